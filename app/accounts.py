@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+import time
+from . import config
+
+logger = logging.getLogger(__name__)
+
+class MailboxRoute:
+    """One monitored mailbox: the account it belongs to and the chat its mail is forwarded to."""
+    __slots__ = ("host", "port", "user", "password", "mailbox", "chat_id", "processed_folder")
+
+    def __init__(self, host, port, user, password, mailbox, chat_id, processed_folder=None):
+        self.host = host; self.port = port; self.user = user; self.password = password
+        self.mailbox = mailbox; self.chat_id = chat_id; self.processed_folder = processed_folder
+
+    @property
+    def account(self):
+        return f"{self.user}@{self.host}"
+
+    @property
+    def key(self):
+        # Also the outbox/mailbox-state key, so journals written in single-mailbox mode stay valid
+        return f"{self.user}@{self.host}/{self.mailbox}"
+
+def route_from_env():
+    """The single route described by IMAP_* / TELEGRAM_CHAT_ID / PROCESSED_FOLDER_NAME."""
+    return MailboxRoute(config.IMAP_HOST, config.IMAP_PORT, config.IMAP_USER, config.IMAP_PASSWORD,
+                        config.IMAP_MAILBOX, config.TELEGRAM_CHAT_ID, config.PROCESSED_FOLDER_NAME)
+
+def load_routes(filename=None):
+    """Every mailbox -> chat route to monitor.
+
+    Without ACCOUNTS_FILE this is the one route from the environment. The file is JSON:
+
+        {"defaults": {"host": "mail.example.com", "port": 993, "processed_folder": "Forwarded"},
+         "accounts": [{"user": "a@example.com", "password_env": "A_PASSWORD",
+                       "mailboxes": [{"mailbox": "INBOX", "chat_id": "-1001"}, {"mailbox": "Alerts", "chat_id": "-1002"}]}]}
+
+    Account keys override "defaults" and mailbox keys override the account's. The password
+    may be given directly ("password") or by the name of an environment variable ("password_env").
+    Raises ValueError for an incomplete or duplicated route.
+    """
+    filename = filename or config.ACCOUNTS_FILE
+    if not filename: return [route_from_env()]
+    with open(filename, encoding='utf-8') as f: data = json.load(f)
+    defaults = {"port": 993, "mailbox": "INBOX", "processed_folder": config.PROCESSED_FOLDER_NAME, **data.get("defaults", {})}
+    routes = []; seen = set()
+    for account_idx, account in enumerate(data.get("accounts", [])):
+        mailboxes = account.get("mailboxes") or [{}]
+        for mailbox in mailboxes:
+            if isinstance(mailbox, str): mailbox = {"mailbox": mailbox}
+            settings = {**defaults, **{k: v for k, v in account.items() if k != "mailboxes"}, **mailbox}
+            password = settings.get("password")
+            if password is None and settings.get("password_env"): password = os.getenv(settings["password_env"])
+            chat_id = settings.get("chat_id", config.TELEGRAM_CHAT_ID)
+            missing = [name for name, value in (("host", settings.get("host")), ("user", settings.get("user")),
+                                                ("password", password), ("chat_id", chat_id)) if not value]
+            if missing: raise ValueError(f"Account #{account_idx + 1} ({settings.get('user') or '?'}) in {filename} is missing: {', '.join(missing)}")
+            route = MailboxRoute(settings["host"], int(settings["port"]), settings["user"], password, settings["mailbox"],
+                                 str(chat_id), settings.get("processed_folder") or None)
+            if route.key in seen: raise ValueError(f"Mailbox {route.key} is listed twice in {filename}.")
+            seen.add(route.key); routes.append(route)
+    if not routes: raise ValueError(f"No accounts defined in {filename}.")
+    logger.info(f"[{time.strftime('%H:%M:%S')}] Loaded {len(routes)} mailbox routes from {filename} ({len({route.account for route in routes})} accounts).")
+    return routes
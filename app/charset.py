@@ -0,0 +1,64 @@
+from collections import OrderedDict
+import codecs
+import logging
+import time
+import chardet
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# Declared labels that real-world senders use for the wider superset encoding
+CHARSET_SUPERSETS = {"gb2312": "gb18030", "gbk": "gb18030", "iso-8859-1": "cp1252", "ascii": "utf-8", "us-ascii": "utf-8"}
+
+# Sender domain -> last charset detected for an undeclared part from that domain (per process)
+_domain_charsets = OrderedDict()
+
+def _normalise(charset):
+    """Python codec name for a charset label, widened to its superset, or None if unknown."""
+    if not charset: return None
+    charset = charset.strip().strip('"').lower()
+    charset = CHARSET_SUPERSETS.get(charset, charset)
+    try: return codecs.lookup(charset).name
+    except LookupError: return None
+
+def _decodes(payload, charset, final=True):
+    # final=False accepts a multibyte sequence cut off at the end of a sample
+    try: codecs.getincrementaldecoder(charset)().decode(payload, final=final); return True
+    except (UnicodeDecodeError, LookupError): return False
+
+def _remember(domain, charset):
+    if not domain or config.CHARSET_CACHE_SIZE <= 0: return
+    _domain_charsets[domain] = charset; _domain_charsets.move_to_end(domain)
+    while len(_domain_charsets) > config.CHARSET_CACHE_SIZE: _domain_charsets.popitem(last=False)
+
+def resolve_charset(payload, declared=None, domain=None):
+    """Picks the codec for a text payload, cheapest evidence first.
+
+    1. the declared charset, 2. strict UTF-8 (covers ASCII), 3. what was last detected
+    for the same sender domain, if the sample decodes cleanly with it, 4. chardet on a bounded sample.
+    """
+    charset = _normalise(declared)
+    if charset: return charset
+    if _decodes(payload, 'utf-8'): return 'utf-8'
+    return _detect(payload, domain)
+
+def _detect(payload, domain=None):
+    # Steps 3 and 4 of resolve_charset, for a payload already known not to be UTF-8
+    sample = payload[:config.CHARSET_DETECT_SAMPLE_BYTES]
+    cached = _domain_charsets.get(domain) if domain else None
+    if cached and _decodes(sample, cached, final=len(sample) == len(payload)):
+        _domain_charsets.move_to_end(domain); return cached
+    detected = _normalise(chardet.detect(sample).get('encoding')) or 'utf-8'
+    logger.debug(f"[{time.strftime('%H:%M:%S')}] Detected charset {detected} from a {len(sample)} byte sample (domain: {domain or 'N/A'}).")
+    _remember(domain, detected)
+    return detected
+
+def decode_text(payload, declared=None, domain=None):
+    """Decodes a text part payload; undecodable bytes are replaced, never raised."""
+    charset = _normalise(declared)
+    if not charset:
+        # The common undeclared case: valid UTF-8 is decoded once, with no detection at all
+        try: return payload.decode('utf-8')
+        except UnicodeDecodeError: charset = _detect(payload, domain) # Not UTF-8: that attempt is not repeated
+    try: return payload.decode(charset, errors='replace')
+    except Exception: return payload.decode('utf-8', errors='replace')
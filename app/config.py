@@ -2,6 +2,7 @@ import os
 import re # 添加导入 re 模块
 from dotenv import load_dotenv
 import logging
+import socket
 import time
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', '..', '.env')
@@ -13,10 +14,20 @@ IMAP_PORT = int(os.getenv('IMAP_PORT', 993))
 IMAP_USER = os.getenv('IMAP_USER')
 IMAP_PASSWORD = os.getenv('IMAP_PASSWORD')
 IMAP_MAILBOX = os.getenv('IMAP_MAILBOX', 'INBOX')
+# JSON file listing many account/mailbox -> chat routes, all monitored by this one process (see accounts.load_routes)
+ACCOUNTS_FILE = os.getenv('ACCOUNTS_FILE') or None
+IMAP_MAX_CONCURRENT_LOGINS = int(os.getenv('IMAP_MAX_CONCURRENT_LOGINS', '4')) # 0: no limit
 
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
 
+# Telegram Bot API transport. Point TELEGRAM_API_BASE_URL at a local Bot API server (or a test stand-in) if needed.
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', 'https://api.telegram.org')
+TELEGRAM_HTTP_POOL_SIZE = int(os.getenv('TELEGRAM_HTTP_POOL_SIZE', '16')) # Max pooled keep-alive connections
+TELEGRAM_CONNECT_TIMEOUT_SECONDS = float(os.getenv('TELEGRAM_CONNECT_TIMEOUT_SECONDS', '10'))
+TELEGRAM_READ_TIMEOUT_SECONDS = float(os.getenv('TELEGRAM_READ_TIMEOUT_SECONDS', '120'))
+TELEGRAM_KEEPALIVE_SECONDS = float(os.getenv('TELEGRAM_KEEPALIVE_SECONDS', '60'))
+
 LOG_LEVEL_STR = os.getenv('LOG_LEVEL', 'INFO').upper()
 LOG_LEVEL = getattr(logging, LOG_LEVEL_STR, logging.INFO)
 
@@ -57,6 +68,13 @@ TELEGRAM_IMAGE_PREVIEW = TELEGRAM_IMAGE_PREVIEW_STR == 'true'
 # Set a conservative default, e.g., 5MB.
 TELEGRAM_IMAGE_PREVIEW_MAX_SIZE_MB = float(os.getenv('TELEGRAM_IMAGE_PREVIEW_MAX_SIZE_MB', '5.0'))
 TELEGRAM_IMAGE_PREVIEW_MAX_SIZE_BYTES = int(TELEGRAM_IMAGE_PREVIEW_MAX_SIZE_MB * 1024 * 1024)
+# Bot API upload limit (50 MB on api.telegram.org, 2000 MB on a local Bot API server)
+TELEGRAM_MAX_UPLOAD_MB = float(os.getenv('TELEGRAM_MAX_UPLOAD_MB', '50'))
+TELEGRAM_MAX_UPLOAD_BYTES = int(TELEGRAM_MAX_UPLOAD_MB * 1024 * 1024)
+
+# Album Mode: group image/document attachments and split body images into sendMediaGroup albums (up to 10 per album)
+TELEGRAM_ALBUM_MODE_STR = os.getenv('TELEGRAM_ALBUM_MODE', 'true').lower()
+TELEGRAM_ALBUM_MODE = TELEGRAM_ALBUM_MODE_STR == 'true'
 
 # Filtering and Content Forwarding Configuration
 def compile_regex(pattern_str, flag=re.IGNORECASE):
@@ -77,12 +95,104 @@ FILTER_SENDER_WHITELIST_REGEX = compile_regex(FILTER_SENDER_WHITELIST_REGEX_STR)
 FILTER_SUBJECT_BLACKLIST_REGEX_STR = os.getenv('FILTER_SUBJECT_BLACKLIST_REGEX', '')
 FILTER_SUBJECT_BLACKLIST_REGEX = compile_regex(FILTER_SUBJECT_BLACKLIST_REGEX_STR)
 
+# JSON rule file (match conditions -> drop / forward / route / headers_only / no_attachments), checked after the regexes above
+FILTER_RULES_FILE = os.getenv('FILTER_RULES_FILE') or None
+
 FORWARD_ATTACHMENTS_STR = os.getenv('FORWARD_ATTACHMENTS', 'true').lower()
 FORWARD_ATTACHMENTS = FORWARD_ATTACHMENTS_STR == 'true'
 
 FORWARD_BODY_STR = os.getenv('FORWARD_BODY', 'true').lower()
 FORWARD_BODY = FORWARD_BODY_STR == 'true'
 
+# Processing Pipeline Configuration
+# Fetched emails flow through parse -> render -> send -> commit stages with bounded queues between them.
+IMAP_FETCH_BATCH_SIZE = int(os.getenv('IMAP_FETCH_BATCH_SIZE', '20'))
+PIPELINE_PARSE_WORKERS = int(os.getenv('PIPELINE_PARSE_WORKERS', '2'))
+PIPELINE_RENDER_WORKERS = int(os.getenv('PIPELINE_RENDER_WORKERS', '2'))
+PIPELINE_SEND_WORKERS = int(os.getenv('PIPELINE_SEND_WORKERS', '4')) # Max chats delivered to concurrently
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '20'))
+# Memory held by in-flight emails (raw messages, parsed bodies, in-memory attachment spools); fetching waits above it
+PIPELINE_MEMORY_BUDGET_MB = float(os.getenv('PIPELINE_MEMORY_BUDGET_MB', '64')) # 0 disables the budget
+PIPELINE_MEMORY_BUDGET_BYTES = int(PIPELINE_MEMORY_BUDGET_MB * 1024 * 1024)
+# Attachments up to this size stay in memory; larger ones are spooled to temporary files in SPOOL_DIR
+SPOOL_MEMORY_THRESHOLD_KB = int(os.getenv('SPOOL_MEMORY_THRESHOLD_KB', '512'))
+SPOOL_MEMORY_THRESHOLD_BYTES = SPOOL_MEMORY_THRESHOLD_KB * 1024
+SPOOL_DIR = os.getenv('SPOOL_DIR') or None # None: the system temporary directory
+IMAP_FLAG_BATCH_SIZE = int(os.getenv('IMAP_FLAG_BATCH_SIZE', '200')) # Delivered UIDs flagged/moved per IMAP command
+IMAP_FLAG_FLUSH_SECONDS = float(os.getenv('IMAP_FLAG_FLUSH_SECONDS', '10')) # Flush a smaller batch once its oldest UID waited this long
+# Two IMAP connections: one parked in IDLE that only reports new mail, one that fetches and flags
+IMAP_DUAL_CONNECTION_STR = os.getenv('IMAP_DUAL_CONNECTION', 'true').lower()
+IMAP_DUAL_CONNECTION = IMAP_DUAL_CONNECTION_STR == 'true'
+# Header-first fetch: with filters configured, the filtered headers (and size) are fetched first and only accepted mail is downloaded
+IMAP_HEADER_PREFETCH_STR = os.getenv('IMAP_HEADER_PREFETCH', 'true').lower()
+IMAP_HEADER_PREFETCH = IMAP_HEADER_PREFETCH_STR == 'true'
+IMAP_HEADER_FETCH_BATCH_SIZE = int(os.getenv('IMAP_HEADER_FETCH_BATCH_SIZE', '200'))
+# Partial fetch: large multipart messages download only their text parts up front; attachments are streamed
+# part by part (BODY.PEEK[n]<offset.length>) to temporary files, and parts over the upload limit are never downloaded
+IMAP_PARTIAL_FETCH_STR = os.getenv('IMAP_PARTIAL_FETCH', 'true').lower()
+IMAP_PARTIAL_FETCH = IMAP_PARTIAL_FETCH_STR == 'true'
+IMAP_PARTIAL_FETCH_MIN_KB = int(os.getenv('IMAP_PARTIAL_FETCH_MIN_KB', '512')) # Smaller messages are fetched whole
+IMAP_PARTIAL_FETCH_MIN_BYTES = IMAP_PARTIAL_FETCH_MIN_KB * 1024
+IMAP_PART_CHUNK_KB = int(os.getenv('IMAP_PART_CHUNK_KB', '1024'))
+IMAP_PART_CHUNK_BYTES = IMAP_PART_CHUNK_KB * 1024
+
+# Parsing Configuration
+# PARSE_PROCESS_WORKERS > 0 parses emails in a pool of worker processes; 0 parses on a background thread.
+PARSE_PROCESS_WORKERS = int(os.getenv('PARSE_PROCESS_WORKERS', '0'))
+# An email whose full parse takes longer than this falls back to a cheap plain-text extraction (process pool mode only).
+PARSE_TIMEOUT_SECONDS = float(os.getenv('PARSE_TIMEOUT_SECONDS', '20'))
+# Text bodies are cut after this many Telegram messages; HTML conversion stops as soon as it gets there
+BODY_TEXT_MAX_MESSAGES = int(os.getenv('BODY_TEXT_MAX_MESSAGES', '10'))
+# Charset detection for text parts without a declared charset: only this many leading bytes are sampled,
+# and the result is remembered per sender domain (entries kept per parse process)
+CHARSET_DETECT_SAMPLE_KB = int(os.getenv('CHARSET_DETECT_SAMPLE_KB', '32'))
+CHARSET_DETECT_SAMPLE_BYTES = CHARSET_DETECT_SAMPLE_KB * 1024
+CHARSET_CACHE_SIZE = int(os.getenv('CHARSET_CACHE_SIZE', '1024'))
+
+# Persistent State Configuration
+# Caches and state files are kept here; mount it as a volume so they survive restarts.
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+
+# Telegram file_id Cache: identical attachments (by content hash) are re-sent by file_id instead of re-uploaded
+FILE_ID_CACHE_ENABLED_STR = os.getenv('FILE_ID_CACHE_ENABLED', 'true').lower()
+FILE_ID_CACHE_ENABLED = FILE_ID_CACHE_ENABLED_STR == 'true'
+FILE_ID_CACHE_DB = os.getenv('FILE_ID_CACHE_DB', os.path.join(DATA_DIR, 'file_id_cache.sqlite3'))
+FILE_ID_CACHE_MAX_ENTRIES = int(os.getenv('FILE_ID_CACHE_MAX_ENTRIES', '50000'))
+
+# Delivery Outbox: journals every sent part per UID so an interrupted delivery resumes instead of starting over
+OUTBOX_DB = os.getenv('OUTBOX_DB', os.path.join(DATA_DIR, 'outbox.sqlite3'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5')) # After this many incomplete attempts the UID is marked processed anyway
+
+# Mailbox State: highest handled UID per mailbox (scoped to UIDVALIDITY), so wakeups only search newer UIDs
+MAILBOX_STATE_DB = os.getenv('MAILBOX_STATE_DB', os.path.join(DATA_DIR, 'mailbox_state.sqlite3'))
+# Sharded workers: processes (or hosts) sharing DATA_DIR split the mailboxes through leases in LEASE_DB.
+# The store is SQLite, so hosts must share it over a filesystem with working locks (not NFS) and synced clocks.
+SHARD_LEASES_STR = os.getenv('SHARD_LEASES', 'false').lower()
+SHARD_LEASES = SHARD_LEASES_STR == 'true'
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '1')) # Worker processes started by this process in sharded mode
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_DB = os.getenv('LEASE_DB', os.path.join(DATA_DIR, 'leases.sqlite3'))
+LEASE_TTL_SECONDS = float(os.getenv('LEASE_TTL_SECONDS', '60')) # A dead worker's mailboxes are taken over after this long
+# CONDSTORE (RFC 7162), used when the server advertises it: reconnects skip the scan if HIGHESTMODSEQ did not change
+IMAP_CONDSTORE_ENABLED_STR = os.getenv('IMAP_CONDSTORE_ENABLED', 'true').lower()
+IMAP_CONDSTORE_ENABLED = IMAP_CONDSTORE_ENABLED_STR == 'true'
+
+# HTML Rendering Configuration
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', '2')) # Max concurrent wkhtmltoimage processes
+RENDER_TIMEOUT_SECONDS = float(os.getenv('RENDER_TIMEOUT_SECONDS', '60'))
+RENDER_QUEUE_TIMEOUT_SECONDS = float(os.getenv('RENDER_QUEUE_TIMEOUT_SECONDS', '120'))
+RENDER_CACHE_DIR = os.getenv('RENDER_CACHE_DIR', os.path.join(DATA_DIR, 'render_cache'))
+RENDER_CACHE_MAX_MB = float(os.getenv('RENDER_CACHE_MAX_MB', '200')) # 0 disables the render cache
+RENDER_CACHE_MAX_BYTES = int(RENDER_CACHE_MAX_MB * 1024 * 1024)
+
+# Telegram Rate Limit Configuration (Bot API limits: ~30 messages/s overall, ~1/s per chat, 20/min per group)
+TELEGRAM_GLOBAL_RATE_PER_SECOND = float(os.getenv('TELEGRAM_GLOBAL_RATE_PER_SECOND', '30'))
+TELEGRAM_GLOBAL_BURST = int(os.getenv('TELEGRAM_GLOBAL_BURST', '30'))
+TELEGRAM_CHAT_RATE_PER_MINUTE = float(os.getenv('TELEGRAM_CHAT_RATE_PER_MINUTE', '60'))
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv('TELEGRAM_GROUP_RATE_PER_MINUTE', '20'))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_RETRY_AFTER_MAX_RETRIES = int(os.getenv('TELEGRAM_RETRY_AFTER_MAX_RETRIES', '10'))
+
 logging.basicConfig(
     level=LOG_LEVEL,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -92,10 +202,12 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 def validate_config():
-    required_vars = {
-        "IMAP_HOST": IMAP_HOST, "IMAP_USER": IMAP_USER, "IMAP_PASSWORD": IMAP_PASSWORD,
-        "TELEGRAM_BOT_TOKEN": TELEGRAM_BOT_TOKEN, "TELEGRAM_CHAT_ID": TELEGRAM_CHAT_ID,
-    }
+    required_vars = {"TELEGRAM_BOT_TOKEN": TELEGRAM_BOT_TOKEN}
+    if ACCOUNTS_FILE:
+        # Accounts and chats come from the file; it is checked when the routes are loaded
+        if not os.path.exists(ACCOUNTS_FILE): raise ValueError(f"ACCOUNTS_FILE '{ACCOUNTS_FILE}' does not exist.")
+    else: required_vars.update({"IMAP_HOST": IMAP_HOST, "IMAP_USER": IMAP_USER, "IMAP_PASSWORD": IMAP_PASSWORD, "TELEGRAM_CHAT_ID": TELEGRAM_CHAT_ID})
+    if FILTER_RULES_FILE and not os.path.exists(FILTER_RULES_FILE): raise ValueError(f"FILTER_RULES_FILE '{FILTER_RULES_FILE}' does not exist.")
     missing_vars = [key for key, value in required_vars.items() if value is None]
     if missing_vars:
         logger.critical(f"Missing critical environment variables: {', '.join(missing_vars)}")
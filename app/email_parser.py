@@ -1,19 +1,22 @@
 import email
 from email.header import decode_header
-from email.utils import parsedate_to_datetime
+from email.utils import parsedate_to_datetime, parseaddr
 import html2text
-import markdownify
 from bs4 import BeautifulSoup
 import logging
-import chardet
 import time
 import re
 from . import config
+from .spool import Spool
+from .charset import decode_text
+from .html_text import html_to_markdown
 
 logger = logging.getLogger(__name__)
 
 MAX_TELEGRAM_MESSAGE_LENGTH = 4096
 EFFECTIVE_MAX_LENGTH = MAX_TELEGRAM_MESSAGE_LENGTH - 30
+BODY_TEXT_MAX_CHARS = config.BODY_TEXT_MAX_MESSAGES * EFFECTIVE_MAX_LENGTH
+BODY_TRUNCATED_NOTE = "[正文过长，后续内容已省略]"
 
 def decode_email_header(header_value):
     if not header_value: return ""
@@ -93,57 +96,103 @@ def handle_email_quotes(text_body):
 
     return "\n".join(processed_lines).strip()
 
-def get_email_body(msg):
-    body_plain = ""
-    body_html_raw = "" # Store raw HTML here
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disposition = str(part.get("Content-Disposition", "")).lower()
-            if "attachment" not in content_disposition:
-                payload = part.get_payload(decode=True)
-                if payload is None: continue
-                charset = part.get_content_charset() or chardet.detect(payload).get('encoding') or 'utf-8'
-                try:
-                    decoded_payload = payload.decode(charset, errors='replace')
-                except Exception:
-                    decoded_payload = payload.decode('utf-8', errors='replace')
-                
-                if content_type == "text/plain" and not body_plain:
-                    body_plain = decoded_payload
-                elif content_type == "text/html" and not body_html_raw:
-                    body_html_raw = decoded_payload # Store raw HTML
-    else:
-        payload = msg.get_payload(decode=True)
-        if payload:
-            charset = msg.get_content_charset() or chardet.detect(payload).get('encoding') or 'utf-8'
-            try:
-                decoded_payload = payload.decode(charset, errors='replace')
-            except Exception:
-                decoded_payload = payload.decode('utf-8', errors='replace')
+class MimePart:
+    """One leaf of the MIME tree. The payload is only transfer-decoded when a consumer asks for it, and only once."""
+    __slots__ = ("part", "content_type", "disposition", "_payload", "_decoded")
+
+    def __init__(self, part):
+        self.part = part
+        self.content_type = part.get_content_type()
+        self.disposition = str(part.get("Content-Disposition", "")).lower()
+        self._payload = None; self._decoded = False
+
+    @property
+    def filename(self):
+        filename = self.part.get_filename() or self.part.get_param('name', header='content-type')
+        return decode_email_header(filename) if filename else None
+
+    @property
+    def estimated_size(self):
+        """Decoded size guessed from the encoded payload, without decoding it."""
+        encoded = self.part.get_payload()
+        if not isinstance(encoded, str): return 0
+        return len(encoded) * 3 // 4 if self.part.get("Content-Transfer-Encoding", "").strip().lower() == "base64" else len(encoded)
+
+    def payload(self):
+        if not self._decoded:
+            self._payload = self.part.get_payload(decode=True); self._decoded = True
+        return self._payload
+
+    def text(self, domain=None):
+        payload = self.payload()
+        if payload is None: return None
+        return decode_text(payload, self.part.get_content_charset(), domain)
+
+    def release(self):
+        self._payload = None; self._decoded = False
+
+class MimeParts:
+    """Result of one walk over a message: body candidates and attachments."""
+    __slots__ = ("plain", "html", "attachments", "domain")
 
-            if msg.get_content_type() == "text/plain":
-                body_plain = decoded_payload
-            elif msg.get_content_type() == "text/html":
-                body_html_raw = decoded_payload # Store raw HTML
+    def __init__(self, domain=None):
+        self.domain = domain # Sender domain, the cache key for charset detection
+        self.plain = []; self.html = [] # Candidates in document order; the first non-empty one is the body
+        self.attachments = []
+
+def walk_mime(msg):
+    """Classifies every part of msg in a single msg.walk(); nothing is decoded here."""
+    parts = MimeParts(parseaddr(decode_email_header(msg.get("From", "")))[1].rpartition("@")[2].lower() or None)
+    if not msg.is_multipart():
+        # A single-part message is its own body, whatever its disposition says
+        leaf = MimePart(msg)
+        if leaf.content_type == "text/plain": parts.plain.append(leaf)
+        elif leaf.content_type == "text/html": parts.html.append(leaf)
+        if "attachment" in leaf.disposition or msg.get_filename(): parts.attachments.append(leaf)
+        return parts
+    for part in msg.walk():
+        if part.is_multipart(): continue
+        leaf = MimePart(part)
+        if "attachment" not in leaf.disposition:
+            if leaf.content_type == "text/plain": parts.plain.append(leaf)
+            elif leaf.content_type == "text/html": parts.html.append(leaf)
+        if "attachment" in leaf.disposition or part.get_filename():
+            # Ensure we are not picking up inline images that html2text might have ignored
+            if "inline" in leaf.disposition and leaf.content_type.startswith("image/"): continue
+            parts.attachments.append(leaf)
+    return parts
+
+def _first_text(candidates, domain=None):
+    for leaf in candidates:
+        text = leaf.text(domain)
+        if text: return text
+    return ""
+
+def get_email_body(parts):
+    # Only text/plain and text/html candidates are decoded, and only until a non-empty one is found
+    body_plain = _first_text(parts.plain, parts.domain)
+    body_html_raw = _first_text(parts.html, parts.domain) # Store raw HTML here
 
     final_body_text_for_markdown = ""
     processed_html_successfully_for_markdown = False
+    body_format = "text" # "markdown" when the text carries the converter's **bold**/[label](url) markup
 
+    truncated = False
     if body_html_raw: # Use body_html_raw for text conversion
         try:
-            final_body_text_for_markdown = markdownify.markdownify(body_html_raw, heading_style="ATX", strip=['script', 'style']).strip()
-            logger.debug(f"[{time.strftime('%H:%M:%S')}] Successfully converted HTML to Markdown using markdownify.")
-            processed_html_successfully_for_markdown = True
+            # Streaming conversion: stops once the text passes what will be sent, so huge HTML costs no more than small HTML
+            final_body_text_for_markdown, truncated = html_to_markdown(body_html_raw, BODY_TEXT_MAX_CHARS)
+            logger.debug(f"[{time.strftime('%H:%M:%S')}] Converted HTML to Markdown ({len(final_body_text_for_markdown)} chars{', truncated' if truncated else ''}).")
+            processed_html_successfully_for_markdown = True; body_format = "markdown"
         except Exception as e_md:
-            logger.warning(f"[{time.strftime('%H:%M:%S')}] markdownify conversion failed: {e_md}. Falling back to html2text.")
+            logger.warning(f"[{time.strftime('%H:%M:%S')}] HTML to Markdown conversion failed: {e_md}. Falling back to html2text.")
             try:
                 h = html2text.HTML2Text()
                 h.ignore_links = False; h.ignore_images = True; h.body_width = 0
                 h.unicode_snob = True; h.emphasis_mark = '*'; h.strong_mark = '**'
                 final_body_text_for_markdown = h.handle(body_html_raw).strip()
                 logger.debug(f"[{time.strftime('%H:%M:%S')}] Successfully converted HTML to text using html2text.")
-                processed_html_successfully_for_markdown = True
+                processed_html_successfully_for_markdown = True; body_format = "markdown"
             except Exception as e_h2t:
                 logger.error(f"[{time.strftime('%H:%M:%S')}] html2text conversion also failed: {e_h2t}. Falling back to BeautifulSoup.")
                 try:
@@ -162,39 +211,37 @@ def get_email_body(msg):
         logger.debug(f"[{time.strftime('%H:%M:%S')}] No HTML body found, using plain text body.")
         final_body_text_for_markdown = body_plain.strip()
     
+    if len(final_body_text_for_markdown) > BODY_TEXT_MAX_CHARS:
+        final_body_text_for_markdown = final_body_text_for_markdown[:BODY_TEXT_MAX_CHARS]; truncated = True
     cleaned_body_for_markdown = handle_email_quotes(final_body_text_for_markdown)
+    if truncated and cleaned_body_for_markdown.strip(): cleaned_body_for_markdown += f"\n\n{BODY_TRUNCATED_NOTE}"
 
     if not cleaned_body_for_markdown.strip() and not (config.EMAIL_QUOTE_HANDLING == 'remove' and final_body_text_for_markdown.strip()):
         cleaned_body_for_markdown = "_[邮件正文为空]_"
     
-    # Return both raw HTML (if available) and the processed text body
-    return body_html_raw if body_html_raw else None, cleaned_body_for_markdown
+    # Return raw HTML (if available), the processed text body and its format
+    return body_html_raw if body_html_raw else None, cleaned_body_for_markdown, body_format
 
-def get_attachments(msg):
+def get_attachments(parts, decode=True):
+    """Attachment dicts for the parsed email. With decode=False payloads stay undecoded ("data" is None, "size" estimated)."""
     attachments = []
-    for part in msg.walk():
-        content_disposition = str(part.get("Content-Disposition", "")).lower()
-        if ("attachment" in content_disposition) or part.get_filename():
-            # Ensure we are not picking up inline images that html2text might have ignored
-            content_type_main = part.get_content_type().split(';')[0].strip().lower()
-            if "inline" in content_disposition and content_type_main.startswith("image/"):
-                continue # Skip inline images if we are generally ignoring them
-
-            filename = part.get_filename()
-            if filename: filename = decode_email_header(filename)
-            else:
-                filename = part.get_param('name', header='content-type')
-                if filename: filename = decode_email_header(filename)
-                else: filename = f"attachment_{len(attachments) + 1}"
-            try:
-                attachment_data = part.get_payload(decode=True)
-                if attachment_data:
-                    attachments.append({"filename": filename, "data": attachment_data, "content_type": part.get_content_type()})
-            except Exception as e: logger.error(f"[{time.strftime('%H:%M:%S')}] Could not decode attachment {filename}: {e}")
+    for number, leaf in enumerate(parts.attachments, 1):
+        filename = leaf.filename or f"attachment_{len(attachments) + 1}"
+        step = f"attachment:{number}" # Numbered by MIME leaf, not list position: empty parts are dropped below
+        if not decode:
+            size = leaf.estimated_size
+            if size: attachments.append({"filename": filename, "data": None, "content_type": leaf.content_type, "size": size, "step": step})
+            continue
+        try:
+            attachment_data = leaf.payload()
+            if attachment_data:
+                # Large payloads spill to disk here, so the parsed email does not pin them in memory
+                attachments.append({"filename": filename, "data": Spool.from_bytes(attachment_data, prefix="att-"), "content_type": leaf.content_type, "step": step})
+        except Exception as e: logger.error(f"[{time.strftime('%H:%M:%S')}] Could not decode attachment {filename}: {e}")
+        finally: leaf.release()
     return attachments
 
-def parse_email(raw_email_bytes, uid=None):
-    msg = email.message_from_bytes(raw_email_bytes)
+def get_header_fields(msg):
     subject = decode_email_header(msg.get("Subject", "[无主题]"))
     from_ = decode_email_header(msg.get("From", "[未知发件人]"))
     to_ = decode_email_header(msg.get("To", "[未知收件人]"))
@@ -215,31 +262,61 @@ def parse_email(raw_email_bytes, uid=None):
         email_importance = "low"
     # 'normal' (Importance) or '3' (X-Priority) or empty/not present defaults to 'normal'
 
-    body_html_raw, body_text_processed = get_email_body(msg) # Now returns two values
-    attachments = get_attachments(msg)
-
-    return {"uid": uid, "subject": subject, "from": from_, "to": to_, "cc": cc_ if cc_ else "N/A",
+    return {"subject": subject, "from": from_, "to": to_, "cc": cc_ if cc_ else "N/A",
             "date": email_date_obj.strftime("%Y-%m-%d %H:%M:%S %Z") if email_date_obj else date_str or "N/A",
-            "body_html": body_html_raw, # Add raw HTML body
-            "body": body_text_processed, # This is the text version for fallback or if no HTML
             "importance": email_importance,
-            "attachments": attachments,
-            "message_id": msg.get("Message-ID", "N/A")}
-
-def split_message(text, max_length=EFFECTIVE_MAX_LENGTH):
-    parts = []; temp_parts = []
-    if not text: return [""]
-    current_text = str(text)
-    while len(current_text) > 0:
-        if len(current_text) <= max_length: temp_parts.append(current_text); break
-        else:
-            split_at = current_text.rfind('\n', 0, max_length)
-            if split_at == -1 or split_at == 0: split_at = max_length
-            temp_parts.append(current_text[:split_at])
-            current_text = current_text[split_at:].lstrip('\n')
-    if not temp_parts: return [""]
-    total_parts = len(temp_parts)
-    if total_parts > 1:
-        for i, part_content in enumerate(temp_parts): parts.append(f"{part_content}\n_(第 {i+1}/{total_parts} 部分)_")
-    else: parts = temp_parts
-    return parts
+            "message_id": msg.get("Message-ID", "N/A"), "list_id": msg.get("List-Id")}
+
+def parse_email(raw_email_bytes, uid=None):
+    # The result only holds str/lists and finished Spools so it can be returned from a parse worker process
+    msg = email.message_from_bytes(raw_email_bytes)
+    parsed_email = {"uid": uid}
+    parsed_email.update(get_header_fields(msg))
+
+    parts = walk_mime(msg)
+    body_html_raw, body_text_processed, body_format = get_email_body(parts)
+    parsed_email["body_html"] = body_html_raw if config.FORWARD_BODY else None # Add raw HTML body (only needed for rendering)
+    parsed_email["body"] = body_text_processed # This is the text version for fallback or if no HTML
+    parsed_email["body_format"] = body_format
+    parsed_email["attachments"] = get_attachments(parts, decode=config.FORWARD_ATTACHMENTS)
+    return parsed_email
+
+FALLBACK_BODY_MAX_CHARS = EFFECTIVE_MAX_LENGTH * 4
+HTML_TAG_PATTERN = re.compile(r"<(script|style)\b.*?</\1\s*>|<[^>]+>", re.IGNORECASE | re.DOTALL)
+
+def parse_email_fallback(raw_email_bytes, uid=None):
+    """Cheap parse used when the full parse times out: no HTML conversion or rendering, tags are just stripped."""
+    msg = email.message_from_bytes(raw_email_bytes)
+    parsed_email = {"uid": uid}
+    parsed_email.update(get_header_fields(msg))
+
+    parts = walk_mime(msg)
+    def _first_prefix(candidates):
+        for leaf in candidates:
+            payload = leaf.payload()
+            if not payload: continue
+            try: return payload[:FALLBACK_BODY_MAX_CHARS * 4].decode(leaf.part.get_content_charset() or 'utf-8', errors='replace')
+            except LookupError: return payload[:FALLBACK_BODY_MAX_CHARS * 4].decode('utf-8', errors='replace')
+        return ""
+    body_text = _first_prefix(parts.plain)
+    if not body_text: body_text = re.sub(r"[ \t]*\n\s*\n\s*", "\n\n", HTML_TAG_PATTERN.sub(" ", _first_prefix(parts.html)))
+    body_text = body_text.strip()[:FALLBACK_BODY_MAX_CHARS]
+
+    parsed_email["body_html"] = None
+    parsed_email["body"] = body_text or "_[邮件正文为空]_"
+    parsed_email["body_format"] = "text"
+    parsed_email["attachments"] = get_attachments(parts, decode=config.FORWARD_ATTACHMENTS)
+    return parsed_email
+
+def utf16_length(text):
+    """Length as Telegram counts it: UTF-16 code units, so astral characters (most emoji) count twice."""
+    return len(text.encode('utf-16-le')) // 2
+
+def utf16_prefix(text, max_units):
+    """Number of leading characters of text that fit in max_units UTF-16 units."""
+    if len(text) * 2 <= max_units or utf16_length(text) <= max_units: return len(text)
+    units = 0
+    for idx, char in enumerate(text):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > max_units: return idx
+    return len(text)
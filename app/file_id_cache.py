@@ -0,0 +1,79 @@
+import hashlib
+import logging
+import time
+from . import config
+from .storage import open_database
+
+logger = logging.getLogger(__name__)
+
+# Bot API errors that mean a cached file_id can no longer be used and the file must be uploaded again.
+# Only Telegram's specific messages: other BadRequests merely mentioning a file_id must not drop the cache
+STALE_FILE_ID_MARKERS = ("wrong file identifier", "wrong remote file identifier", "file reference expired", "file_reference_expired",
+                         "type of file mismatch", "wrong type of the web page content")
+
+def is_stale_file_id_error(error):
+    text = str(error).lower()
+    return any(marker in text for marker in STALE_FILE_ID_MARKERS)
+
+def extract_file_id(message, kind):
+    """Pulls the file_id Telegram assigned to an uploaded photo/document out of the sent message."""
+    if not message: return None
+    if kind == 'photo' and message.get('photo'): return message['photo'][-1].get('file_id') # Largest size
+    for key in (kind, 'document', 'animation', 'video'):
+        media = message.get(key)
+        if isinstance(media, dict) and media.get('file_id'): return media['file_id']
+    return None
+
+class FileIdCache:
+    """Persistent map of attachment content hash -> Telegram file_id, with LRU eviction."""
+
+    def __init__(self, filename=None, max_entries=None, enabled=None):
+        self.filename = filename or config.FILE_ID_CACHE_DB
+        self.max_entries = max_entries or config.FILE_ID_CACHE_MAX_ENTRIES
+        self.enabled = config.FILE_ID_CACHE_ENABLED if enabled is None else enabled
+        self._db = None; self._inserts_since_evict = 0
+
+    @staticmethod
+    def content_hash(data):
+        # Spooled attachments (spool.Spool) were hashed while they were written
+        return data.sha256 if hasattr(data, 'sha256') else hashlib.sha256(data).hexdigest()
+
+    def _conn(self):
+        if self._db is None:
+            self._db = open_database(self.filename)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS file_ids (
+                content_hash TEXT NOT NULL, kind TEXT NOT NULL, file_id TEXT NOT NULL,
+                size INTEGER NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (content_hash, kind))""")
+            self._db.execute("CREATE INDEX IF NOT EXISTS file_ids_last_used ON file_ids (last_used)")
+        return self._db
+
+    def lookup(self, content_hash, kind):
+        if not self.enabled: return None
+        db = self._conn()
+        row = db.execute("SELECT file_id FROM file_ids WHERE content_hash = ? AND kind = ?", (content_hash, kind)).fetchone()
+        if row is None: return None
+        db.execute("UPDATE file_ids SET last_used = ? WHERE content_hash = ? AND kind = ?", (time.time(), content_hash, kind))
+        return row[0]
+
+    def store(self, content_hash, kind, file_id, size):
+        if not self.enabled or not file_id: return
+        self._conn().execute("INSERT OR REPLACE INTO file_ids (content_hash, kind, file_id, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                             (content_hash, kind, file_id, size, time.time()))
+        self._inserts_since_evict += 1
+        if self._inserts_since_evict >= 100: self._evict()
+
+    def invalidate(self, content_hash, kind):
+        if not self.enabled: return
+        self._conn().execute("DELETE FROM file_ids WHERE content_hash = ? AND kind = ?", (content_hash, kind))
+        logger.info(f"[{time.strftime('%H:%M:%S')}] Dropped stale cached file_id for {kind} {content_hash[:12]}.")
+
+    def _evict(self):
+        self._inserts_since_evict = 0
+        db = self._conn()
+        count = db.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+        if count > self.max_entries:
+            db.execute("DELETE FROM file_ids WHERE rowid IN (SELECT rowid FROM file_ids ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+            logger.debug(f"[{time.strftime('%H:%M:%S')}] Evicted {count - self.max_entries} file_id cache entries.")
+
+    def close(self):
+        if self._db is not None: self._db.close(); self._db = None
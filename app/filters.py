@@ -0,0 +1,219 @@
+from bisect import bisect_right
+from email.utils import getaddresses, parseaddr
+import email
+import json
+import logging
+import re
+import time
+from . import config
+from .email_parser import decode_email_header
+
+logger = logging.getLogger(__name__)
+
+# Header fields the rules look at; the header-first fetch asks the server for exactly these
+FILTER_HEADER_FIELDS = ("FROM", "TO", "CC", "SUBJECT", "LIST-ID")
+
+ACTIONS = ("forward", "drop", "headers_only", "no_attachments")
+# Conditions answered by hashed lookups of the message's keys, and by regexes over a text field
+HASHED_CONDITIONS = ("from_address", "from_domain", "to_address", "to_domain", "list_id", "attachment_type")
+REGEX_CONDITIONS = {"from_regex": "from", "to_regex": "recipients", "subject_regex": "subject"}
+SIZE_CONDITIONS = ("min_size_kb", "max_size_kb")
+
+class Rule:
+    """One compiled rule: what it does when it matches, and its regex conditions (hashed ones live in RuleSet's index)."""
+    __slots__ = ("name", "action", "chat_id", "regexes", "invert", "needs_attachments", "description")
+
+    def __init__(self, name, action="forward", chat_id=None, regexes=None, invert=False, needs_attachments=False, description=None):
+        self.name = name; self.action = action; self.chat_id = chat_id; self.description = description
+        self.regexes = regexes or {} # facts field -> compiled regexes, any of which may match
+        self.invert = invert # Matches when its conditions do NOT all hold (used for whitelists)
+        self.needs_attachments = needs_attachments
+
+    @property
+    def reason(self):
+        if self.description: return self.description
+        return f"rule '{self.name}' ({self.action}{' -> ' + self.chat_id if self.chat_id else ''})"
+
+DEFAULT_RULE = Rule("default")
+
+def _values(value):
+    return [value] if isinstance(value, (str, int, float)) else list(value or [])
+
+def _domain_suffixes(domain):
+    # "a.b.example.com" -> a.b.example.com, b.example.com, example.com, com: a domain rule also covers its subdomains
+    labels = domain.split(".")
+    return [".".join(labels[i:]) for i in range(len(labels))] if domain else []
+
+def _compile_pattern(pattern, where):
+    try: return re.compile(pattern, re.IGNORECASE)
+    except re.error as e: raise ValueError(f"Invalid regex {pattern!r} in {where}: {e}")
+
+class RuleSet:
+    """Rules compiled into one matcher; evaluate() finds the first matching rule in one pass.
+
+    Each rule is a bit. Hashed conditions (addresses, domains, list ids, attachment types)
+    map every value to the mask of rules listing it, size limits are bisected over sorted
+    thresholds, and each regex field has one combined alternation: when it does not match,
+    every rule with that regex is ruled out by a single search (patterns with capture groups
+    stay out of it, since joining renumbers their groups). What is left is walked in
+    rule order, and only those few candidates run their own regexes.
+    """
+
+    def __init__(self, rules, default=DEFAULT_RULE):
+        self.rules = []; self.default = default
+        self.index = {condition: {} for condition in HASHED_CONDITIONS}
+        self.constrained = dict.fromkeys(HASHED_CONDITIONS, 0) # Rules that have the condition at all
+        self.regex_constrained = dict.fromkeys(REGEX_CONDITIONS.values(), 0)
+        self.regex_prefiltered = dict.fromkeys(REGEX_CONDITIONS.values(), 0) # Rules whose patterns are in the combined regex
+        self.inverted = 0; self._patterns = {field: [] for field in REGEX_CONDITIONS.values()}
+        min_sizes = []; max_sizes = []
+        for spec in rules: self._add(spec, min_sizes, max_sizes)
+        self.all = (1 << len(self.rules)) - 1
+        self._min_sizes = self._threshold_masks(min_sizes); self._max_sizes = self._threshold_masks(max_sizes, reverse=True)
+        self.combined = {}
+        for field, patterns in self._patterns.items():
+            if not patterns: continue
+            # Rules with inline global flags cannot be joined; that field is then checked rule by rule
+            try: self.combined[field] = re.compile("|".join(f"(?:{pattern})" for pattern in patterns), re.IGNORECASE)
+            except re.error: self.combined[field] = None
+        del self._patterns
+
+    def _add(self, spec, min_sizes, max_sizes):
+        bit = 1 << len(self.rules); name = spec.get("name") or f"#{len(self.rules) + 1}"
+        action = spec.get("action", "forward")
+        if action == "route": action = "forward" # "route" + chat_id reads better in rule files
+        if action not in ACTIONS: raise ValueError(f"Rule {name}: unknown action {action!r}. Known actions: {', '.join(ACTIONS + ('route',))}")
+        match = spec.get("match", {}); regexes = {}
+        unknown = set(match) - set(HASHED_CONDITIONS) - set(REGEX_CONDITIONS) - set(SIZE_CONDITIONS)
+        if unknown: raise ValueError(f"Rule {name}: unknown conditions {', '.join(sorted(unknown))}.")
+        for condition in HASHED_CONDITIONS:
+            if condition not in match: continue
+            self.constrained[condition] |= bit
+            for value in _values(match[condition]):
+                key = str(value).strip().lower()
+                if condition == "list_id": key = key.strip("<>")
+                self.index[condition][key] = self.index[condition].get(key, 0) | bit
+        for condition, field in REGEX_CONDITIONS.items():
+            if condition not in match: continue
+            compiled = [_compile_pattern(pattern, f"rule {name}") for pattern in _values(match[condition])]
+            self.regex_constrained[field] |= bit
+            if any(regex.groups for regex in compiled):
+                # Joining renumbers capture groups and breaks backreferences: matched one by one, never prefiltered
+                regexes[field] = compiled; continue
+            pattern = "|".join(f"(?:{regex.pattern})" for regex in compiled)
+            regexes[field] = [_compile_pattern(pattern, f"rule {name}")]
+            self.regex_prefiltered[field] |= bit; self._patterns[field].append(pattern)
+        if "min_size_kb" in match: min_sizes.append((float(match["min_size_kb"]) * 1024, bit))
+        if "max_size_kb" in match: max_sizes.append((float(match["max_size_kb"]) * 1024, bit))
+        if spec.get("invert"): self.inverted |= bit
+        chat_id = spec.get("chat_id")
+        self.rules.append(Rule(name, action, str(chat_id) if chat_id is not None else None, regexes,
+                               bool(spec.get("invert")), "attachment_type" in match, spec.get("description")))
+
+    @staticmethod
+    def _threshold_masks(entries, reverse=False):
+        # Sorted thresholds with cumulative masks: a bisect gives every rule whose limit a size satisfies
+        # Maximums are stored negated, so both lists ascend and "limit met" is always a prefix
+        entries = sorted((-threshold if reverse else threshold, bit) for threshold, bit in entries); masks = []; mask = 0
+        for _, bit in entries: mask |= bit; masks.append(mask)
+        return [threshold for threshold, _ in entries], masks
+
+    def __len__(self):
+        return len(self.rules)
+
+    def evaluate(self, facts):
+        """The first rule matching the message facts (see message_facts), or the default rule.
+
+        Returns None if the facts are partial (attachment types not known yet) and the
+        outcome depends on them: the message has to be fetched before it can be decided.
+        """
+        candidates = self.all
+        for condition in HASHED_CONDITIONS:
+            keys = facts.get(condition)
+            if keys is None: continue # Unknown: decided per rule below
+            satisfied = 0
+            for key in keys: satisfied |= self.index[condition].get(key, 0)
+            candidates &= ~(self.constrained[condition] & ~satisfied)
+        size = facts.get("size")
+        if size is not None:
+            for (thresholds, masks), key in ((self._min_sizes, size), (self._max_sizes, -size)):
+                if not thresholds: continue
+                met = bisect_right(thresholds, key)
+                candidates &= ~(masks[-1] & ~(masks[met - 1] if met else 0))
+        for field, combined in self.combined.items():
+            if combined is not None and not combined.search(facts.get(field) or ""): candidates &= ~self.regex_prefiltered[field]
+        # Inverted rules are walked even when their conditions failed, since that is when they match
+        walk = (candidates | self.inverted) & self.all
+        while walk:
+            low = walk & -walk; walk ^= low
+            rule = self.rules[low.bit_length() - 1]
+            if rule.needs_attachments and facts.get("attachment_type") is None: return None
+            holds = bool(candidates & low) and all(any(regex.search(facts.get(field) or "") for regex in regexes) for field, regexes in rule.regexes.items())
+            if holds != rule.invert: return rule
+        return self.default
+
+def message_facts(sender, subject, to="", cc="", list_id=None, size=None, attachment_types=None):
+    """What the rules are evaluated against. attachment_types=None means not known yet (header-only fetch)."""
+    from_address = parseaddr(sender or "")[1].lower()
+    # parse_email fills missing To/Cc with placeholders; only real addresses count
+    recipients = [address.lower() for _, address in getaddresses([to or "", cc or ""]) if "@" in address]
+    list_id = (list_id or "").strip()
+    bracketed = re.search(r"<([^>]+)>", list_id)
+    return {
+        "from": sender or "", "subject": subject or "", "recipients": ", ".join(filter(None, [to, cc])),
+        "from_address": [from_address] if from_address else [],
+        "from_domain": _domain_suffixes(from_address.rpartition("@")[2]),
+        "to_address": recipients,
+        "to_domain": [suffix for address in recipients for suffix in _domain_suffixes(address.rpartition("@")[2])],
+        "list_id": [(bracketed.group(1) if bracketed else list_id).lower()] if list_id else [],
+        "attachment_type": None if attachment_types is None else
+            [key for content_type in attachment_types for key in (content_type.lower(), content_type.lower().split("/")[0] + "/*")],
+        "size": size,
+    }
+
+def header_facts(header_bytes, size=None):
+    """message_facts from a raw header block, decoded the same way parse_email does."""
+    msg = email.message_from_bytes(header_bytes)
+    return message_facts(decode_email_header(msg.get("From", "[未知发件人]")), decode_email_header(msg.get("Subject", "[无主题]")),
+                         decode_email_header(msg.get("To", "")), decode_email_header(msg.get("Cc", "")), msg.get("List-Id"), size)
+
+def _legacy_rules():
+    # The FILTER_*_REGEX settings, kept with their old meaning: a whitelist overrides the sender blacklist
+    rules = []
+    if config.FILTER_SENDER_WHITELIST_REGEX:
+        rules.append({"name": "FILTER_SENDER_WHITELIST_REGEX", "match": {"from_regex": config.FILTER_SENDER_WHITELIST_REGEX.pattern}, "action": "drop", "invert": True, "description": "Sender not in whitelist."})
+    elif config.FILTER_SENDER_BLACKLIST_REGEX:
+        rules.append({"name": "FILTER_SENDER_BLACKLIST_REGEX", "match": {"from_regex": config.FILTER_SENDER_BLACKLIST_REGEX.pattern}, "action": "drop", "description": "Sender in blacklist."})
+    if config.FILTER_SUBJECT_BLACKLIST_REGEX:
+        rules.append({"name": "FILTER_SUBJECT_BLACKLIST_REGEX", "match": {"subject_regex": config.FILTER_SUBJECT_BLACKLIST_REGEX.pattern}, "action": "drop", "description": "Subject in blacklist."})
+    return rules
+
+def load_rules(filename=None):
+    """Compiles the FILTER_*_REGEX settings followed by the rules in FILTER_RULES_FILE. Raises ValueError for a bad rule.
+
+    The file is JSON: {"rules": [{"name": ..., "match": {...}, "action": ..., "chat_id": ...}, ...], "default": {"action": ...}}
+    """
+    filename = filename or config.FILTER_RULES_FILE
+    specs = _legacy_rules(); default = DEFAULT_RULE
+    if filename:
+        with open(filename, encoding='utf-8') as f: data = json.load(f)
+        specs += data.get("rules", [])
+        default_spec = data.get("default")
+        if isinstance(default_spec, str): default_spec = {"action": default_spec}
+        if default_spec:
+            default = RuleSet([{"name": "default", **default_spec}]).rules[0]
+    started = time.monotonic(); ruleset = RuleSet(specs, default)
+    if filename: logger.info(f"[{time.strftime('%H:%M:%S')}] Compiled {len(ruleset)} filter rules from {filename} in {(time.monotonic() - started) * 1000:.1f} ms.")
+    return ruleset
+
+_ruleset = None
+
+def active_rules():
+    """The process-wide RuleSet, compiled on first use."""
+    global _ruleset
+    if _ruleset is None: _ruleset = load_rules()
+    return _ruleset
+
+def filters_active():
+    ruleset = active_rules()
+    return bool(len(ruleset)) or ruleset.default.action != "forward" or ruleset.default.chat_id is not None
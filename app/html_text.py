@@ -0,0 +1,148 @@
+from html.parser import HTMLParser
+import re
+
+# Content of these elements is never shown
+SKIPPED_TAGS = {"script", "style", "head", "title", "template", "noscript", "svg", "object", "iframe"}
+BLOCK_TAGS = {"p", "div", "section", "article", "header", "footer", "main", "aside", "nav", "table", "thead", "tbody",
+              "tfoot", "tr", "ul", "ol", "dl", "dt", "dd", "blockquote", "pre", "form", "fieldset", "address", "center", "figure"}
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+# Zero sizes only: the value must end after the zero (and unit), so "font-size:0.9em" stays visible
+HIDDEN_STYLE_PATTERN = re.compile(r"display\s*:\s*none|visibility\s*:\s*hidden|(?:max-height|font-size)\s*:\s*0+(?:\.0+)?(?:px|pt|em|rem|%)?\s*(?:;|!|$)", re.IGNORECASE)
+# Elements whose end tag may be omitted: the start tags that implicitly close them, and the elements that would
+# scope a nested copy (a <td> inside an inner <table> does not close the outer one)
+_P_CLOSERS = BLOCK_TAGS - {"tr", "thead", "tbody", "tfoot", "dt", "dd"} | {"h1", "h2", "h3", "h4", "h5", "h6", "hr", "main", "menu"}
+IMPLICIT_END_TAGS = {
+    "head": ({"body"}, ()), "p": (_P_CLOSERS, ()),
+    "li": ({"li"}, ("ul", "ol")),
+    "dt": ({"dt", "dd"}, ("dl",)), "dd": ({"dt", "dd"}, ("dl",)),
+    "td": ({"td", "th", "tr", "thead", "tbody", "tfoot"}, ("table",)), "th": ({"td", "th", "tr", "thead", "tbody", "tfoot"}, ("table",)),
+    "tr": ({"tr", "thead", "tbody", "tfoot"}, ("table",)),
+    "thead": ({"tbody", "tfoot"}, ("table",)), "tbody": ({"tbody", "tfoot"}, ("table",)), "tfoot": ({"tbody"}, ("table",)),
+    "option": ({"option", "optgroup"}, ("select",)),
+}
+WHITESPACE_PATTERN = re.compile(r"\s+")
+FEED_CHUNK_CHARS = 64 * 1024
+
+class _OutputLimitReached(Exception):
+    pass
+
+class _MarkdownWriter(HTMLParser):
+    """Incremental HTML tokenizer writing Markdown as tags stream past; no tree is ever built."""
+
+    def __init__(self, max_chars):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.out = []; self.length = 0; self.newlines = 0 # Newlines at the end of the output so far
+        self.skip_tag = None; self.skip_open = [] # Element whose content is being dropped, and the elements open inside it
+        self.pre_depth = 0; self.lists = [] # Open ul/ol, with the next number for ol
+        self.links = [] # Open <a>: (href, index of its reserved "[" slot in the output)
+        self.cell_open = False; self.pending_space = False
+
+    def _write(self, text):
+        if not text: return
+        self.out.append(text); self.length += len(text)
+        body = text.rstrip("\n")
+        self.newlines = self.newlines + len(text) if not body else len(text) - len(body)
+        if self.length > self.max_chars: raise _OutputLimitReached()
+
+    def _newlines(self, count):
+        # Collapses consecutive block breaks into at most `count` newlines, and never starts the output with one
+        if self.out and self.newlines < count: self._write("\n" * (count - self.newlines))
+        self.pending_space = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip_tag:
+            closers, scopes = IMPLICIT_END_TAGS.get(self.skip_tag, ((), ()))
+            if tag not in closers or any(scope in self.skip_open for scope in scopes):
+                if tag not in VOID_TAGS: self.skip_open.append(tag)
+                return
+            self.skip_tag = None; self.skip_open = [] # A sibling (e.g. the next <td>) implicitly ended the hidden element
+        attrs = dict(attrs)
+        if tag in SKIPPED_TAGS or "hidden" in attrs or HIDDEN_STYLE_PATTERN.search(attrs.get("style") or ""):
+            if tag not in VOID_TAGS: self.skip_tag = tag; self.skip_open = []
+            return
+        if tag == "br": self._write("\n"); self.pending_space = False
+        elif tag == "hr": self._newlines(2); self._write("---"); self._newlines(2)
+        elif tag in ("h1", "h2", "h3", "h4", "h5", "h6"): self._newlines(2); self._write("#" * int(tag[1]) + " ")
+        elif tag in ("b", "strong"): self._space(); self._write("**")
+        elif tag in ("i", "em"): self._space(); self._write("*")
+        elif tag == "a":
+            # Reserve a slot for the opening bracket; it is only filled in if the link is kept
+            self._space(); self.links.append((attrs.get("href") or "", len(self.out))); self.out.append("")
+        elif tag == "li":
+            self._newlines(1)
+            indent = "  " * max(len(self.lists) - 1, 0)
+            if self.lists and self.lists[-1] is not None:
+                self._write(f"{indent}{self.lists[-1]}. "); self.lists[-1] += 1
+            else: self._write(f"{indent}* ")
+        elif tag in ("ul", "ol"): self._newlines(1 if self.lists else 2); self.lists.append(1 if tag == "ol" else None)
+        elif tag in ("td", "th"):
+            if self.cell_open: self._write(" | ")
+            self.cell_open = True; self.pending_space = False
+        elif tag == "tr": self._newlines(1); self.cell_open = False
+        elif tag == "blockquote": self._newlines(2); self._write("> ")
+        elif tag == "pre": self._newlines(2); self.pre_depth += 1
+        elif tag in BLOCK_TAGS: self._newlines(2)
+
+    def handle_endtag(self, tag):
+        if self.skip_tag:
+            if tag in self.skip_open:
+                # Also closes whatever was left unclosed inside it
+                del self.skip_open[len(self.skip_open) - 1 - self.skip_open[::-1].index(tag):]; return
+            ended_parent = tag != self.skip_tag
+            self.skip_tag = None; self.skip_open = []
+            # An end tag opened outside the hidden element (e.g. </tr> after an unclosed <td>) ends it and then applies
+            if not ended_parent: return
+        if tag in ("b", "strong"): self._write("**")
+        elif tag in ("i", "em"): self._write("*")
+        elif tag == "a" and self.links:
+            href, start = self.links.pop()
+            text = "".join(self.out[start + 1:]).strip()
+            if href and not href.startswith(("#", "javascript:", "mailto:")) and text and text != href:
+                self.out[start] = "["; self.length += 1; self._write(f"]({href})")
+        elif tag in ("ul", "ol"):
+            if self.lists: self.lists.pop()
+            self._newlines(2 if not self.lists else 1)
+        elif tag == "pre": self.pre_depth = max(self.pre_depth - 1, 0); self._newlines(2)
+        elif tag in ("h1", "h2", "h3", "h4", "h5", "h6"): self._newlines(2)
+        elif tag == "tr": self._newlines(1); self.cell_open = False
+        elif tag == "table": self._newlines(2); self.cell_open = False
+        elif tag in BLOCK_TAGS: self._newlines(2)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS: self.handle_endtag(tag)
+
+    def _space(self):
+        if self.pending_space: self._write(" "); self.pending_space = False
+
+    def handle_data(self, data):
+        if self.skip_tag or not data: return
+        if self.pre_depth: self._write(data); return
+        leading = data[:1].isspace(); trailing = data[-1:].isspace()
+        text = WHITESPACE_PATTERN.sub(" ", data).strip()
+        if not text:
+            if self.out and not self.out[-1].endswith(("\n", " ")): self.pending_space = True
+            return
+        if leading and self.out and not self.out[-1].endswith(("\n", " ", "[")): self.pending_space = True
+        self._space(); self._write(text)
+        self.pending_space = trailing
+
+def html_to_markdown(html, max_chars):
+    """Converts HTML to Markdown-like text in one streaming pass.
+
+    Input is tokenized in chunks and conversion stops as soon as the output passes
+    max_chars, so the work done is bounded by what will be sent, not by the input size.
+    Returns (text, truncated).
+    """
+    writer = _MarkdownWriter(max_chars); truncated = False
+    try:
+        for start in range(0, len(html), FEED_CHUNK_CHARS): writer.feed(html[start:start + FEED_CHUNK_CHARS])
+        writer.close()
+    except _OutputLimitReached: truncated = True
+    text = "".join(writer.out)
+    if truncated:
+        text = text[:max_chars]; cut = text.rfind("\n")
+        if cut > max_chars // 2: text = text[:cut] # End on a line boundary when one is reasonably close
+    text = re.sub(r"[ \t]+\n", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip(), truncated
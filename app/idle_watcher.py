@@ -0,0 +1,66 @@
+from imapclient.exceptions import IMAPClientError, LoginError
+import logging
+import time
+import socket
+import asyncio
+
+logger = logging.getLogger(__name__)
+
+class IdleWatcher:
+    """Second IMAP connection that stays in IDLE on the mailbox and only reports new mail.
+
+    The mailbox is opened read-only (EXAMINE) and nothing but IDLE runs on this connection,
+    so it is never torn down to fetch or flag. Every EXISTS response sets `new_mail`; the
+    connection doing the actual work waits on that event instead of cycling its own IDLE.
+    After a login failure the watcher stops until `retry_at`; meanwhile the worker idles on its own connection.
+    """
+
+    def __init__(self, session, user, password, mailbox, idle_timeout,
+                 initial_reconnect_delay, max_reconnect_delay, backoff_factor):
+        self.user = user; self.password = password; self.mailbox = mailbox
+        self.idle_timeout = idle_timeout
+        self.initial_reconnect_delay = initial_reconnect_delay; self.max_reconnect_delay = max_reconnect_delay
+        self.backoff_factor = backoff_factor
+        self.session = session # An AsyncIMAPSession of its own, never shared with the fetching connection
+        self.new_mail = asyncio.Event()
+        self._task = None; self.retry_at = 0 # time.monotonic() before which a failed login is not retried
+
+    def start(self):
+        if (self._task is None or self._task.done()) and time.monotonic() >= self.retry_at: self._task = asyncio.create_task(self._run())
+
+    @property
+    def active(self):
+        return self._task is not None and not self._task.done()
+
+    async def _connect(self):
+        await self.session.connect(self.user, self.password)
+        await self.session.select_folder(self.mailbox, readonly=True)
+        logger.info(f"[{time.strftime('%H:%M:%S')}] IDLE connection opened on {self.mailbox} (read-only).")
+
+    async def _run(self):
+        delay = self.initial_reconnect_delay
+        while True:
+            try:
+                if not self.session.connected:
+                    await self._connect(); delay = self.initial_reconnect_delay
+                    self.new_mail.set() # Anything may have arrived while this connection was down
+                responses = await self.session.idle_wait(self.idle_timeout)
+                # Only new messages matter here; flag changes and expunges are the worker's own doing
+                new = [response for response in responses or [] if len(response) > 1 and response[1] == b'EXISTS']
+                if new:
+                    logger.info(f"[{time.strftime('%H:%M:%S')}] IDLE reported new mail ({new[-1][0]} messages in {self.mailbox}).")
+                    self.new_mail.set()
+            except LoginError as e:
+                logger.critical(f"[{time.strftime('%H:%M:%S')}] IDLE connection login failed: {e}. Idling on the fetch connection; retrying in {self.max_reconnect_delay}s.")
+                self.session.abort(); self.retry_at = time.monotonic() + self.max_reconnect_delay
+                self.new_mail.set(); return # Wakes the worker, which then sees the watcher is gone
+            except (IMAPClientError, ConnectionError, BrokenPipeError, socket.error, OSError, TimeoutError) as e:
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] IDLE connection error ({type(e).__name__}): {e}. Reconnecting in {delay}s.")
+                self.session.abort()
+                await asyncio.sleep(delay); delay = min(self.max_reconnect_delay, delay * self.backoff_factor)
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel() # idle_wait aborts the socket when cancelled
+            await asyncio.gather(self._task, return_exceptions=True)
+        self.session.shutdown()
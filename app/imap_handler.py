@@ -1,13 +1,20 @@
-from imapclient import IMAPClient
-from imapclient.exceptions import IMAPClientError, LoginError
-import ssl
+from imapclient.exceptions import IMAPClientAbortError, IMAPClientError, LoginError
 import logging
 import time
 import socket
 import asyncio
 from . import config
-from .email_parser import parse_email # Ensure this is the updated version
-from .telegram_sender import forward_email_to_telegram # Ensure this is the updated version
+from .imap_session import ConnectionManager, format_uid_set
+from .accounts import route_from_env
+from .idle_watcher import IdleWatcher
+from .parse_pool import ParsePool
+from .telegram_sender import forward_email_to_telegram, prerender_email_body_async
+from .pipeline import MessagePipeline
+from .outbox import Outbox
+from .partial_fetch import plan_fetch, build_skeleton, download_part
+from .spool import Spool, close_attachments
+from .filters import FILTER_HEADER_FIELDS, active_rules, filters_active, header_facts, message_facts
+from .mailbox_state import MailboxState
 
 logger = logging.getLogger(__name__)
 
@@ -18,56 +25,116 @@ MAX_RECONNECT_DELAY_SECONDS = 300 # 5 minutes
 RECONNECT_BACKOFF_FACTOR = 2
 MAX_CONNECTION_ATTEMPTS_BEFORE_LONG_PAUSE = 5 # After 5 failed attempts, take a long pause
 LONG_PAUSE_SECONDS = 10 * 60 # 10 minutes
+CLOSE_TIMEOUT_SECONDS = 5
 
 class IMAPHandler:
-    def __init__(self):
-        self.host = config.IMAP_HOST; self.port = config.IMAP_PORT; self.user = config.IMAP_USER
-        self.password = config.IMAP_PASSWORD; self.mailbox = config.IMAP_MAILBOX
-        self.processed_folder = config.PROCESSED_FOLDER_NAME; self.client = None
-        self.is_mailbox_selected = False; self.ssl_context = ssl.create_default_context()
-        self.connection_attempts = 0 # Initialize connection_attempts
-        self.current_reconnect_delay = INITIAL_RECONNECT_DELAY_SECONDS # Initialize current_reconnect_delay
-
-    def _close_existing_client(self):
-        if self.client:
-            try: logger.info(f"[{time.strftime('%H:%M:%S')}] Closing existing IMAP client session."); self.client.logout()
-            except Exception as e: logger.debug(f"[{time.strftime('%H:%M:%S')}] Exception while logging out (ignored): {e}")
-        self.client = None; self.is_mailbox_selected = False
-
-    def _select_mailbox_if_needed(self):
+    def __init__(self, route=None, connections=None, parse_pool=None, outbox=None, mailbox_state=None, memory_budget=None):
+        """route: the MailboxRoute to monitor (default: the one from the environment).
+
+        connections, parse_pool, outbox, mailbox_state and memory_budget are shared by all
+        handlers of a multi-account process; whatever is not passed is created (and closed) here.
+        """
+        route = route or route_from_env(); self.route = route
+        self.host = route.host; self.port = route.port; self.user = route.user
+        self.password = route.password; self.mailbox = route.mailbox; self.chat_id = route.chat_id
+        self.processed_folder = route.processed_folder
+        self._owned = [] # Resources created here rather than shared; closed with the handler
+        if connections is None: connections = ConnectionManager(); self._owned.append(connections)
+        self.is_mailbox_selected = False
+        self.session = connections.session(self.host, self.port, CONNECTION_TIMEOUT_SECONDS, name=f"imap-{route.key}")
+        self.backoff = connections.backoff(route.account, INITIAL_RECONNECT_DELAY_SECONDS) # Shared by the account's mailboxes
+        if parse_pool is None: parse_pool = ParsePool(); self._owned.append(parse_pool)
+        self.parse_pool = parse_pool
+        # Two-connection mode: a parked IDLE connection reports new mail, self.session only fetches and flags
+        self.idle_watcher = IdleWatcher(connections.session(self.host, self.port, CONNECTION_TIMEOUT_SECONDS, name=f"imap-idle-{route.key}"),
+                                        self.user, self.password, self.mailbox, IDLE_CHECK_TIMEOUT_SECONDS, INITIAL_RECONNECT_DELAY_SECONDS,
+                                        MAX_RECONNECT_DELAY_SECONDS, RECONNECT_BACKOFF_FACTOR) if config.IMAP_DUAL_CONNECTION else None
+        self.pipeline = MessagePipeline(self._parse_stage, self._render_stage, self._send_stage, self._commit_stage, finish=self._finish_item,
+                                        memory_budget=memory_budget)
+        if outbox is None: outbox = Outbox(); self._owned.append(outbox)
+        self.outbox = outbox; self.outbox_key = route.key
+        self._pending_processed = []; self._pending_seen = [] # UIDs waiting for the next batched flag/move
+        self._pending_since = None # When the oldest of them was queued (time.monotonic())
+        if mailbox_state is None: mailbox_state = MailboxState(); self._owned.append(mailbox_state)
+        self.mailbox_state = mailbox_state; self.select_info = {}
+        self.sync_extensions = set() # {'CONDSTORE'} when the server supports it and IMAP_CONDSTORE_ENABLED
+        self._fresh_select = False # The next scan is the first after a SELECT, so its HIGHESTMODSEQ is current
+        self._known_folders = set() # Folders confirmed to exist; not checked again on reconnect, only after a failed MOVE
+        self._committed_uids = set() # UIDs of the current scan whose flag/move went through; the UID mark never passes the others
+        self.lease = None # Set by leases.ShardManager in sharded mode; nothing is sent once it is no longer valid
+
+    # Connection attempts and reconnect delay live in the account's shared ReconnectBackoff
+    @property
+    def connection_attempts(self): return self.backoff.attempts
+    @connection_attempts.setter
+    def connection_attempts(self, value): self.backoff.attempts = value
+    @property
+    def current_reconnect_delay(self): return self.backoff.delay
+    @current_reconnect_delay.setter
+    def current_reconnect_delay(self, value): self.backoff.delay = value
+
+    @property
+    def client(self):
+        return self.session.client
+
+    async def _close_existing_client(self):
+        if self.session.connected:
+            logger.info(f"[{time.strftime('%H:%M:%S')}] Closing existing IMAP client session.")
+            await self.session.logout()
+        self.is_mailbox_selected = False
+
+    async def _folder_exists(self, folder):
+        if folder in self._known_folders: return True
+        if await self.session.folder_exists(folder): self._known_folders.add(folder); return True
+        return False
+
+    async def _select_mailbox_if_needed(self):
         if not self.client: logger.warning(f"[{time.strftime('%H:%M:%S')}] Cannot select mailbox, client is None."); return False
         try:
-            select_info = self.client.select_folder(self.mailbox, readonly=False)
+            stored_uidvalidity = (await self.mailbox_state.call(self.mailbox_state.load, self.outbox_key))[0]
+            select_info = await self.session.select_folder(self.mailbox, readonly=False)
+            journalled = await self.outbox.call(self.outbox.uids, self.outbox_key)
+            if journalled and select_info and select_info.get(b'UIDVALIDITY') == stored_uidvalidity:
+                # Journal entries of mail expunged while disconnected would never be committed
+                existing = set(await self.session.search(['UID', format_uid_set(journalled)]))
+                gone = [uid for uid in journalled if uid not in existing]
+                if gone:
+                    logger.info(f"[{time.strftime('%H:%M:%S')}] {len(gone)} journalled UIDs were expunged meanwhile. Dropping them from the outbox.")
+                    await self.outbox.call(self.outbox.forget, self.outbox_key, gone)
             if select_info:
                 logger.info(f"[{time.strftime('%H:%M:%S')}] Successfully selected/re-selected mailbox: {self.mailbox}. Info: {select_info}")
+                self.select_info = select_info; self._fresh_select = True
                 self.is_mailbox_selected = True; return True
             else: logger.error(f"[{time.strftime('%H:%M:%S')}] select_folder for '{self.mailbox}' returned None/empty."); self.is_mailbox_selected = False; return False
         except (IMAPClientError, socket.error, BrokenPipeError) as e:
             logger.error(f"[{time.strftime('%H:%M:%S')}] Error during select_folder for '{self.mailbox}': {e}")
-            self.is_mailbox_selected = False; self._close_existing_client(); return False
+            self.is_mailbox_selected = False; await self._close_existing_client(); return False
 
-    def connect(self): # This method now performs a single connection attempt.
-        self._close_existing_client() # Ensure any old client is gone
+    async def connect(self): # This method now performs a single connection attempt.
+        await self._close_existing_client() # Ensure any old client is gone
         self.connection_attempts += 1
 
         try:
             logger.info(f"[{time.strftime('%H:%M:%S')}] Attempting to connect (attempt {self.connection_attempts}) to IMAP server {self.host}:{self.port}")
-            self.client = IMAPClient(self.host, port=self.port, ssl=True, ssl_context=self.ssl_context, timeout=CONNECTION_TIMEOUT_SECONDS)
-            self.client.login(self.user, self.password)
+            await self.session.connect(self.user, self.password)
             logger.info(f"[{time.strftime('%H:%M:%S')}] Successfully connected and logged in as {self.user}")
+            if config.IMAP_CONDSTORE_ENABLED:
+                try: self.sync_extensions = await self.session.enable_sync_extensions()
+                except IMAPClientError as e: logger.warning(f"[{time.strftime('%H:%M:%S')}] ENABLE failed ({e}). Using plain UID sync."); self.sync_extensions = set()
+                if self.sync_extensions: logger.info(f"[{time.strftime('%H:%M:%S')}] Enabled {', '.join(sorted(self.sync_extensions))} for incremental sync.")
             
-            if not self.client.folder_exists(self.mailbox):
-                logger.critical(f"Mailbox '{self.mailbox}' does not exist. Exiting."); self._close_existing_client(); raise ValueError(f"Mailbox '{self.mailbox}' not found.")
+            if not await self._folder_exists(self.mailbox):
+                logger.critical(f"Mailbox '{self.mailbox}' does not exist. Exiting."); await self._close_existing_client(); raise ValueError(f"Mailbox '{self.mailbox}' not found.")
             
-            if not self._select_mailbox_if_needed(): # This already handles its own errors and might close client
+            if not await self._select_mailbox_if_needed(): # This already handles its own errors and might close client
                 logger.error(f"[{time.strftime('%H:%M:%S')}] Mailbox selection failed after connect.")
                 # _select_mailbox_if_needed might have closed the client, ensure it's None if failed
-                if self.client: self._close_existing_client()
+                if self.client: await self._close_existing_client()
                 return False # Indicate connection process failed at selection stage
 
-            if self.processed_folder and not self.client.folder_exists(self.processed_folder):
+            if self.processed_folder and not await self._folder_exists(self.processed_folder):
                 try:
-                    self.client.create_folder(self.processed_folder)
+                    await self.session.create_folder(self.processed_folder)
                     logger.info(f"[{time.strftime('%H:%M:%S')}] Created folder: {self.processed_folder}")
                 except IMAPClientError as e:
                     logger.error(f"Failed to create folder {self.processed_folder}: {e}. Will mark as read instead.")
@@ -81,12 +148,12 @@ class IMAPHandler:
 
         except LoginError as e:
             logger.critical(f"IMAP Login failed: {e}. Check credentials. This is a fatal error for the current session.")
-            self._close_existing_client()
+            await self._close_existing_client()
             raise # Re-raise to be caught by main loop for exit
         
         except (IMAPClientError, socket.timeout, TimeoutError, ConnectionRefusedError, OSError, BrokenPipeError) as e:
             logger.error(f"[{time.strftime('%H:%M:%S')}] IMAP connection error (attempt {self.connection_attempts}, type {type(e).__name__}): {e}.")
-            self._close_existing_client() # Ensure client is closed on error
+            await self._close_existing_client() # Ensure client is closed on error
             self.current_reconnect_delay = min(MAX_RECONNECT_DELAY_SECONDS, self.current_reconnect_delay * RECONNECT_BACKOFF_FACTOR)
             logger.info(f"Next reconnect attempt will be in {self.current_reconnect_delay}s.")
             # Optional: Check for MAX_CONNECTION_ATTEMPTS_BEFORE_LONG_PAUSE
@@ -103,81 +170,279 @@ class IMAPHandler:
 
         except Exception as e: # Catch any other unexpected errors
             logger.error(f"[{time.strftime('%H:%M:%S')}] Unexpected error during IMAP connection (attempt {self.connection_attempts}, type {type(e).__name__}): {e}", exc_info=True)
-            self._close_existing_client()
+            await self._close_existing_client()
             self.current_reconnect_delay = min(MAX_RECONNECT_DELAY_SECONDS, self.current_reconnect_delay * RECONNECT_BACKOFF_FACTOR)
             logger.info(f"Next reconnect attempt will be in {self.current_reconnect_delay}s due to unexpected error.")
             return False
 
-    async def process_message(self, msg_uid, raw_email_bytes):
+    async def _parse_stage(self, item):
+        msg_uid = item.uid
+        logger.info(f"[{time.strftime('%H:%M:%S')}] Processing email UID {msg_uid}")
+        parsed_email = await self.parse_pool.parse(item.raw, uid=msg_uid)
+
+        # Apply filtering rules (header-only rules already ran when IMAP_HEADER_PREFETCH is on; cheap to repeat)
+        sender = parsed_email.get('from', '')
+        subject = parsed_email.get('subject', '')
+        attachment_types = [attachment['content_type'] for attachment in parsed_email['attachments']] + [part.content_type for part in item.parts or []]
+        size = len(item.raw) + sum(part.size for part in item.parts or [])
+        rule = active_rules().evaluate(message_facts(sender, subject, parsed_email.get('to'), parsed_email.get('cc'),
+                                                     parsed_email.get('list_id'), size, attachment_types))
+        if rule.action == "drop":
+            logger.info(f"[{time.strftime('%H:%M:%S')}] Email UID {msg_uid} from '{sender}' (Subject: '{subject}') skipped: {rule.reason}")
+            # Mark as seen even if skipped by filter, to avoid re-processing
+            close_attachments(parsed_email.get('attachments')); item.skipped = True; return
+        if rule.action in ("headers_only", "no_attachments"):
+            logger.info(f"[{time.strftime('%H:%M:%S')}] Email UID {msg_uid}: forwarding without {'body and ' if rule.action == 'headers_only' else ''}attachments: {rule.reason}")
+            close_attachments(parsed_email['attachments']); parsed_email['attachments'] = []; item.parts = None
+            if rule.action == "headers_only": parsed_email['body_html'] = None; parsed_email['forward_body'] = False
+
+        if item.parts is not None: parsed_email['attachments'] = await self._download_parts(item)
+        item.chat_id = parsed_email['chat_id'] = rule.chat_id or self.chat_id
+        item.parsed = parsed_email
+        # From here on the item holds its parsed text and in-memory spools, not the raw message
+        item.memory = len(parsed_email.get('body_html') or '') + len(parsed_email.get('body') or '') + \
+            sum(attachment['data'].memory_size for attachment in parsed_email['attachments'] if isinstance(attachment.get('data'), Spool))
+
+    async def _download_parts(self, item):
+        """Streams the attachments of a partially fetched message to temporary files.
+
+        Parts over Telegram's upload limit and parts an earlier attempt already delivered
+        are described but never downloaded.
+        """
+        attachments = []; sent_steps = await self.outbox.call(self.outbox.done_steps, self.outbox_key, item.uid)
         try:
-            logger.info(f"[{time.strftime('%H:%M:%S')}] Processing email UID {msg_uid}")
-            parsed_email = parse_email(raw_email_bytes, uid=msg_uid)
-
-            # Apply filtering rules
-            sender = parsed_email.get('from', '')
-            subject = parsed_email.get('subject', '')
-
-            # Whitelist check (overrides blacklist if present and matched)
-            if config.FILTER_SENDER_WHITELIST_REGEX:
-                if not config.FILTER_SENDER_WHITELIST_REGEX.search(sender):
-                    logger.info(f"[{time.strftime('%H:%M:%S')}] Email UID {msg_uid} from '{sender}' (Subject: '{subject}') skipped: Sender not in whitelist.")
-                    # Mark as seen even if skipped by filter, to avoid re-processing
-                    if self.client and self.is_mailbox_selected: self.client.add_flags([msg_uid], [b'\\Seen'])
-                    return
-            # Blacklist check (only if whitelist is not active or did not cause a skip)
-            elif config.FILTER_SENDER_BLACKLIST_REGEX:
-                if config.FILTER_SENDER_BLACKLIST_REGEX.search(sender):
-                    logger.info(f"[{time.strftime('%H:%M:%S')}] Email UID {msg_uid} from '{sender}' (Subject: '{subject}') skipped: Sender in blacklist.")
-                    if self.client and self.is_mailbox_selected: self.client.add_flags([msg_uid], [b'\\Seen'])
-                    return
-            
-            if config.FILTER_SUBJECT_BLACKLIST_REGEX:
-                if config.FILTER_SUBJECT_BLACKLIST_REGEX.search(subject):
-                    logger.info(f"[{time.strftime('%H:%M:%S')}] Email UID {msg_uid} (Subject: '{subject}') skipped: Subject in blacklist.")
-                    if self.client and self.is_mailbox_selected: self.client.add_flags([msg_uid], [b'\\Seen'])
-                    return
-
-            await forward_email_to_telegram(parsed_email)
-            if not self.client:
-                 logger.warning(f"[{time.strftime('%H:%M:%S')}] IMAP client None before marking UID {msg_uid}. Reconnecting.")
-                 if not self.connect(): logger.error(f"[{time.strftime('%H:%M:%S')}] Reconnect failed. UID {msg_uid} not marked."); return
-            if not self.is_mailbox_selected:
-                if not self._select_mailbox_if_needed(): logger.error(f"[{time.strftime('%H:%M:%S')}] Failed to select mailbox for UID {msg_uid}. Cannot mark."); return
-            if not self.client: logger.error(f"[{time.strftime('%H:%M:%S')}] IMAP client None after select for UID {msg_uid}. Cannot mark."); return
-            if self.processed_folder and self.client.folder_exists(self.processed_folder):
-                logger.info(f"[{time.strftime('%H:%M:%S')}] Moving email UID {msg_uid} to '{self.processed_folder}'")
-                self.client.move([msg_uid], self.processed_folder)
-            else:
-                if self.processed_folder: logger.warning(f"[{time.strftime('%H:%M:%S')}] Folder '{self.processed_folder}' not found. Marking UID {msg_uid} as read.")
-                logger.info(f"[{time.strftime('%H:%M:%S')}] Marking email UID {msg_uid} as \\Seen")
-                self.client.add_flags([msg_uid], [b'\\Seen'])
-            logger.info(f"[{time.strftime('%H:%M:%S')}] Successfully processed and marked/moved email UID {msg_uid}")
-        except Exception as e: logger.error(f"[{time.strftime('%H:%M:%S')}] Critical error processing/marking UID {msg_uid} ({type(e).__name__}): {e}", exc_info=True)
+            for part in item.parts:
+                # Keyed by the part's section number: whether an earlier part turns out empty is only known after download
+                entry = {"filename": part.filename or f"attachment_{len(attachments) + 1}", "data": None,
+                         "content_type": part.content_type, "size": part.estimated_decoded_size, "step": f"attachment:{part.section}"}
+                if not config.FORWARD_ATTACHMENTS or entry['step'] in sent_steps: pass
+                elif part.estimated_decoded_size > config.TELEGRAM_MAX_UPLOAD_BYTES:
+                    logger.info(f"[{time.strftime('%H:%M:%S')}] UID {item.uid}: attachment '{entry['filename']}' (~{part.estimated_decoded_size} bytes) exceeds the upload limit. Not downloading it.")
+                    entry['oversized'] = True
+                else:
+                    entry['data'] = await download_part(self.session, item.uid, part); entry['size'] = len(entry['data'])
+                    if not entry['size']: entry['data'].close(); continue # get_attachments drops empty parts too
+                attachments.append(entry)
+        except BaseException:
+            close_attachments(attachments); raise
+        return attachments
+
+    def _finish_item(self, item):
+        # Attachment spools (and their temporary files) live until the item leaves the pipeline
+        close_attachments((item.parsed or {}).get('attachments'))
+
+    async def _fetch_chunk(self, chunk_uids):
+        """Fetches one batch of UIDs and returns [(uid, raw, parts)] in UID order.
+
+        With IMAP_PARTIAL_FETCH, large multipart messages are planned from their BODYSTRUCTURE:
+        only the header and text parts are downloaded here, attachments are left as parts
+        for the parse stage to stream. Everything else is fetched whole.
+        """
+        plans = {}
+        if config.IMAP_PARTIAL_FETCH:
+            structures = await self.session.fetch(chunk_uids, ['BODYSTRUCTURE', 'BODY.PEEK[HEADER]', 'RFC822.SIZE'])
+            for msg_uid, data in structures.items():
+                if (data.get(b'RFC822.SIZE') or 0) < config.IMAP_PARTIAL_FETCH_MIN_BYTES or b'BODYSTRUCTURE' not in data: continue
+                plan = plan_fetch(data[b'BODYSTRUCTURE'])
+                if plan and plan[1]: plans[msg_uid] = (data.get(b'BODY[HEADER]') or b'', *plan)
+        whole_uids = [uid for uid in chunk_uids if uid not in plans]
+        # BODY.PEEK[] leaves \\Seen alone, so a crash before commit keeps the message unseen
+        fetched_data = await self.session.fetch(whole_uids, ['BODY.PEEK[]']) if whole_uids else {}
+        messages = []
+        for msg_uid in sorted(set(fetched_data) | set(plans)):
+            if msg_uid not in plans:
+                messages.append((msg_uid, fetched_data[msg_uid].get(b'BODY[]'), None)); continue
+            header_bytes, text_parts, attachment_parts = plans[msg_uid]
+            payloads = {}
+            if text_parts:
+                text_data = (await self.session.fetch([msg_uid], [f"BODY.PEEK[{part.section}]" for part in text_parts])).get(msg_uid, {})
+                payloads = {part.section: text_data.get(f"BODY[{part.section}]".encode(), b'') for part in text_parts}
+            logger.info(f"[{time.strftime('%H:%M:%S')}] UID {msg_uid}: partial fetch of {len(text_parts)} text parts; {len(attachment_parts)} attachments will be streamed.")
+            messages.append((msg_uid, build_skeleton(header_bytes, text_parts, payloads), attachment_parts))
+        return messages
+
+    async def _render_stage(self, item):
+        await prerender_email_body_async(item.parsed)
+
+    async def _send_stage(self, item):
+        # Another worker may own this mailbox by now; it resumes the UID from the shared journal
+        # (checked here and again before every step, since sending a long email can outlast the lease)
+        if self.lease: self.lease.check()
+        # Every part is journalled as it goes out; a retry of this UID only sends what is still missing
+        delivery = await self.outbox.call(self.outbox.begin, self.outbox_key, item.uid, lease=self.lease)
+        if not await forward_email_to_telegram(item.parsed, delivery=delivery):
+            if delivery.attempts < self.outbox.max_attempts:
+                raise RuntimeError(f"Delivery of UID {item.uid} incomplete (attempt {delivery.attempts}/{self.outbox.max_attempts}). Leaving it unseen to resume later.")
+            logger.error(f"[{time.strftime('%H:%M:%S')}] UID {item.uid} still incomplete after {delivery.attempts} attempts. Giving up on the missing parts and marking it processed.")
+        if self.lease: self.lease.check()
+        await self.outbox.call(self.outbox.mark_delivered, self.outbox_key, item.uid)
+
+    async def _commit_stage(self, item):
+        # Delivery is already durable in the outbox; flags/moves are sent in batches
+        self._queue_commit(item.uid, seen_only=item.skipped)
+        if len(self._pending_processed) + len(self._pending_seen) >= config.IMAP_FLAG_BATCH_SIZE or \
+           time.monotonic() - self._pending_since >= config.IMAP_FLAG_FLUSH_SECONDS:
+            await self._flush_commits()
+
+    def _queue_commit(self, uid, seen_only=False):
+        # seen_only: filtered mail, which is only marked \Seen and never moved
+        if self._pending_since is None: self._pending_since = time.monotonic()
+        (self._pending_seen if seen_only else self._pending_processed).append(uid)
+
+    async def _flush_commits(self):
+        """Flags/moves every UID queued so far with one IMAP command per kind, each UID set sent as ranges."""
+        processed_uids = sorted(set(self._pending_processed)); seen_uids = sorted(set(self._pending_seen))
+        self._pending_processed = []; self._pending_seen = []; self._pending_since = None
+        if not processed_uids and not seen_uids: return
+        if not self.client:
+             logger.warning(f"[{time.strftime('%H:%M:%S')}] IMAP client None before marking {len(processed_uids) + len(seen_uids)} UIDs. Reconnecting.")
+             if not await self.connect(): logger.error(f"[{time.strftime('%H:%M:%S')}] Reconnect failed. UIDs not marked; the outbox keeps them for the next check."); return
+        if not self.is_mailbox_selected:
+            if not await self._select_mailbox_if_needed(): logger.error(f"[{time.strftime('%H:%M:%S')}] Failed to select mailbox. UIDs not marked; the outbox keeps them for the next check."); return
+        if seen_uids:
+            # Filtered mail is not journalled: until this succeeds the UID mark stays below it, so it is filtered again
+            await self.session.add_flags(seen_uids, [b'\\Seen']); self._committed_uids.update(seen_uids)
+        if not processed_uids: return
+        moved = False
+        if self.processed_folder and await self._folder_exists(self.processed_folder):
+            logger.info(f"[{time.strftime('%H:%M:%S')}] Moving {len(processed_uids)} emails to '{self.processed_folder}': UIDs {format_uid_set(processed_uids)}")
+            try: await self.session.move(processed_uids, self.processed_folder); moved = True
+            except IMAPClientAbortError: raise
+            except IMAPClientError as e:
+                # Deleted or renamed since it was cached: look it up again next time, and mark these as read now
+                self._known_folders.discard(self.processed_folder)
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] Moving to '{self.processed_folder}' failed: {e}. Marking UIDs as read instead.")
+        elif self.processed_folder: logger.warning(f"[{time.strftime('%H:%M:%S')}] Folder '{self.processed_folder}' not found. Marking UIDs as read instead.")
+        if not moved:
+            logger.info(f"[{time.strftime('%H:%M:%S')}] Marking {len(processed_uids)} emails as \\Seen: UIDs {format_uid_set(processed_uids)}")
+            await self.session.add_flags(processed_uids, [b'\\Seen'])
+        self._committed_uids.update(processed_uids)
+        await self.outbox.call(self.outbox.forget, self.outbox_key, processed_uids)
+        logger.info(f"[{time.strftime('%H:%M:%S')}] Successfully processed and marked/moved {len(processed_uids)} emails.")
 
     async def _handle_unseen_messages(self):
         try:
             if not self.client or not self.is_mailbox_selected:
                 logger.warning(f"[{time.strftime('%H:%M:%S')}] Client not ready for unseen check. Reconnecting/reselecting.")
-                if not self.connect(): return False
+                if not await self.connect(): return False
                 if not self.is_mailbox_selected: logger.error(f"[{time.strftime('%H:%M:%S')}] Failed select after connect in _handle_unseen."); return False
-            unseen_msgs_uids = self.client.search(['UNSEEN'])
+            uidvalidity = self.select_info.get(b'UIDVALIDITY')
+            stored_uidvalidity, last_uid, stored_modseq = await self.mailbox_state.call(self.mailbox_state.load, self.outbox_key)
+            # HIGHESTMODSEQ from SELECT is only current for the first scan after it
+            current_modseq = self.select_info.get(b'HIGHESTMODSEQ') if self._fresh_select and self.sync_extensions else None
+            self._fresh_select = False
+            # Delivered before a crash or failed flag/move: only the IMAP side is still owed
+            delivered_uids = await self.outbox.call(self.outbox.delivered_uids, self.outbox_key)
+            if current_modseq is not None and current_modseq == stored_modseq and stored_uidvalidity == uidvalidity \
+               and last_uid is not None and not delivered_uids:
+                logger.info(f"[{time.strftime('%H:%M:%S')}] HIGHESTMODSEQ unchanged ({current_modseq}) since the last sync. Skipping the scan.")
+                return False
+            if stored_uidvalidity is not None and stored_uidvalidity != uidvalidity:
+                # Old UIDs (and their journal entries) mean nothing any more
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] UIDVALIDITY of {self.mailbox} changed ({stored_uidvalidity} -> {uidvalidity}). Discarding UID mark {last_uid} and outbox entries.")
+                await self.outbox.call(self.outbox.forget_mailbox, self.outbox_key); last_uid = None; delivered_uids = []
+            if last_uid is None:
+                logger.info(f"[{time.strftime('%H:%M:%S')}] No UID mark for UIDVALIDITY {uidvalidity}. Running a full UNSEEN resync.")
+                unseen_msgs_uids = await self.session.search(['UNSEEN'])
+            else:
+                # "n:*" always matches the newest message, even below n, so filter the answer as well
+                unseen_msgs_uids = [uid for uid in await self.session.search(['UID', f'{last_uid + 1}:*', 'UNSEEN']) if uid > last_uid]
+            if delivered_uids:
+                still_unseen = set(await self.session.search(['UID', format_uid_set(delivered_uids), 'UNSEEN']))
+                await self.outbox.call(self.outbox.forget, self.outbox_key, [uid for uid in delivered_uids if uid not in still_unseen]) # Already flagged/moved
+                for uid in delivered_uids:
+                    if uid in still_unseen: self._queue_commit(uid)
+                unseen_msgs_uids = [uid for uid in unseen_msgs_uids if uid not in set(delivered_uids)]
+            if not unseen_msgs_uids:
+                await self._flush_commits()
+                if current_modseq is not None: current_modseq = await self._modseq_after_commits()
+                if last_uid is None or current_modseq is not None: await self._save_uid_mark(uidvalidity, last_uid, [], [], current_modseq)
             if unseen_msgs_uids:
                 logger.info(f"[{time.strftime('%H:%M:%S')}] Found {len(unseen_msgs_uids)} unseen messages. Processing.")
-                for i in range(0, len(unseen_msgs_uids), 5):
-                    chunk_uids = unseen_msgs_uids[i:i+5]
+                self.pipeline.start(); self._committed_uids = set()
+                accepted_uids = unseen_msgs_uids
+                if config.IMAP_HEADER_PREFETCH and filters_active(): accepted_uids = await self._prefilter_by_headers(unseen_msgs_uids)
+                batch_size = config.IMAP_FETCH_BATCH_SIZE
+                for i in range(0, len(accepted_uids), batch_size):
+                    chunk_uids = accepted_uids[i:i+batch_size]
                     try:
-                        fetched_data = self.client.fetch(chunk_uids, ['RFC822'])
-                        for msg_uid, data in fetched_data.items():
-                            raw_email_bytes = data.get(b'RFC822')
-                            if raw_email_bytes: await self.process_message(msg_uid, raw_email_bytes)
-                            else: logger.warning(f"[{time.strftime('%H:%M:%S')}] No RFC822 for UID {msg_uid} in unseen check.")
+                        fetched_messages = await self._fetch_chunk(chunk_uids)
                     except (IMAPClientError, socket.error, BrokenPipeError) as fetch_err:
-                        logger.error(f"[{time.strftime('%H:%M:%S')}] Error fetching unseen chunk: {fetch_err}. Reconnecting in IDLE loop."); self.is_mailbox_selected = False; self._close_existing_client(); raise
-                    await asyncio.sleep(0.5)
+                        logger.error(f"[{time.strftime('%H:%M:%S')}] Error fetching unseen chunk: {fetch_err}. Reconnecting in IDLE loop."); self.is_mailbox_selected = False; await self._close_existing_client(); raise
+                    for msg_uid, raw_email_bytes, parts in fetched_messages:
+                        if raw_email_bytes: await self.pipeline.submit(msg_uid, raw_email_bytes, parts=parts) # Blocks while the pipeline is full
+                        else: logger.warning(f"[{time.strftime('%H:%M:%S')}] No message body for UID {msg_uid} in unseen check.")
+                    del fetched_messages
+                # Commits share this connection, so let the backlog settle before going back to IDLE
+                await self.pipeline.drain()
+                await self._flush_commits()
+                if current_modseq is not None: current_modseq = await self._modseq_after_commits()
+                await self._save_uid_mark(uidvalidity, last_uid, unseen_msgs_uids, self._committed_uids, current_modseq)
                 return True
             return False
         except (IMAPClientError, socket.error, OSError, BrokenPipeError) as e:
-            logger.error(f"[{time.strftime('%H:%M:%S')}] Error during unseen check: {e}. Reconnecting in IDLE loop."); self.is_mailbox_selected = False; self._close_existing_client(); raise
+            logger.error(f"[{time.strftime('%H:%M:%S')}] Error during unseen check: {e}. Reconnecting in IDLE loop."); self.is_mailbox_selected = False; await self._close_existing_client(); raise
+
+    async def _prefilter_by_headers(self, uids):
+        """Phase one of the two-phase fetch: runs the filter rules on the headers and size only.
+
+        Rules that need the attachment types are left undecided and checked after the full fetch.
+        Rejected UIDs are queued for \\Seen without their body ever being downloaded.
+        Returns the UIDs whose full message still has to be fetched.
+        """
+        accepted = []; skipped_bytes = 0; rules = active_rules()
+        header_item = f"BODY.PEEK[HEADER.FIELDS ({' '.join(FILTER_HEADER_FIELDS)})]"
+        batch_size = config.IMAP_HEADER_FETCH_BATCH_SIZE
+        for i in range(0, len(uids), batch_size):
+            chunk_uids = uids[i:i+batch_size]
+            try: fetched_data = await self.session.fetch(chunk_uids, [header_item, 'RFC822.SIZE'])
+            except (IMAPClientError, socket.error, BrokenPipeError) as fetch_err:
+                logger.error(f"[{time.strftime('%H:%M:%S')}] Error fetching headers: {fetch_err}. Reconnecting in IDLE loop."); self.is_mailbox_selected = False; await self._close_existing_client(); raise
+            for msg_uid in chunk_uids:
+                data = fetched_data.get(msg_uid)
+                if data is None: continue # Expunged meanwhile
+                # The response key echoes the field list, and servers differ in how they quote it
+                header_bytes = next((value for key, value in data.items() if key.upper().startswith(b'BODY[HEADER')), None)
+                if header_bytes is None: accepted.append(msg_uid); continue
+                size = data.get(b'RFC822.SIZE') or 0
+                facts = header_facts(header_bytes, size); rule = rules.evaluate(facts)
+                if rule is None or rule.action != "drop": accepted.append(msg_uid); continue
+                skipped_bytes += size
+                logger.info(f"[{time.strftime('%H:%M:%S')}] Email UID {msg_uid} from '{facts['from']}' (Subject: '{facts['subject']}', {size} bytes) skipped by header filter: {rule.reason}")
+                self._queue_commit(msg_uid, seen_only=True)
+        if len(accepted) < len(uids):
+            logger.info(f"[{time.strftime('%H:%M:%S')}] Header filter dropped {len(uids) - len(accepted)} of {len(uids)} emails ({skipped_bytes / (1024 * 1024):.2f} MB not downloaded).")
+        return accepted
+
+    async def _modseq_after_commits(self):
+        """HIGHESTMODSEQ including this scan's own flags/moves, read with STATUS.
+
+        None if mail arrived after the SELECT (UIDNEXT moved): saving the newer value
+        would let the next reconnect skip a scan that still has to see that mail.
+        """
+        try: status = await self.session.folder_status(self.mailbox, ['HIGHESTMODSEQ', 'UIDNEXT'])
+        except IMAPClientError as e:
+            logger.warning(f"[{time.strftime('%H:%M:%S')}] STATUS after commits failed ({e}). Not saving HIGHESTMODSEQ."); return None
+        if status.get(b'UIDNEXT') != self.select_info.get(b'UIDNEXT'): return None
+        return status.get(b'HIGHESTMODSEQ')
+
+    async def _save_uid_mark(self, uidvalidity, last_uid, scanned_uids, committed_uids, highestmodseq=None):
+        """Advances the UID high-water mark past this scan, but never past a UID that still needs another try.
+
+        highestmodseq (read after this scan's commits) is only kept if the scan finished
+        everything, since a matching value later lets a reconnect skip its scan entirely.
+        """
+        if uidvalidity is None: return
+        unfinished = [uid for uid in scanned_uids if uid not in committed_uids]
+        if unfinished: new_mark = min(unfinished) - 1; highestmodseq = None
+        else:
+            # Every UID below UIDNEXT (as of SELECT) existed when the search ran, so it has been considered
+            new_mark = max(list(scanned_uids) + [self.select_info.get(b'UIDNEXT', 1) - 1])
+        if last_uid is not None:
+            if new_mark <= last_uid and highestmodseq is None: return
+            new_mark = max(new_mark, last_uid)
+        await self.mailbox_state.call(self.mailbox_state.save, self.outbox_key, uidvalidity, new_mark, highestmodseq)
+        logger.debug(f"[{time.strftime('%H:%M:%S')}] UID mark for {self.mailbox} advanced to {new_mark} (UIDVALIDITY {uidvalidity}, HIGHESTMODSEQ {highestmodseq}).")
 
     async def idle_loop(self):
         logger.info(f"[{time.strftime('%H:%M:%S')}] Initializing IDLE mode for mailbox {self.mailbox}...")
@@ -198,29 +463,36 @@ class IMAPHandler:
                             logger.info(f"Waiting {self.current_reconnect_delay}s before next connection attempt ({self.connection_attempts + 1})...")
                             await asyncio.sleep(self.current_reconnect_delay)
                         
-                        if not self.connect(): # connect() now handles attempt counting and delay calculation
+                        if not await self.connect(): # connect() now handles attempt counting and delay calculation
                             # connect() returned False, means it failed and has set up for next retry
                             continue # Loop to retry connection after the calculated delay
                         # If connect() was successful, it reset attempts and delay.
 
                     if not self.is_mailbox_selected: # Client connected, but mailbox not selected
                         logger.info(f"[{time.strftime('%H:%M:%S')}] Mailbox not selected, re-selecting '{self.mailbox}'...")
-                        if not self._select_mailbox_if_needed():
+                        if not await self._select_mailbox_if_needed():
                             logger.error(f"[{time.strftime('%H:%M:%S')}] Failed to select mailbox in IDLE loop. Will attempt reconnect in next cycle.")
                             # _select_mailbox_if_needed might close client if it fails badly
-                            if self.client: self._close_existing_client() # Ensure client is closed to force reconnect
+                            if self.client: await self._close_existing_client() # Ensure client is closed to force reconnect
                             continue # To top of loop, will trigger reconnect logic
                 
                 # At this point, client should be connected and mailbox selected
+                if self.idle_watcher: self.idle_watcher.start(); self.idle_watcher.new_mail.clear() # Mail arriving during the scan sets it again
                 await self._handle_unseen_messages() # Process any existing unseen messages
 
+                if self.idle_watcher and self.idle_watcher.active:
+                    # No IDLE teardown/setup here: wait for the IDLE connection, or rescan at once if mail came in meanwhile
+                    if not self.idle_watcher.new_mail.is_set():
+                        try: await asyncio.wait_for(self.idle_watcher.new_mail.wait(), timeout=IDLE_CHECK_TIMEOUT_SECONDS)
+                        except asyncio.TimeoutError:
+                            logger.debug(f"[{time.strftime('%H:%M:%S')}] No new mail reported for {IDLE_CHECK_TIMEOUT_SECONDS}s. Sending NOOP on the fetch connection to keep it alive.")
+                            await self.session.noop() # Failures are handled below like any other IMAP error
+                    continue
+
                 logger.info(f"[{time.strftime('%H:%M:%S')}] Entering IDLE state (timeout: {IDLE_CHECK_TIMEOUT_SECONDS}s).")
-                self.client.idle()
-                logger.debug(f"[{time.strftime('%H:%M:%S')}] IMAPClient.idle() called.")
-                responses = self.client.idle_check(timeout=IDLE_CHECK_TIMEOUT_SECONDS)
-                logger.info(f"[{time.strftime('%H:%M:%S')}] IMAPClient.idle_check() returned: {responses if responses else 'Timeout/no specific response'}")
-                self.client.idle_done()
-                logger.debug(f"[{time.strftime('%H:%M:%S')}] IMAPClient.idle_done() called.")
+                # The whole IDLE/idle_check/idle_done cycle runs on the session's I/O thread, so the loop stays free
+                responses = await self.session.idle_wait(IDLE_CHECK_TIMEOUT_SECONDS)
+                logger.info(f"[{time.strftime('%H:%M:%S')}] IDLE cycle returned: {responses if responses else 'Timeout/no specific response'}")
 
                 if responses:
                     logger.info(f"[{time.strftime('%H:%M:%S')}] IDLE responses received. Next loop will check unseen.")
@@ -229,14 +501,14 @@ class IMAPHandler:
                     logger.debug(f"[{time.strftime('%H:%M:%S')}] IDLE check timed out. Sending NOOP to keep alive.")
                     try:
                         if self.client:
-                            self.client.noop()
+                            await self.session.noop()
                             logger.info(f"[{time.strftime('%H:%M:%S')}] Sent NOOP successfully.")
                         else: # Should not happen if logic above is correct
                             logger.warning(f"[{time.strftime('%H:%M:%S')}] Client None, cannot NOOP. Forcing reconnect.")
-                            self._close_existing_client() # Force reconnect in next loop
+                            await self._close_existing_client() # Force reconnect in next loop
                     except (IMAPClientError, socket.error, BrokenPipeError) as noop_e:
                         logger.warning(f"[{time.strftime('%H:%M:%S')}] Failed NOOP: {noop_e}. Stale connection likely. Forcing reconnect.")
-                        self._close_existing_client() # Force reconnect
+                        await self._close_existing_client() # Force reconnect
                 
                 await asyncio.sleep(1) # Brief pause before next IDLE cycle or unseen check
 
@@ -248,21 +520,28 @@ class IMAPHandler:
 
             except (socket.timeout, TimeoutError) as e: # More general timeouts during IDLE ops
                 logger.warning(f"[{time.strftime('%H:%M:%S')}] Timeout in IDLE operations ({type(e).__name__}): {e}. Forcing reconnect.")
-                self._close_existing_client() # Force reconnect
+                await self._close_existing_client() # Force reconnect
                 # Loop will continue and trigger reconnect logic
 
             except (IMAPClientError, ConnectionError, BrokenPipeError, socket.error, OSError) as e:
                 logger.error(f"[{time.strftime('%H:%M:%S')}] Major IMAP/network error in IDLE loop ({type(e).__name__}): {e}. Forcing reconnect.")
-                self._close_existing_client() # Force reconnect
+                await self._close_existing_client() # Force reconnect
                 # Loop will continue and trigger reconnect logic
 
             except Exception as e: # Catch-all for truly unexpected errors in the loop
                 logger.critical(f"[{time.strftime('%H:%M:%S')}] Unexpected critical error in IDLE loop ({type(e).__name__}): {e}", exc_info=True)
                 logger.info(f"[{time.strftime('%H:%M:%S')}] Attempting to recover by forcing reconnect.")
-                self._close_existing_client() # Force reconnect
+                await self._close_existing_client() # Force reconnect
                 # Loop will continue and trigger reconnect logic. Add a small delay to prevent rapid crash loops on persistent unknown errors.
                 await asyncio.sleep(5)
 
-    def close(self):
+    async def close(self):
         logger.info(f"[{time.strftime('%H:%M:%S')}] Initiating IMAP client shutdown.")
-        self._close_existing_client()
+        await self.pipeline.stop()
+        if self.idle_watcher: await self.idle_watcher.stop()
+        # A cancelled IDLE has already aborted its socket; bound the LOGOUT so a stuck command can't delay shutdown
+        try: await asyncio.wait_for(self._close_existing_client(), timeout=CLOSE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError: logger.warning(f"[{time.strftime('%H:%M:%S')}] IMAP logout timed out after {CLOSE_TIMEOUT_SECONDS}s. Dropping connection.")
+        self.session.shutdown(); self.is_mailbox_selected = False
+        # Shared resources are closed by their owner; unflushed UIDs stay 'delivered' in the outbox and are flagged after restart
+        for resource in self._owned: resource.shutdown() if isinstance(resource, ConnectionManager) else resource.close()
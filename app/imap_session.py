@@ -0,0 +1,154 @@
+from imapclient import IMAPClient
+from concurrent.futures import ThreadPoolExecutor
+import weakref
+import ssl
+import functools
+import logging
+import asyncio
+import time
+from . import config
+
+logger = logging.getLogger(__name__)
+
+def format_uid_set(uids):
+    """[1, 2, 3, 7, 9, 10] -> '1:3,7,9:10': a UID set as ranges, so a batch costs a short command."""
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1: ranges[-1][1] = uid
+        else: ranges.append([uid, uid])
+    return ','.join(f"{lo}:{hi}" if hi > lo else str(lo) for lo, hi in ranges)
+
+class AsyncIMAPSession:
+    """Awaitable wrapper around a blocking IMAPClient connection.
+
+    Every command runs on a dedicated single I/O thread owned by the session, so
+    commands stay strictly ordered on the wire while the event loop never blocks.
+    """
+
+    def __init__(self, host, port, ssl_context, timeout, name="imap", connect_slots=None):
+        self.host = host; self.port = port; self.ssl_context = ssl_context; self.timeout = timeout
+        self.name = name
+        self.connect_slots = connect_slots # Optional semaphore shared by sessions to cap concurrent logins
+        self.client = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-io")
+
+    @property
+    def connected(self):
+        return self.client is not None
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def call(self, method_name, *args, **kwargs):
+        if not self.client: raise ConnectionError(f"IMAP session '{self.name}' is not connected.")
+        return await self._run(getattr(self.client, method_name), *args, **kwargs)
+
+    async def connect(self, user, password):
+        def _connect():
+            client = IMAPClient(self.host, port=self.port, ssl=True, ssl_context=self.ssl_context, timeout=self.timeout)
+            try: client.login(user, password)
+            except Exception:
+                try: client.shutdown()
+                except Exception: pass
+                raise
+            return client
+        if self.connect_slots is None: self.client = await self._run(_connect)
+        else:
+            async with self.connect_slots: self.client = await self._run(_connect)
+        return self.client
+
+    async def select_folder(self, folder, readonly=False): return await self.call('select_folder', folder, readonly=readonly)
+    async def folder_exists(self, folder): return await self.call('folder_exists', folder)
+    async def create_folder(self, folder): return await self.call('create_folder', folder)
+    async def search(self, criteria): return await self.call('search', criteria)
+    async def fetch(self, messages, data, modifiers=None): return await self.call('fetch', messages, data, modifiers=modifiers)
+    # UID lists go out as one compact UID set; flag changes are not echoed back (STORE +FLAGS.SILENT)
+    async def add_flags(self, messages, flags): return await self.call('add_flags', format_uid_set(messages), flags, silent=True)
+    async def move(self, messages, folder): return await self.call('move', format_uid_set(messages), folder)
+    async def noop(self): return await self.call('noop')
+
+    async def folder_status(self, folder, what): return await self.call('folder_status', folder, what)
+
+    async def enable_sync_extensions(self):
+        """ENABLEs CONDSTORE if advertised, so SELECT and STATUS report HIGHESTMODSEQ. Returns the enabled names."""
+        def _enable():
+            client = self.client
+            if not client.has_capability('ENABLE') or not client.has_capability('CONDSTORE'): return set()
+            return {name.decode() if isinstance(name, bytes) else name for name in client.enable('CONDSTORE')}
+        if not self.client: raise ConnectionError(f"IMAP session '{self.name}' is not connected.")
+        return await self._run(_enable)
+
+    async def idle_wait(self, timeout):
+        """Runs a full IDLE cycle (IDLE, wait, DONE) on the I/O thread.
+
+        Cancelling the awaiting task aborts the socket so the blocked thread is
+        released immediately instead of waiting out the IDLE timeout.
+        """
+        client = self.client
+        if not client: raise ConnectionError(f"IMAP session '{self.name}' is not connected.")
+        def _idle():
+            client.idle()
+            try: return client.idle_check(timeout=timeout)
+            finally: client.idle_done()
+        try:
+            return await self._run(_idle)
+        except asyncio.CancelledError:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Tears down the socket without a LOGOUT round-trip. Safe to call from the event loop thread."""
+        client = self.client; self.client = None
+        if client:
+            try: client.shutdown()
+            except Exception as e: logger.debug(f"[{time.strftime('%H:%M:%S')}] Exception while aborting IMAP session '{self.name}' (ignored): {e}")
+
+    async def logout(self):
+        client = self.client; self.client = None
+        if client:
+            try: await self._run(client.logout)
+            except Exception as e:
+                logger.debug(f"[{time.strftime('%H:%M:%S')}] Exception while logging out (ignored): {e}")
+                try: client.shutdown()
+                except Exception: pass
+
+    def shutdown(self):
+        self.abort()
+        self._executor.shutdown(wait=False)
+
+class ReconnectBackoff:
+    """Connection attempts and the current reconnect delay of one account, shared by all its mailboxes."""
+    __slots__ = ("attempts", "delay")
+
+    def __init__(self, initial_delay):
+        self.attempts = 0; self.delay = initial_delay
+
+class ConnectionManager:
+    """IMAP connection resources shared by every mailbox monitored in the process.
+
+    Sessions get one TLS context (loading the CA bundle once instead of per connection),
+    logins are capped at IMAP_MAX_CONCURRENT_LOGINS so a restart does not open dozens of
+    TLS handshakes at once, and reconnect backoff is kept per account rather than per mailbox.
+    """
+
+    def __init__(self, max_concurrent_logins=None):
+        self.ssl_context = ssl.create_default_context()
+        limit = config.IMAP_MAX_CONCURRENT_LOGINS if max_concurrent_logins is None else max_concurrent_logins
+        self._connect_slots = asyncio.Semaphore(limit) if limit > 0 else None
+        # Weak: sharded mode creates sessions with every lease it takes, and a closed handler's sessions must not pile up here
+        self._backoff = {}; self._sessions = weakref.WeakSet()
+
+    def session(self, host, port, timeout, name="imap"):
+        session = AsyncIMAPSession(host, port, self.ssl_context, timeout, name=name, connect_slots=self._connect_slots)
+        self._sessions.add(session)
+        return session
+
+    def backoff(self, account, initial_delay):
+        """The ReconnectBackoff of an account (e.g. "user@host"), created on first use."""
+        if account not in self._backoff: self._backoff[account] = ReconnectBackoff(initial_delay)
+        return self._backoff[account]
+
+    def shutdown(self):
+        for session in list(self._sessions): session.shutdown()
+        self._sessions.clear()
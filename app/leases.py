@@ -0,0 +1,160 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import math
+import time
+from . import config
+from .storage import open_database
+
+logger = logging.getLogger(__name__)
+
+class LeaseExpired(RuntimeError):
+    """Raised before a journalled send once this worker can no longer be sure it holds the mailbox lease."""
+
+class LeaseStore:
+    """Mailbox leases and worker heartbeats in a SQLite file shared by every worker.
+
+    A lease has an owner, a wall-clock expiry and a fence number that grows every time
+    the lease changes hands, so an owner that lost its lease cannot renew it by accident.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename or config.LEASE_DB
+        self._db = None
+
+    def _conn(self):
+        if self._db is None:
+            self._db = open_database(self.filename)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS leases (
+                resource TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL, fence INTEGER NOT NULL)""")
+            self._db.execute("CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, expires REAL NOT NULL)")
+        return self._db
+
+    def heartbeat(self, worker, ttl):
+        self._conn().execute("INSERT OR REPLACE INTO workers (worker, expires) VALUES (?, ?)", (worker, time.time() + ttl))
+
+    def live_workers(self):
+        return self._conn().execute("SELECT COUNT(*) FROM workers WHERE expires > ?", (time.time(),)).fetchone()[0]
+
+    def remove_worker(self, worker):
+        self._conn().execute("DELETE FROM workers WHERE worker = ?", (worker,))
+
+    def acquire(self, resource, owner, ttl):
+        """Takes the lease if it is free, expired or already ours. Returns its fence number, or None."""
+        db = self._conn(); now = time.time()
+        db.execute("BEGIN IMMEDIATE") # Serialises competing workers on the database write lock
+        try:
+            row = db.execute("SELECT owner, expires, fence FROM leases WHERE resource = ?", (resource,)).fetchone()
+            if row and row[0] != owner and row[1] > now: db.execute("ROLLBACK"); return None
+            fence = (row[2] if row else 0) + (0 if row and row[0] == owner and row[1] > now else 1)
+            db.execute("INSERT OR REPLACE INTO leases (resource, owner, expires, fence) VALUES (?, ?, ?, ?)", (resource, owner, now + ttl, fence))
+            db.execute("COMMIT"); return fence
+        except BaseException:
+            db.execute("ROLLBACK"); raise
+
+    def renew(self, resource, owner, fence, ttl):
+        """Extends a lease we still hold. False once it has expired and been taken over."""
+        cursor = self._conn().execute("UPDATE leases SET expires = ? WHERE resource = ? AND owner = ? AND fence = ?",
+                                      (time.time() + ttl, resource, owner, fence))
+        return cursor.rowcount == 1
+
+    def release(self, resource, owner, fence):
+        # The row (and its fence number) is kept; only the expiry is cleared
+        self._conn().execute("UPDATE leases SET expires = 0 WHERE resource = ? AND owner = ? AND fence = ?", (resource, owner, fence))
+
+    def close(self):
+        if self._db is not None: self._db.close(); self._db = None
+
+def lease_deadline(started, ttl):
+    """Local validity of a lease written at `started` (time.monotonic(), taken before the write).
+
+    A third of the TTL short of the stored expiry: work stops before another worker can take over.
+    """
+    return started + ttl * 2 / 3
+
+class Lease:
+    """A lease held by this worker. valid() turns false a safety margin before the stored expiry."""
+    __slots__ = ("resource", "fence", "deadline")
+
+    def __init__(self, resource, fence, deadline):
+        self.resource = resource; self.fence = fence; self.deadline = deadline
+
+    def valid(self):
+        return time.monotonic() < self.deadline
+
+    def check(self):
+        if not self.valid(): raise LeaseExpired(f"Lease on {self.resource} (fence {self.fence}) expired. Leaving the mailbox to its new owner.")
+
+class ShardManager:
+    """Runs the IMAPHandlers of the mailboxes this worker holds a lease on.
+
+    Every worker sharing LEASE_DB is a peer: each one heartbeats, renews its leases and,
+    every LEASE_TTL_SECONDS / 3, takes free or expired leases up to its fair share
+    (mailboxes / live workers), giving back any surplus so a new worker gets mailboxes too.
+    The mailboxes of a dead worker are picked up by the others once its leases expire;
+    deliveries it left half done resume from the shared outbox journal.
+    """
+
+    def __init__(self, routes, make_handler, store=None, worker_id=None, ttl=None):
+        self.routes = routes; self.make_handler = make_handler
+        self.store = store or LeaseStore()
+        self.worker_id = worker_id or config.WORKER_ID
+        self.ttl = ttl or config.LEASE_TTL_SECONDS
+        self._held = {} # route key -> (Lease, handler, idle task)
+        # SQLite calls wait up to 30s on a busy database: they run off the event loop, one at a time
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="leases")
+        # Rendezvous order: workers prefer different mailboxes, so they rarely race for the same lease
+        self._preference = sorted(routes, key=lambda route: hashlib.sha1(f"{self.worker_id}/{route.key}".encode()).digest())
+
+    async def _db(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+
+    async def run(self):
+        logger.info(f"[{time.strftime('%H:%M:%S')}] Worker {self.worker_id} sharing {len(self.routes)} mailboxes through leases (TTL {self.ttl}s).")
+        while True:
+            try: await self._rebalance()
+            except Exception as e: logger.error(f"[{time.strftime('%H:%M:%S')}] Lease rebalance failed: {e}", exc_info=True)
+            await asyncio.sleep(self.ttl / 3)
+
+    async def _rebalance(self):
+        await self._db(self.store.heartbeat, self.worker_id, self.ttl)
+        for key, (lease, handler, task) in list(self._held.items()):
+            if task.done():
+                # Its IDLE loop gave up (e.g. login failure): hand the mailbox back so it is retried, here or elsewhere
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] IDLE task for {key} ended. Releasing its lease.")
+                await self._stop(key, release=True); continue
+            renewed_at = time.monotonic()
+            if await self._db(self.store.renew, key, self.worker_id, lease.fence, self.ttl):
+                lease.deadline = lease_deadline(renewed_at, self.ttl)
+            else:
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] Lease on {key} was lost (fence {lease.fence}). Stopping its handler.")
+                await self._stop(key, release=False)
+        fair_share = math.ceil(len(self.routes) / max(await self._db(self.store.live_workers), 1))
+        for route in reversed(self._preference):
+            if len(self._held) <= fair_share: break
+            if route.key in self._held:
+                logger.info(f"[{time.strftime('%H:%M:%S')}] Holding more than a fair share ({fair_share}). Handing {route.key} back.")
+                await self._stop(route.key, release=True)
+        for route in self._preference:
+            if len(self._held) >= fair_share: break
+            if route.key in self._held: continue
+            started = time.monotonic(); fence = await self._db(self.store.acquire, route.key, self.worker_id, self.ttl)
+            if fence is not None: self._start(route, Lease(route.key, fence, lease_deadline(started, self.ttl)))
+
+    def _start(self, route, lease):
+        logger.info(f"[{time.strftime('%H:%M:%S')}] Worker {self.worker_id} took the lease on {route.key} (fence {lease.fence}).")
+        handler = self.make_handler(route); handler.lease = lease
+        self._held[route.key] = (lease, handler, asyncio.create_task(handler.idle_loop()))
+
+    async def _stop(self, key, release):
+        lease, handler, task = self._held.pop(key)
+        if not task.done(): task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await handler.close()
+        if release: await self._db(self.store.release, key, self.worker_id, lease.fence)
+
+    async def close(self):
+        for key in list(self._held): await self._stop(key, release=True)
+        await self._db(self.store.remove_worker, self.worker_id); await self._db(self.store.close)
+        self._executor.shutdown(wait=False)
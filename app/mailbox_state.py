@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import time
+from . import config
+from .storage import open_database
+
+logger = logging.getLogger(__name__)
+
+class MailboxState:
+    """Persists the highest fully handled UID per mailbox, scoped to the mailbox's UIDVALIDITY.
+
+    UIDs are only meaningful for one UIDVALIDITY; when the server reports a different
+    value the stored mark must be discarded and the mailbox resynced from scratch. With
+    CONDSTORE the HIGHESTMODSEQ seen at the last complete sync is kept as well.
+    Like the outbox, it is called from the event loop through call().
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename or config.MAILBOX_STATE_DB
+        self._db = None; self._executor = None
+
+    async def call(self, method, *args):
+        """Awaits a method of this store on its own thread, so a busy database never blocks the event loop."""
+        if self._executor is None: self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mailbox-state")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+
+    def _conn(self):
+        if self._db is None:
+            self._db = open_database(self.filename)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS mailbox_state (
+                mailbox TEXT PRIMARY KEY, uidvalidity INTEGER NOT NULL, last_uid INTEGER NOT NULL, updated REAL NOT NULL,
+                highestmodseq INTEGER)""")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(mailbox_state)")]
+            if 'highestmodseq' not in columns: self._db.execute("ALTER TABLE mailbox_state ADD COLUMN highestmodseq INTEGER")
+        return self._db
+
+    def load(self, mailbox):
+        """Returns (uidvalidity, last_uid, highestmodseq) as stored, or Nones for a mailbox never seen before."""
+        row = self._conn().execute("SELECT uidvalidity, last_uid, highestmodseq FROM mailbox_state WHERE mailbox = ?", (mailbox,)).fetchone()
+        return tuple(row) if row else (None, None, None)
+
+    def save(self, mailbox, uidvalidity, last_uid, highestmodseq=None):
+        """Stores the mark. highestmodseq=None clears it: the next reconnect must not skip its scan."""
+        self._conn().execute("INSERT OR REPLACE INTO mailbox_state (mailbox, uidvalidity, last_uid, updated, highestmodseq) VALUES (?, ?, ?, ?, ?)",
+                             (mailbox, uidvalidity, last_uid, time.time(), highestmodseq))
+
+    def _close_db(self):
+        if self._db is not None: self._db.close(); self._db = None
+
+    def close(self):
+        if self._executor is None: self._close_db(); return
+        self._executor.submit(self._close_db); self._executor.shutdown(wait=False); self._executor = None
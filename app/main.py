@@ -1,14 +1,36 @@
 import asyncio
+import multiprocessing
 import signal
 import logging
+import time
 from . import config 
 from .imap_handler import IMAPHandler
+from .imap_session import ConnectionManager
+from .accounts import load_routes
+from .filters import active_rules
+from .parse_pool import ParsePool
+from .outbox import Outbox
+from .mailbox_state import MailboxState
+from .pipeline import MemoryBudget
+from .leases import ShardManager
+from . import telegram_sender
 
 logger = logging.getLogger(__name__)
 
 async def main_loop():
     logger.info("Starting Mailu Telegram Forwarder...")
-    imap_handler = IMAPHandler()
+    try: routes = load_routes()
+    except (OSError, ValueError) as e: logger.critical(f"Could not load mailbox routes: {e}. Exiting."); return
+    try: active_rules() # Compiled once up front, so a broken rule file stops the start instead of the first scan
+    except (OSError, ValueError) as e: logger.critical(f"Could not load filter rules: {e}. Exiting."); return
+    # One process serves every route: connections, parsing, journals, memory budget and the Telegram send scheduler are shared
+    connections = ConnectionManager(); parse_pool = ParsePool(); outbox = Outbox(); mailbox_state = MailboxState()
+    memory_budget = MemoryBudget(config.PIPELINE_MEMORY_BUDGET_BYTES)
+    def make_handler(route):
+        return IMAPHandler(route, connections=connections, parse_pool=parse_pool, outbox=outbox, mailbox_state=mailbox_state, memory_budget=memory_budget)
+    # Sharded mode: handlers come and go with the mailbox leases this worker holds
+    shards = ShardManager(routes, make_handler) if config.SHARD_LEASES else None
+    imap_handlers = [] if shards else [make_handler(route) for route in routes]
     stop_event = asyncio.Event(); loop = asyncio.get_event_loop()
     def signal_handler():
         logger.info("Shutdown signal received. Setting stop event...")
@@ -20,35 +42,48 @@ async def main_loop():
             logger.warning(f"loop.add_signal_handler for {sig} not fully supported: {e}")
             try: signal.signal(sig, lambda s, f: signal_handler())
             except Exception as sig_e: logger.error(f"Failed to set signal.signal fallback for {sig}: {sig_e}")
-    idle_task = None
+    idle_tasks = []; task_names = []
     try:
-        if not imap_handler.connect(): logger.critical("Initial IMAP connect failed. Exiting."); return
-        logger.info("Initial IMAP connection successful.")
-        idle_task = asyncio.create_task(imap_handler.idle_loop())
+        if shards: results = [True]
+        else: results = await asyncio.gather(*(handler.connect() for handler in imap_handlers), return_exceptions=True)
+        if not any(result is True for result in results): logger.critical("Initial IMAP connect failed. Exiting."); return
+        for handler, result in zip(imap_handlers, results):
+            # The IDLE loop keeps retrying these with the account's backoff
+            if result is not True: logger.warning(f"Initial IMAP connect for {handler.route.key} failed ({result if isinstance(result, Exception) else 'see above'}). Retrying in its IDLE loop.")
+        if shards: idle_tasks = [asyncio.create_task(shards.run())]; task_names = ["Lease manager"]
+        else:
+            logger.info(f"Initial IMAP connection successful ({sum(result is True for result in results)}/{len(imap_handlers)} mailboxes).")
+            idle_tasks = [asyncio.create_task(handler.idle_loop()) for handler in imap_handlers]
+            task_names = [f"IDLE task for {handler.route.key}" for handler in imap_handlers]
         stop_event_task = asyncio.create_task(stop_event.wait())
-        done, pending = await asyncio.wait([idle_task, stop_event_task], return_when=asyncio.FIRST_COMPLETED)
-        if stop_event_task in done:
-            logger.info("Stop event triggered. Shutting down IDLE task.")
-            if idle_task and not idle_task.done(): idle_task.cancel()
-        elif idle_task in done:
-            logger.info("IDLE task completed. Triggering stop event.")
+        running = set(idle_tasks)
+        while running:
+            done, _ = await asyncio.wait(running | {stop_event_task}, return_when=asyncio.FIRST_COMPLETED)
+            if stop_event_task in done: logger.info("Stop event triggered. Shutting down IDLE tasks."); break
+            for task in done:
+                running.discard(task); name = task_names[idle_tasks.index(task)]
+                exc = task.exception() if not task.cancelled() else None
+                if exc: logger.error(f"{name} exited with exception: {exc}", exc_info=exc)
+                else: logger.info(f"{name} completed.")
+        else:
+            logger.info("All IDLE tasks completed. Triggering stop event.")
             if not stop_event.is_set(): stop_event.set()
-        if pending:
-            for task in pending:
-                if not task.done(): task.cancel()
-            await asyncio.gather(*pending, return_exceptions=True)
-        if idle_task and idle_task.done() and not idle_task.cancelled():
-            exc = idle_task.exception()
-            if exc: logger.error(f"IDLE task exited with exception: {exc}", exc_info=exc)
+        if not stop_event_task.done(): stop_event_task.cancel()
+        await asyncio.gather(stop_event_task, return_exceptions=True)
     except asyncio.CancelledError: logger.info("Main loop cancelled.")
     except Exception as e: logger.critical(f"Critical error in main execution: {e}", exc_info=True)
     finally:
-        logger.info("Shutting down IMAP handler in main_loop finally...")
-        if idle_task and not idle_task.done():
-            idle_task.cancel()
-            try: await asyncio.gather(idle_task, return_exceptions=True)
-            except asyncio.CancelledError: logger.info("IDLE task successfully cancelled during final shutdown.")
-        if hasattr(imap_handler, 'close'): imap_handler.close()
+        logger.info("Shutting down IMAP handlers in main_loop finally...")
+        for task in idle_tasks:
+            if not task.done(): task.cancel()
+        if idle_tasks:
+            await asyncio.gather(*idle_tasks, return_exceptions=True)
+            logger.info("IDLE tasks cancelled during final shutdown.")
+        if shards: await shards.close() # Stops the handlers it runs and releases their leases for the other workers
+        await asyncio.gather(*(handler.close() for handler in imap_handlers), return_exceptions=True)
+        connections.shutdown(); parse_pool.close(); mailbox_state.close()
+        outbox.close() # Unflushed UIDs stay 'delivered' in the journal and are flagged after restart
+        await telegram_sender.shutdown()
         for sig in (signal.SIGINT, signal.SIGTERM):
             try: loop.remove_signal_handler(sig)
             except (NotImplementedError, RuntimeError): 
@@ -56,7 +91,45 @@ async def main_loop():
                 except: pass
         logger.info("Mailu Telegram Forwarder stopped.")
 
+WORKER_RESTART_DELAY_SECONDS = 5
+
+def _run_worker(index):
+    # Spawned child: one sharded worker with an ID of its own, even if WORKER_ID was set for the host
+    config.WORKER_ID = f"{config.WORKER_ID}/{index}"
+    try: asyncio.run(main_loop())
+    except KeyboardInterrupt: pass
+
+def run_shard_workers(count):
+    """Coordinator: runs `count` sharded worker processes on this host and restarts any that die.
+
+    The workers split the mailboxes among themselves through the lease store; a worker that
+    dies has its mailboxes taken over by the others until its replacement takes its share back.
+    """
+    context = multiprocessing.get_context('spawn'); workers = {}; stopping = False
+    def start(index):
+        process = context.Process(target=_run_worker, args=(index,), name=f"forwarder-worker-{index}")
+        process.start(); workers[index] = process
+        logger.info(f"Started worker process {index} (PID {process.pid}).")
+    def stop(signum, frame):
+        nonlocal stopping; stopping = True
+        logger.info(f"Signal {signum} received. Stopping {len(workers)} worker processes...")
+        for process in workers.values():
+            if process.is_alive(): process.terminate() # SIGTERM: each worker shuts down gracefully and releases its leases
+    for sig in (signal.SIGINT, signal.SIGTERM): signal.signal(sig, stop)
+    for index in range(count): start(index)
+    while workers:
+        time.sleep(1)
+        for index, process in list(workers.items()):
+            if process.is_alive(): continue
+            del workers[index]
+            if stopping: continue
+            logger.warning(f"Worker process {index} exited (code {process.exitcode}). Restarting it in {WORKER_RESTART_DELAY_SECONDS}s.")
+            time.sleep(WORKER_RESTART_DELAY_SECONDS)
+            if not stopping: start(index)
+    logger.info("All worker processes stopped.")
+
 if __name__ == "__main__":
+    if config.SHARD_LEASES and config.SHARD_WORKERS > 1: run_shard_workers(config.SHARD_WORKERS); raise SystemExit(0)
     try: asyncio.run(main_loop())
     except KeyboardInterrupt: logger.info("Application interrupted by user (KeyboardInterrupt from asyncio.run).")
     except SystemExit as e: logger.info(f"SystemExit called: {e}")
@@ -0,0 +1,150 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import logging
+import time
+from . import config
+from .storage import open_database
+
+logger = logging.getLogger(__name__)
+
+STATE_PENDING = 'pending' # Delivery started, some steps may still be missing
+STATE_DELIVERED = 'delivered' # Every step went out (or attempts ran out); the IMAP flag/move is still owed
+
+class Delivery:
+    """Journal handle for one email. Each Telegram operation is a named step that runs at most once."""
+
+    def __init__(self, outbox, mailbox, uid, attempts=0, steps=None, lease=None):
+        self.outbox = outbox; self.mailbox = mailbox; self.uid = uid
+        self.attempts = attempts; self.steps = steps if steps is not None else {}
+        self.lease = lease # Sharded mode: every step still to be sent checks it first (raises LeaseExpired)
+
+    @classmethod
+    def untracked(cls):
+        """A handle that remembers steps only in memory (sends outside the IMAP pipeline)."""
+        return cls(None, None, None)
+
+    def is_done(self, key):
+        """Whether a step already went out. Senders ask this before every send, so a lost lease stops them here."""
+        if key is not None and key in self.steps: return True
+        self.check_lease(); return False
+
+    def check_lease(self):
+        if self.lease is not None: self.lease.check()
+
+    def result(self, key):
+        return self.steps.get(key)
+
+    def any_done(self, prefix):
+        return any(key == prefix or key.startswith(f"{prefix}:") for key in self.steps)
+
+    async def mark_done(self, key, result=''):
+        if key is None: return
+        self.steps[key] = result
+        if self.outbox is not None: await self.outbox.call(self.outbox.record_step, self.mailbox, self.uid, key, result)
+
+    async def run(self, key, send):
+        """Awaits send() unless the step already went out. Records it when send() reports success."""
+        if self.is_done(key): return True
+        sent = await send()
+        if sent: await self.mark_done(key)
+        return bool(sent)
+
+class Outbox:
+    """SQLite journal of per-UID Telegram deliveries.
+
+    Every part of a forwarded email (header, body text parts, body image slices,
+    attachments) is recorded as soon as Telegram accepts it, so a retry after a crash
+    or failure resumes with the first missing part. Rows are removed once the UID
+    has been flagged/moved on the IMAP server.
+
+    The methods below block: the event loop runs them through call().
+    """
+
+    def __init__(self, filename=None, max_attempts=None):
+        self.filename = filename or config.OUTBOX_DB
+        self.max_attempts = max_attempts or config.OUTBOX_MAX_ATTEMPTS
+        self._db = None; self._executor = None
+
+    async def call(self, method, *args, **kwargs):
+        """Awaits a method of this journal on its own thread.
+
+        The database is shared by every worker process and a write may wait up to 30s for
+        its lock, which must not stall the event loop. One thread keeps the calls in order.
+        """
+        if self._executor is None: self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+    def _conn(self):
+        if self._db is None:
+            self._db = open_database(self.filename)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS deliveries (
+                mailbox TEXT NOT NULL, uid INTEGER NOT NULL, state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL, PRIMARY KEY (mailbox, uid))""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS delivery_steps (
+                mailbox TEXT NOT NULL, uid INTEGER NOT NULL, step TEXT NOT NULL,
+                result TEXT, done_at REAL NOT NULL, PRIMARY KEY (mailbox, uid, step))""")
+        return self._db
+
+    def begin(self, mailbox, uid, lease=None):
+        """Starts (or resumes) the delivery of a UID and returns its journal handle."""
+        db = self._conn()
+        db.execute("""INSERT INTO deliveries (mailbox, uid, state, attempts, updated) VALUES (?, ?, ?, 1, ?)
+                      ON CONFLICT (mailbox, uid) DO UPDATE SET attempts = attempts + 1, updated = excluded.updated""",
+                   (mailbox, uid, STATE_PENDING, time.time()))
+        attempts = db.execute("SELECT attempts FROM deliveries WHERE mailbox = ? AND uid = ?", (mailbox, uid)).fetchone()[0]
+        steps = dict(db.execute("SELECT step, result FROM delivery_steps WHERE mailbox = ? AND uid = ?", (mailbox, uid)).fetchall())
+        if steps: logger.info(f"[{time.strftime('%H:%M:%S')}] Resuming delivery of UID {uid} (attempt {attempts}, {len(steps)} steps already sent).")
+        return Delivery(self, mailbox, uid, attempts, steps, lease)
+
+    def done_steps(self, mailbox, uid):
+        """Steps already sent for a UID, without starting a delivery attempt."""
+        return {row[0] for row in self._conn().execute("SELECT step FROM delivery_steps WHERE mailbox = ? AND uid = ?", (mailbox, uid))}
+
+    def record_step(self, mailbox, uid, step, result=''):
+        """Journals one step of a UID as sent (Delivery.mark_done calls this)."""
+        self._conn().execute("INSERT OR REPLACE INTO delivery_steps (mailbox, uid, step, result, done_at) VALUES (?, ?, ?, ?, ?)",
+                             (mailbox, uid, step, result, time.time()))
+
+    def mark_delivered(self, mailbox, uid):
+        self._conn().execute("UPDATE deliveries SET state = ?, updated = ? WHERE mailbox = ? AND uid = ?",
+                             (STATE_DELIVERED, time.time(), mailbox, uid))
+
+    def state(self, mailbox, uid):
+        row = self._conn().execute("SELECT state FROM deliveries WHERE mailbox = ? AND uid = ?", (mailbox, uid)).fetchone()
+        return row[0] if row else None
+
+    def delivered_uids(self, mailbox):
+        """UIDs whose Telegram delivery finished but whose IMAP flag/move has not been confirmed."""
+        rows = self._conn().execute("SELECT uid FROM deliveries WHERE mailbox = ? AND state = ? ORDER BY uid", (mailbox, STATE_DELIVERED))
+        return [row[0] for row in rows]
+
+    def uids(self, mailbox):
+        """Every UID with a journal entry, delivered or not."""
+        return [row[0] for row in self._conn().execute("SELECT uid FROM deliveries WHERE mailbox = ? ORDER BY uid", (mailbox,))]
+
+    def forget(self, mailbox, uids):
+        """Drops the journal of UIDs that are now flagged/moved on the server."""
+        if not uids: return
+        db = self._conn()
+        db.execute("BEGIN")
+        try:
+            db.executemany("DELETE FROM delivery_steps WHERE mailbox = ? AND uid = ?", [(mailbox, uid) for uid in uids])
+            db.executemany("DELETE FROM deliveries WHERE mailbox = ? AND uid = ?", [(mailbox, uid) for uid in uids])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK"); raise
+
+    def forget_mailbox(self, mailbox):
+        """Drops every journal entry of a mailbox (its UIDs were invalidated by a UIDVALIDITY change)."""
+        db = self._conn()
+        db.execute("DELETE FROM delivery_steps WHERE mailbox = ?", (mailbox,))
+        db.execute("DELETE FROM deliveries WHERE mailbox = ?", (mailbox,))
+
+    def _close_db(self):
+        if self._db is not None: self._db.close(); self._db = None
+
+    def close(self):
+        # Writes already queued still run; the connection is closed after them, on the same thread
+        if self._executor is None: self._close_db(); return
+        self._executor.submit(self._close_db); self._executor.shutdown(wait=False); self._executor = None
@@ -0,0 +1,69 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import asyncio
+import logging
+import time
+from . import config
+from .email_parser import parse_email, parse_email_fallback
+
+logger = logging.getLogger(__name__)
+
+class ParsePool:
+    """Runs parse_email off the event loop, optionally in a pool of worker processes.
+
+    With PARSE_PROCESS_WORKERS > 0 every email is parsed in a separate process and must
+    finish within PARSE_TIMEOUT_SECONDS; otherwise the pool is recycled (killing the stuck
+    worker) and a cheap plain-text parse is used instead. Emails whose parse was cut off
+    by that recycle are retried once on the fresh pool. Only as many emails as there are
+    workers are handed to the pool at a time, so the timeout measures the parse itself,
+    not the wait behind other mailboxes' emails. With 0 workers parsing runs on the
+    default thread executor.
+    """
+
+    def __init__(self, workers=None, timeout=None):
+        self.workers = config.PARSE_PROCESS_WORKERS if workers is None else workers
+        self.timeout = timeout or config.PARSE_TIMEOUT_SECONDS
+        self._pool = None
+        self._slots = asyncio.Semaphore(max(self.workers, 1)) # One submission per worker process
+
+    def _get_pool(self):
+        if self._pool is None:
+            # spawn, not fork: the parent has live I/O threads whose locks must not be copied
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            logger.info(f"[{time.strftime('%H:%M:%S')}] Started parse process pool with {self.workers} workers.")
+        return self._pool
+
+    def _recycle_pool(self, pool):
+        # Only the pool the failure happened on; another parse may already have started a fresh one
+        if pool is None or self._pool is not pool: return
+        self._pool = None
+        for process in list(getattr(pool, '_processes', {}).values()):
+            try: process.terminate()
+            except Exception: pass
+        pool.shutdown(wait=False)
+
+    async def parse(self, raw_email_bytes, uid=None):
+        loop = asyncio.get_event_loop()
+        if self.workers <= 0:
+            return await loop.run_in_executor(None, parse_email, raw_email_bytes, uid)
+        for attempt in (1, 2):
+            try:
+                async with self._slots:
+                    pool = self._get_pool()
+                    return await asyncio.wait_for(loop.run_in_executor(pool, parse_email, raw_email_bytes, uid), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] Parsing UID {uid} exceeded {self.timeout}s. Recycling parse pool and using plain-text fallback.")
+                self._recycle_pool(pool); break
+            except BrokenProcessPool as e:
+                self._recycle_pool(pool)
+                # Usually another email's timeout recycled the pool under this one (the pool is shared by
+                # every mailbox): it gets one more try on a fresh pool before degrading to plain text
+                if attempt == 1:
+                    logger.warning(f"[{time.strftime('%H:%M:%S')}] Parse pool broke while parsing UID {uid}: {e}. Retrying on a fresh pool."); continue
+                logger.error(f"[{time.strftime('%H:%M:%S')}] Parse pool broke again while parsing UID {uid}: {e}. Using plain-text fallback.")
+        return await loop.run_in_executor(None, parse_email_fallback, raw_email_bytes, uid)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True); self._pool = None
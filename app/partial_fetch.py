@@ -0,0 +1,142 @@
+import base64
+import binascii
+import email
+import email.utils
+import logging
+import quopri
+import time
+import uuid
+from . import config
+from .email_parser import decode_email_header
+from .spool import Spool
+
+logger = logging.getLogger(__name__)
+
+def _text(value):
+    return value.decode('utf-8', errors='replace') if isinstance(value, bytes) else (value or '')
+
+def _params(raw_params):
+    """BODYSTRUCTURE parameter list (k1, v1, k2, v2, ...) -> {lowercase key: str value}, RFC 2231 decoded."""
+    params = {}
+    if not isinstance(raw_params, (tuple, list)): return params
+    for key, value in zip(raw_params[::2], raw_params[1::2]):
+        key = _text(key).lower(); value = _text(value)
+        if key.endswith('*'):
+            key = key[:-1]
+            value = email.utils.collapse_rfc2231_value(email.utils.decode_rfc2231(value))
+        params[key] = value
+    return params
+
+class BodyPart:
+    """One leaf of a BODYSTRUCTURE: enough to fetch, decode and describe the part without downloading it."""
+    __slots__ = ("section", "content_type", "params", "encoding", "size", "disposition", "disposition_params")
+
+    def __init__(self, section, content_type, params, encoding, size, disposition, disposition_params):
+        self.section = section; self.content_type = content_type; self.params = params
+        self.encoding = encoding; self.size = size
+        self.disposition = disposition; self.disposition_params = disposition_params
+
+    @property
+    def filename(self):
+        name = self.disposition_params.get('filename') or self.params.get('name')
+        return decode_email_header(name) if name else None
+
+    @property
+    def is_attachment(self):
+        # Same rule as email_parser.walk_mime
+        if self.disposition != 'attachment' and not self.filename: return False
+        return not (self.disposition == 'inline' and self.content_type.startswith('image/'))
+
+    @property
+    def estimated_decoded_size(self):
+        return self.size * 3 // 4 if self.encoding == 'base64' else self.size
+
+def walk_bodystructure(structure, section=''):
+    """Yields the BodyPart leaves of an IMAPClient BODYSTRUCTURE. Attached messages are leaves."""
+    if structure.is_multipart:
+        for idx, child in enumerate(structure[0], start=1):
+            yield from walk_bodystructure(child, f"{section}.{idx}" if section else str(idx))
+        return
+    content_type = f"{_text(structure[0])}/{_text(structure[1])}".lower()
+    if content_type == 'message/rfc822': dsp_index = 11
+    elif content_type.startswith('text/'): dsp_index = 9
+    else: dsp_index = 8
+    disposition = structure[dsp_index] if len(structure) > dsp_index else None
+    disposition_type = _text(disposition[0]).lower() if isinstance(disposition, (tuple, list)) and disposition else ''
+    disposition_params = _params(disposition[1]) if isinstance(disposition, (tuple, list)) and len(disposition) > 1 else {}
+    yield BodyPart(section or '1', content_type, _params(structure[2]), _text(structure[5]).lower() or '7bit',
+                   int(structure[6] or 0), disposition_type, disposition_params)
+
+def plan_fetch(structure):
+    """Splits a message into the text parts the parser needs and the attachments to stream separately.
+
+    Returns (text_parts, attachment_parts), or None when the message is not multipart
+    (nothing to gain over a whole-message fetch).
+    """
+    if not structure.is_multipart: return None
+    text_parts = []; attachment_parts = []; seen_types = set()
+    for part in walk_bodystructure(structure):
+        if part.is_attachment: attachment_parts.append(part)
+        elif part.content_type in ('text/plain', 'text/html') and part.content_type not in seen_types:
+            seen_types.add(part.content_type); text_parts.append(part)
+    return text_parts, attachment_parts
+
+def build_skeleton(header_bytes, text_parts, payloads):
+    """Rebuilds a small MIME message from the real headers and the fetched text parts, for parse_email."""
+    headers = email.message_from_bytes(header_bytes)
+    del headers['Content-Type']; del headers['Content-Transfer-Encoding']
+    boundary = f"=_partial_{uuid.uuid4().hex}"
+    headers['Content-Type'] = f'multipart/mixed; boundary="{boundary}"'
+    chunks = [headers.as_bytes().rstrip(b'\r\n') + b'\n\n']
+    for part in text_parts:
+        params = ''.join(f'; {key}="{value}"' for key, value in part.params.items())
+        chunks.append(f"--{boundary}\nContent-Type: {part.content_type}{params}\nContent-Transfer-Encoding: {part.encoding}\n\n".encode('utf-8'))
+        chunks.append(payloads.get(part.section, b'')); chunks.append(b'\n')
+    chunks.append(f"--{boundary}--\n".encode('ascii'))
+    return b''.join(chunks)
+
+class _TransferDecoder:
+    """Incremental Content-Transfer-Encoding decoder for chunked part downloads."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding; self._pending = b''
+
+    def feed(self, data):
+        if self.encoding == 'base64':
+            data = self._pending + b''.join(data.split())
+            usable = len(data) - len(data) % 4
+            self._pending = data[usable:]
+            try: return base64.b64decode(data[:usable])
+            except binascii.Error: return base64.b64decode(data[:usable] + b'==', validate=False)
+        if self.encoding == 'quoted-printable':
+            data = self._pending + data
+            cut = data.rfind(b'\n') + 1 # Only decode whole lines, a soft break may straddle chunks
+            self._pending = data[cut:]
+            return quopri.decodestring(data[:cut])
+        return data
+
+    def flush(self):
+        pending = self._pending; self._pending = b''
+        if not pending: return b''
+        if self.encoding == 'base64': return base64.b64decode(pending + b'=' * (-len(pending) % 4), validate=False)
+        if self.encoding == 'quoted-printable': return quopri.decodestring(pending)
+        return pending
+
+async def download_part(session, uid, part, chunk_size=None):
+    """Streams one body part with BODY.PEEK[section]<offset.length> into a Spool, decoding as it goes."""
+    chunk_size = chunk_size or config.IMAP_PART_CHUNK_BYTES
+    spool = Spool(prefix=f"part-{uid}-"); decoder = _TransferDecoder(part.encoding); offset = 0
+    try:
+        while True:
+            fetched = await session.fetch([uid], [f"BODY.PEEK[{part.section}]<{offset}.{chunk_size}>"])
+            data = fetched.get(uid, {})
+            # Returned as BODY[section]<offset>; look it up by prefix rather than rebuilding the key
+            chunk = next((value for key, value in data.items() if key.upper().startswith(f"BODY[{part.section}]".encode())), None) or b''
+            spool.write(decoder.feed(chunk))
+            offset += len(chunk)
+            if len(chunk) < chunk_size: break
+        spool.write(decoder.flush()); spool.finish()
+    except BaseException:
+        spool.close(); raise
+    logger.debug(f"[{time.strftime('%H:%M:%S')}] Streamed part {part.section} of UID {uid} ({len(spool)} bytes, {'memory' if spool.in_memory else spool.path}).")
+    return spool
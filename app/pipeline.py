@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+from . import config
+
+logger = logging.getLogger(__name__)
+
+class PipelineItem:
+    __slots__ = ("seq", "uid", "raw", "parsed", "chat_id", "skipped", "parts", "memory")
+
+    def __init__(self, seq, uid, raw, parts=None):
+        self.seq = seq; self.uid = uid; self.raw = raw
+        self.parsed = None; self.chat_id = None; self.skipped = False
+        self.parts = parts # Attachment parts still on the server (partial fetch), downloaded by the parse stage
+        self.memory = len(raw) # Bytes charged to the memory budget; the parse stage may lower it
+
+class MemoryBudget:
+    """Bounds the bytes held by in-flight emails; acquire() waits while the budget is used up.
+
+    An email larger than the whole budget is admitted once nothing else is in flight,
+    so it is delayed but never stuck. A limit of 0 disables the budget.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit; self.used = 0
+        self._freed = asyncio.Event()
+
+    async def acquire(self, amount):
+        while self.limit and self.used and self.used + amount > self.limit:
+            self._freed.clear(); await self._freed.wait()
+        self.used += amount
+
+    def release(self, amount):
+        self.used -= amount; self._freed.set()
+
+class MessagePipeline:
+    """Staged fetch -> parse -> render -> send -> commit pipeline.
+
+    The stage callables are supplied by the owner (IMAPHandler):
+      parse(item)  -> fills item.parsed / item.chat_id, or sets item.skipped for filtered mail
+      render(item) -> optional pre-work before sending (HTML rendering)
+      send(item)   -> delivers item.parsed to Telegram
+      commit(item) -> marks/moves the UID on the IMAP server
+      finish(item) -> optional cleanup once the item leaves the pipeline, whatever happened to it
+    Parse and render run in worker pools. Items are released to the send stage in
+    submission order and each chat has a single sender, so per-chat order is kept
+    while different chats are delivered concurrently.
+    """
+
+    def __init__(self, parse, render, send, commit, finish=None,
+                 parse_workers=None, render_workers=None, send_workers=None, queue_size=None, memory_budget=None):
+        self._parse = parse; self._render = render; self._send = send; self._commit = commit; self._on_finish = finish
+        self.parse_workers = parse_workers or config.PIPELINE_PARSE_WORKERS
+        self.render_workers = render_workers or config.PIPELINE_RENDER_WORKERS
+        self.send_workers = send_workers or config.PIPELINE_SEND_WORKERS
+        self.queue_size = queue_size or config.PIPELINE_QUEUE_SIZE
+        self.memory_budget = config.PIPELINE_MEMORY_BUDGET_BYTES if memory_budget is None else memory_budget
+        self._tasks = []; self._chat_tasks = {}; self._started = False
+
+    def start(self):
+        if self._started: return
+        self._parse_queue = asyncio.Queue(maxsize=self.queue_size)
+        self._render_queue = asyncio.Queue(maxsize=self.queue_size)
+        self._commit_queue = asyncio.Queue()
+        self._chat_queues = {}
+        # Bounds everything between submit() and commit, including items parked in the reorder buffer
+        self._inflight = asyncio.Semaphore(self.queue_size * 2 + self.parse_workers + self.render_workers)
+        self._send_slots = asyncio.Semaphore(self.send_workers)
+        # A MemoryBudget instance may be shared by several pipelines (one per monitored mailbox)
+        self._budget = self.memory_budget if isinstance(self.memory_budget, MemoryBudget) else MemoryBudget(self.memory_budget)
+        self._reorder = {}; self._next_seq = 0; self._seq = 0
+        self._live = set() # Every item holding budget and an inflight slot, wherever it is
+        self._pending = 0; self._drained = asyncio.Event(); self._drained.set()
+        self._tasks = [asyncio.create_task(self._parse_worker(i)) for i in range(self.parse_workers)]
+        self._tasks += [asyncio.create_task(self._render_worker(i)) for i in range(self.render_workers)]
+        self._tasks.append(asyncio.create_task(self._commit_worker()))
+        self._started = True
+        logger.info(f"[{time.strftime('%H:%M:%S')}] Pipeline started (parse={self.parse_workers}, render={self.render_workers}, send={self.send_workers}, queue={self.queue_size}).")
+
+    async def stop(self):
+        if not self._started: return
+        tasks = self._tasks + list(self._chat_tasks.values())
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Items still queued, parked for reordering or cut off mid-stage stay unseen on the server; give back
+        # what they hold, or a budget shared with other mailboxes would stay charged for them forever
+        for item in list(self._live): self._finish(item)
+        self._tasks = []; self._chat_tasks = {}; self._started = False
+
+    @property
+    def pending(self):
+        return self._pending if self._started else 0
+
+    async def submit(self, uid, raw, parts=None):
+        """Queues one fetched message. Waits when the pipeline is full or the memory budget is used up (backpressure on the fetcher)."""
+        await self._inflight.acquire()
+        item = PipelineItem(self._seq, uid, raw, parts)
+        if self._budget.limit and self._budget.used and self._budget.used + item.memory > self._budget.limit:
+            logger.debug(f"[{time.strftime('%H:%M:%S')}] UID {uid} waits for memory budget ({self._budget.used}/{self._budget.limit} bytes in flight).")
+        try: await self._budget.acquire(item.memory)
+        except BaseException: self._inflight.release(); raise
+        self._seq += 1; self._live.add(item)
+        self._pending += 1; self._drained.clear()
+        await self._parse_queue.put(item)
+
+    async def drain(self):
+        """Waits until every submitted message has been committed or dropped."""
+        await self._drained.wait()
+
+    def _finish(self, item):
+        if item not in self._live: return
+        self._live.discard(item)
+        if self._on_finish:
+            try: self._on_finish(item)
+            except Exception as e: logger.warning(f"[{time.strftime('%H:%M:%S')}] Cleanup failed for UID {item.uid}: {e}")
+        item.raw = None; item.parsed = None; item.parts = None
+        self._budget.release(item.memory); item.memory = 0
+        self._pending -= 1; self._inflight.release()
+        if self._pending == 0: self._drained.set()
+
+    def _release(self, item):
+        # Reorder buffer: hand items to the send stage strictly in submission order
+        self._reorder[item.seq] = item
+        while self._next_seq in self._reorder:
+            ready = self._reorder.pop(self._next_seq); self._next_seq += 1
+            if ready.parsed is None and not ready.skipped: self._finish(ready) # Failed earlier, stays unseen for retry
+            elif ready.skipped: self._commit_queue.put_nowait(ready)
+            else: self._chat_queue(ready.chat_id).put_nowait(ready)
+
+    def _chat_queue(self, chat_id):
+        queue = self._chat_queues.get(chat_id)
+        if queue is None:
+            queue = self._chat_queues[chat_id] = asyncio.Queue()
+            self._chat_tasks[chat_id] = asyncio.create_task(self._send_worker(chat_id, queue))
+        return queue
+
+    async def _parse_worker(self, idx):
+        while True:
+            item = await self._parse_queue.get()
+            try:
+                charged = item.memory
+                await self._parse(item)
+                item.raw = None # Parsed; the raw message is not needed any more
+                if item.memory < charged: self._budget.release(charged - item.memory)
+                else: item.memory = charged
+                if item.parsed is not None and not item.skipped:
+                    await self._render_queue.put(item); continue
+            except asyncio.CancelledError: raise
+            except Exception as e:
+                logger.error(f"[{time.strftime('%H:%M:%S')}] Parse stage failed for UID {item.uid} ({type(e).__name__}): {e}", exc_info=True)
+                item.parsed = None; item.skipped = False
+            finally: self._parse_queue.task_done()
+            self._release(item)
+
+    async def _render_worker(self, idx):
+        while True:
+            item = await self._render_queue.get()
+            try: await self._render(item)
+            except asyncio.CancelledError: raise
+            except Exception as e:
+                # Rendering is an optimisation; the send stage falls back on its own
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] Render stage failed for UID {item.uid} ({type(e).__name__}): {e}")
+            finally: self._render_queue.task_done()
+            self._release(item)
+
+    async def _send_worker(self, chat_id, queue):
+        while True:
+            item = await queue.get()
+            try:
+                async with self._send_slots:
+                    await self._send(item)
+                self._commit_queue.put_nowait(item)
+            except asyncio.CancelledError: raise
+            except Exception as e:
+                logger.error(f"[{time.strftime('%H:%M:%S')}] Send stage failed for UID {item.uid} to chat {chat_id} ({type(e).__name__}): {e}", exc_info=True)
+                self._finish(item)
+            finally: queue.task_done()
+
+    async def _commit_worker(self):
+        while True:
+            item = await self._commit_queue.get()
+            try: await self._commit(item)
+            except asyncio.CancelledError: raise
+            except Exception as e:
+                logger.error(f"[{time.strftime('%H:%M:%S')}] Commit stage failed for UID {item.uid} ({type(e).__name__}): {e}", exc_info=True)
+            finally:
+                self._commit_queue.task_done(); self._finish(item)
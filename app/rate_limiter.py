@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import time
+from . import config
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second; self.capacity = capacity
+        self.tokens = float(capacity); self.updated = time.monotonic()
+        self.blocked_until = 0.0 # Set when Telegram answers RetryAfter for this bucket
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self):
+        """Takes one token if available. Returns 0 on success, otherwise the seconds to wait before retrying."""
+        now = time.monotonic()
+        if now < self.blocked_until: return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1; return 0
+        return (1 - self.tokens) / self.rate
+
+    def block_for(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class SendScheduler:
+    """Central gate for Telegram Bot API calls.
+
+    Every call takes a token from the global bucket and from its chat's bucket
+    (groups/channels have a lower per-chat limit than private chats). When Telegram
+    replies with RetryAfter the chat is parked for exactly the requested time and the
+    call is retried instead of being dropped.
+    """
+
+    def __init__(self, global_rate=None, private_chat_rate=None, group_chat_rate=None, max_retries=None):
+        self.global_bucket = TokenBucket(global_rate or config.TELEGRAM_GLOBAL_RATE_PER_SECOND, config.TELEGRAM_GLOBAL_BURST)
+        self.private_chat_rate = private_chat_rate or config.TELEGRAM_CHAT_RATE_PER_MINUTE / 60
+        self.group_chat_rate = group_chat_rate or config.TELEGRAM_GROUP_RATE_PER_MINUTE / 60
+        self.max_retries = config.TELEGRAM_RETRY_AFTER_MAX_RETRIES if max_retries is None else max_retries
+        self._chat_buckets = {}; self._waiting = {}
+
+    @property
+    def queue_depth(self):
+        """Number of calls currently waiting for a token or parked after RetryAfter."""
+        return sum(self._waiting.values())
+
+    def chat_queue_depth(self, chat_id):
+        return self._waiting.get(str(chat_id), 0)
+
+    def _chat_bucket(self, chat_id):
+        key = str(chat_id)
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            # Negative ids are groups, supergroups and channels
+            rate = self.group_chat_rate if key.startswith('-') else self.private_chat_rate
+            bucket = self._chat_buckets[key] = TokenBucket(rate, config.TELEGRAM_CHAT_BURST)
+        return bucket
+
+    async def _acquire(self, chat_bucket):
+        while True:
+            wait = chat_bucket.try_take()
+            if wait > 0: await asyncio.sleep(wait); continue
+            wait = self.global_bucket.try_take()
+            if wait > 0:
+                chat_bucket.tokens += 1 # Give the chat token back while we wait for the global one
+                await asyncio.sleep(wait); continue
+            return
+
+    async def run(self, chat_id, make_request, description="request"):
+        """Runs make_request() (returning an awaitable) once tokens are available, retrying on RetryAfter."""
+        key = str(chat_id); chat_bucket = self._chat_bucket(chat_id)
+        attempt = 0
+        while True:
+            self._waiting[key] = self._waiting.get(key, 0) + 1
+            try: await self._acquire(chat_bucket)
+            finally: self._waiting[key] -= 1
+            try:
+                return await make_request()
+            except Exception as e:
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is None or attempt >= self.max_retries: raise
+                attempt += 1
+                # Telegram may send a fractional or timedelta value depending on the client library
+                delay = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+                chat_bucket.block_for(delay)
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] Telegram RetryAfter {delay}s for chat {chat_id} ({description}). Parking chat (attempt {attempt}/{self.max_retries}, queue depth {self.queue_depth}).")
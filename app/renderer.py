@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import imgkit
+from . import config
+
+logger = logging.getLogger(__name__)
+
+class RenderJob:
+    __slots__ = ("key", "html", "future", "enqueued_at")
+
+    def __init__(self, key, html, future):
+        self.key = key; self.html = html; self.future = future; self.enqueued_at = time.monotonic()
+
+class RenderCache:
+    """On-disk LRU cache of rendered images, keyed by content hash. File mtime is the recency stamp."""
+
+    def __init__(self, directory, max_bytes, extension):
+        self.directory = directory; self.max_bytes = max_bytes; self.extension = extension
+        self._total_bytes = None
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.{self.extension}")
+
+    def _scan(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(f".{self.extension}"): continue
+            try: stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError: continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f: data = f.read()
+            os.utime(path) # Mark as recently used
+            return data
+        except FileNotFoundError: return None
+
+    def put(self, key, data):
+        if self._total_bytes is None: self._total_bytes = sum(size for _, size, _ in self._scan())
+        path = self._path(key); tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f: f.write(data)
+        os.replace(tmp_path, path)
+        self._total_bytes += len(data)
+        if self._total_bytes > self.max_bytes: self._evict()
+
+    def _evict(self):
+        entries = sorted(self._scan())
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9) # Evict a little extra so we don't rescan on every insert
+        for _, size, name in entries:
+            if total <= target: break
+            try: os.remove(os.path.join(self.directory, name)); total -= size
+            except FileNotFoundError: pass
+        self._total_bytes = total
+        logger.debug(f"[{time.strftime('%H:%M:%S')}] Render cache evicted down to {total} bytes.")
+
+class HTMLRenderer:
+    """Fixed pool of wkhtmltoimage workers fed from a render queue, in front of a content-addressed cache.
+
+    The wkhtmltoimage command line is resolved once, identical HTML (same wrapped HTML and
+    options) is rendered only once even when requested concurrently, and every render is
+    bounded both in queue wait time and in run time (the process is killed on timeout).
+    """
+
+    def __init__(self, options, workers=None, render_timeout=None, queue_timeout=None, cache_dir=None, cache_max_bytes=None):
+        self.options = options
+        self.workers = workers or config.RENDER_WORKERS
+        self.render_timeout = render_timeout or config.RENDER_TIMEOUT_SECONDS
+        self.queue_timeout = queue_timeout or config.RENDER_QUEUE_TIMEOUT_SECONDS
+        extension = options.get('format', 'jpg')
+        self.cache = RenderCache(cache_dir or config.RENDER_CACHE_DIR,
+                                 config.RENDER_CACHE_MAX_BYTES if cache_max_bytes is None else cache_max_bytes, extension)
+        self._options_fingerprint = json.dumps(options, sort_keys=True).encode('utf-8')
+        self._command = None; self._queue = None; self._tasks = []; self._inflight = {}
+
+    def _get_command(self):
+        if self._command is None:
+            # Built once from an empty source: avoids a `which` lookup per render and ignores
+            # imgkit-* meta tags that an email's own HTML could use to inject options.
+            self._command = imgkit.IMGKit('', 'string', options=self.options, config=imgkit.config()).command()
+        return self._command
+
+    def _start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    def cache_key(self, full_html):
+        digest = hashlib.sha256(full_html.encode('utf-8', errors='surrogatepass'))
+        digest.update(b'\0'); digest.update(self._options_fingerprint)
+        return digest.hexdigest()
+
+    async def render(self, full_html):
+        """Returns image bytes for already-wrapped HTML, from cache when possible."""
+        loop = asyncio.get_event_loop()
+        key = self.cache_key(full_html)
+        if self.cache.enabled:
+            cached = await loop.run_in_executor(None, self.cache.get, key)
+            if cached:
+                logger.info(f"[{time.strftime('%H:%M:%S')}] Render cache hit ({len(cached)} bytes).")
+                return cached
+        inflight = self._inflight.get(key)
+        if inflight is not None: return await asyncio.shield(inflight)
+
+        self._start()
+        future = loop.create_future(); self._inflight[key] = future
+        # A caller that gave up must not leave an unretrieved exception behind; the worker still finishes and caches
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            self._queue.put_nowait(RenderJob(key, full_html, future))
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout + self.render_timeout)
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _worker(self, idx):
+        loop = asyncio.get_event_loop()
+        while True:
+            job = await self._queue.get()
+            try:
+                waited = time.monotonic() - job.enqueued_at
+                if waited > self.queue_timeout:
+                    job.future.set_exception(TimeoutError(f"Render job waited {waited:.1f}s in queue (limit {self.queue_timeout}s)."))
+                    continue
+                image_bytes = await self._run_wkhtmltoimage(job.html)
+                if not job.future.done(): job.future.set_result(image_bytes)
+                if image_bytes and self.cache.enabled:
+                    try: await loop.run_in_executor(None, self.cache.put, job.key, image_bytes)
+                    except OSError as e: logger.warning(f"[{time.strftime('%H:%M:%S')}] Could not write render cache entry: {e}")
+            except asyncio.CancelledError: raise
+            except Exception as e:
+                if not job.future.done(): job.future.set_exception(e)
+            finally: self._queue.task_done()
+
+    async def _run_wkhtmltoimage(self, full_html):
+        process = await asyncio.create_subprocess_exec(*self._get_command(), stdin=asyncio.subprocess.PIPE,
+                                                       stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(('<meta charset="UTF-8">' + full_html).encode('utf-8', errors='replace')), timeout=self.render_timeout)
+        except asyncio.TimeoutError:
+            process.kill(); await process.wait()
+            raise TimeoutError(f"wkhtmltoimage did not finish within {self.render_timeout}s and was killed.")
+        stderr_text = stderr.decode('utf-8', errors='replace')
+        if "Error" in stderr_text or process.returncode != 0:
+            raise OSError(f"wkhtmltoimage failed (exit code {process.returncode}): {stderr_text.strip()[:500]}")
+        return stdout
+
+    async def close(self):
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []; self._queue = None
@@ -0,0 +1,76 @@
+import hashlib
+import io
+import os
+import tempfile
+from . import config
+
+class Spool:
+    """Attachment payload held in memory up to a threshold and spilled to a temporary file above it.
+
+    Written once (write()/finish(), or from_bytes()), then read any number of times through
+    open(). len() gives the size and sha256 the content hash, so a Spool stands in for
+    attachment bytes everywhere. close() deletes the temporary file, if any.
+    A finished Spool is picklable, so parse worker processes can hand it back to the parent.
+    """
+
+    def __init__(self, threshold=None, prefix="spool-"):
+        self.threshold = config.SPOOL_MEMORY_THRESHOLD_BYTES if threshold is None else threshold
+        self.prefix = prefix
+        self.size = 0; self.sha256 = None; self.path = None
+        self._buffer = bytearray(); self._data = None; self._file = None; self._digest = hashlib.sha256()
+
+    @classmethod
+    def from_bytes(cls, data, threshold=None, prefix="spool-"):
+        spool = cls(threshold, prefix)
+        try: spool.write(data); return spool.finish()
+        except BaseException: spool.close(); raise
+
+    def write(self, data):
+        if not data: return
+        self._digest.update(data); self.size += len(data)
+        if self._file is None and len(self._buffer) + len(data) > self.threshold:
+            fd, self.path = tempfile.mkstemp(prefix=self.prefix, dir=config.SPOOL_DIR)
+            self._file = os.fdopen(fd, 'wb'); self._file.write(self._buffer); self._buffer = bytearray()
+        if self._file is not None: self._file.write(data)
+        else: self._buffer += data
+
+    def finish(self):
+        if self._file is not None: self._file.close(); self._file = None
+        else: self._data = bytes(self._buffer)
+        self._buffer = bytearray(); self.sha256 = self._digest.hexdigest(); self._digest = None
+        return self
+
+    @property
+    def in_memory(self):
+        return self.path is None
+
+    @property
+    def memory_size(self):
+        """Bytes this spool keeps in RAM (0 once spilled to disk)."""
+        return self.size if self.in_memory else 0
+
+    def __len__(self):
+        return self.size
+
+    def open(self):
+        """A fresh binary file object positioned at the start of the payload."""
+        return io.BytesIO(self._data or b'') if self.in_memory else open(self.path, 'rb')
+
+    def read_bytes(self):
+        if self.in_memory: return self._data or b''
+        with self.open() as f: return f.read()
+
+    def close(self):
+        if self._file is not None:
+            try: self._file.close()
+            except OSError: pass
+            self._file = None
+        self._data = None
+        if self.path:
+            try: os.remove(self.path)
+            except FileNotFoundError: pass
+
+def close_attachments(attachments):
+    """Releases the spools of a parsed email's attachment list."""
+    for attachment in attachments or []:
+        if isinstance(attachment.get('data'), Spool): attachment['data'].close()
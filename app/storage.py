@@ -0,0 +1,12 @@
+import os
+import sqlite3
+from . import config
+
+def open_database(filename):
+    """Opens (creating if needed) a SQLite database file under DATA_DIR in autocommit mode."""
+    path = filename if os.path.isabs(filename) else os.path.join(config.DATA_DIR, filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
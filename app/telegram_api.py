@@ -0,0 +1,116 @@
+import aiohttp
+import asyncio
+import json
+import logging
+from . import config
+
+logger = logging.getLogger(__name__)
+
+class TelegramAPIError(Exception):
+    def __init__(self, description, error_code=None, method=None):
+        super().__init__(description)
+        self.description = description; self.error_code = error_code; self.method = method
+
+class BadRequest(TelegramAPIError): pass
+
+class NetworkError(TelegramAPIError): pass
+
+class RetryAfter(TelegramAPIError):
+    def __init__(self, retry_after, description=None, method=None):
+        super().__init__(description or f"Flood control exceeded. Retry in {retry_after} seconds", error_code=429, method=method)
+        self.retry_after = retry_after
+
+class InputFile:
+    """A file to upload. data is bytes, or a zero-argument callable returning a fresh binary file object
+    (aiohttp streams and then closes the object, so retries need a new one)."""
+    __slots__ = ("data", "filename", "content_type")
+
+    def __init__(self, data, filename, content_type="application/octet-stream"):
+        self.data = data; self.filename = filename; self.content_type = content_type
+
+class TelegramBotAPI:
+    """Minimal asyncio Bot API client over one pooled keep-alive aiohttp session.
+
+    Uploads are sent as streamed multipart bodies, other calls as JSON. base_url can
+    point at a local Bot API server or a test stand-in.
+    """
+
+    def __init__(self, token, base_url=None, pool_size=None, connect_timeout=None, read_timeout=None, keepalive_seconds=None):
+        self.token = token
+        self.base_url = (base_url or config.TELEGRAM_API_BASE_URL).rstrip('/')
+        self.pool_size = pool_size or config.TELEGRAM_HTTP_POOL_SIZE
+        self.connect_timeout = connect_timeout or config.TELEGRAM_CONNECT_TIMEOUT_SECONDS
+        self.read_timeout = read_timeout or config.TELEGRAM_READ_TIMEOUT_SECONDS
+        self.keepalive_seconds = keepalive_seconds or config.TELEGRAM_KEEPALIVE_SECONDS
+        self._session = None
+
+    def _get_session(self):
+        # Created lazily: aiohttp sessions must be bound to the running loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_seconds)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    def _build_form(self, params, files):
+        form = aiohttp.FormData()
+        for key, value in params.items():
+            if value is None: continue
+            form.add_field(key, value if isinstance(value, str) else json.dumps(value))
+        for key, input_file in files.items():
+            data = input_file.data() if callable(input_file.data) else input_file.data
+            form.add_field(key, data, filename=input_file.filename, content_type=input_file.content_type)
+        return form
+
+    async def call(self, method, params=None, files=None):
+        """Calls a Bot API method and returns its `result`. Raises TelegramAPIError subclasses on failure."""
+        params = {key: value for key, value in (params or {}).items() if value is not None}
+        url = f"{self.base_url}/bot{self.token}/{method}"
+        try:
+            if files: request = self._get_session().post(url, data=self._build_form(params, files))
+            else: request = self._get_session().post(url, json=params)
+            async with request as response:
+                try: payload = await response.json(content_type=None)
+                except ValueError: raise NetworkError(f"Invalid response from Telegram (HTTP {response.status}).", error_code=response.status, method=method)
+        except aiohttp.ClientError as e:
+            raise NetworkError(f"{type(e).__name__}: {e}", method=method) from e
+        except asyncio.TimeoutError as e:
+            raise NetworkError(f"Timed out calling {method}.", method=method) from e
+
+        if payload.get('ok'): return payload.get('result')
+        description = payload.get('description', 'Unknown error'); error_code = payload.get('error_code')
+        parameters = payload.get('parameters') or {}
+        if 'retry_after' in parameters: raise RetryAfter(parameters['retry_after'], description, method=method)
+        if error_code == 400: raise BadRequest(description, error_code, method=method)
+        raise TelegramAPIError(description, error_code, method=method)
+
+    async def send_message(self, chat_id, text, parse_mode=None, disable_web_page_preview=None, **extra):
+        return await self.call('sendMessage', dict(chat_id=chat_id, text=text, parse_mode=parse_mode,
+                                                   disable_web_page_preview=disable_web_page_preview, **extra))
+
+    async def _send_file(self, method, field, chat_id, file, caption, parse_mode, extra):
+        params = dict(chat_id=chat_id, caption=caption, parse_mode=parse_mode, **extra)
+        if isinstance(file, InputFile): return await self.call(method, params, files={field: file})
+        params[field] = file # A file_id or URL string
+        return await self.call(method, params)
+
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None, **extra):
+        return await self._send_file('sendPhoto', 'photo', chat_id, photo, caption, parse_mode, extra)
+
+    async def send_document(self, chat_id, document, caption=None, parse_mode=None, **extra):
+        return await self._send_file('sendDocument', 'document', chat_id, document, caption, parse_mode, extra)
+
+    async def send_media_group(self, chat_id, media, **extra):
+        """media: list of dicts with 'type' ('photo'/'document'), 'media' (InputFile or file_id) and optional caption/parse_mode."""
+        files = {}; payload = []
+        for idx, item in enumerate(media):
+            entry = {key: value for key, value in item.items() if value is not None}
+            if isinstance(entry['media'], InputFile):
+                name = f"file{idx}"; files[name] = entry['media']; entry['media'] = f"attach://{name}"
+            payload.append(entry)
+        return await self.call('sendMediaGroup', dict(chat_id=chat_id, media=payload, **extra), files=files or None)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -1,20 +1,38 @@
-import telegram
-from telegram import InputFile
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import asyncio
 import time
-import imgkit # For HTML to Image conversion
 import os # For imgkit options if needed
 from PIL import Image # For image manipulation (splitting)
 from . import config
-from .email_parser import split_message
+from .email_parser import EFFECTIVE_MAX_LENGTH
+from .renderer import HTMLRenderer
+from .rate_limiter import SendScheduler
+from .telegram_api import TelegramBotAPI, TelegramAPIError, BadRequest, InputFile
+from .file_id_cache import FileIdCache, extract_file_id, is_stale_file_id_error
+from .outbox import Delivery
+from .leases import LeaseExpired
+from .spool import Spool
+from .tg_format import FormattedText, from_markdown, MAX_CAPTION_LENGTH
 
 logger = logging.getLogger(__name__)
 
-bot = telegram.Bot(token=config.TELEGRAM_BOT_TOKEN)
+api = TelegramBotAPI(config.TELEGRAM_BOT_TOKEN)
+scheduler = SendScheduler() # Every Bot API call goes through this rate limiter
+file_id_cache = FileIdCache() # Content hash -> file_id, so identical files are uploaded only once
+# Hashing payloads (up to 50 MB) and the cache's SQLite calls run here, one at a time, off the event loop
+file_id_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="file-id-cache")
 
-PARSEMODE_MARKDOWN = "Markdown"
+MAX_MEDIA_GROUP_SIZE = 10 # Telegram's limit for sendMediaGroup
+
+# Telegram's sendPhoto limits, checked before uploading so a rejected photo is never sent twice
+PHOTO_MAX_BYTES = 10 * 1024 * 1024
+PHOTO_MAX_DIMENSION_SUM = 10000 # width + height
+PHOTO_MAX_ASPECT_RATIO = 20
+PHOTO_MAX_SLICE_HEIGHT = 2560 # Height of the slices a too tall body image is cut into
+PHOTO_JPEG_QUALITY = 85 # JPEG quality for re-encoded (sliced or downscaled) images
+PHOTO_MIN_DOWNSCALE = 0.75 # Shrinking more than this makes text hard to read; such images are sliced instead
 
 # Define supported image MIME types for direct photo sending (from attachments)
 SUPPORTED_IMAGE_MIME_TYPES = [
@@ -37,97 +55,175 @@ IMGKIT_OPTIONS = {
 # if os.path.exists(DEFAULT_CSS_PATH):
 #     IMGKIT_OPTIONS['user-style-sheet'] = DEFAULT_CSS_PATH
 
+renderer = HTMLRenderer(IMGKIT_OPTIONS)
+
+
+async def _bot_call(chat_id, method_name, **kwargs):
+    """Calls a Bot API client method once the rate limiter allows it. Returns the sent message dict."""
+    method = getattr(api, method_name)
+    return await scheduler.run(chat_id, lambda: method(chat_id=chat_id, **kwargs), description=method_name)
+
+def _input_file(data, filename):
+    # Spooled attachments are streamed from the spool; InputFile re-opens them for every (re)try
+    return InputFile(data.open if isinstance(data, Spool) else data, filename=filename)
+
+async def _cache_call(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(file_id_executor, func, *args)
+
+def _cached_file_id(data, kind):
+    content_hash = file_id_cache.content_hash(data)
+    return content_hash, file_id_cache.lookup(content_hash, kind)
 
-def escape_markdown_legacy_chars(text):
-    """Escapes special characters for Telegram's legacy Markdown mode."""
-    if not isinstance(text, str): return ""
-    # For legacy Markdown, only `_`, `*`, `` ` ``, `[` need escaping.
-    escape_chars = r'_*`['
-    # Escape `\` first if it's used in the escape sequence, but it's not here.
-    for char in escape_chars:
-        text = text.replace(char, f'\\{char}')
-    return text
-
-async def send_telegram_message_async(chat_id, text, parse_mode=PARSEMODE_MARKDOWN, disable_web_page_preview=True):
-    if not text: logger.warning(f"[{time.strftime('%H:%M:%S')}] Attempted to send an empty or None message."); return
-    loop = asyncio.get_event_loop()
-    message_parts = split_message(text)
+async def _send_file_cached(chat_id, kind, data, filename, **kwargs):
+    """Sends a photo/document, referencing the cached file_id when the same bytes were uploaded before."""
+    method_name = 'send_photo' if kind == 'photo' else 'send_document'
+    content_hash, file_id = await _cache_call(_cached_file_id, data, kind) if file_id_cache.enabled else (None, None)
+    if file_id:
+        try:
+            message_object = await _bot_call(chat_id, method_name, **{kind: file_id}, **kwargs)
+            logger.debug(f"[{time.strftime('%H:%M:%S')}] Reused cached file_id for {kind} '{filename}' (no upload).")
+            return message_object
+        except BadRequest as e:
+            if not is_stale_file_id_error(e): raise
+            logger.warning(f"[{time.strftime('%H:%M:%S')}] Cached file_id for '{filename}' rejected: {e}. Re-uploading.")
+            await _cache_call(file_id_cache.invalidate, content_hash, kind)
+    message_object = await _bot_call(chat_id, method_name, **{kind: _input_file(data, filename)}, **kwargs)
+    if content_hash: await _cache_call(file_id_cache.store, content_hash, kind, extract_file_id(message_object, kind), len(data))
+    return message_object
+
+def _caption_params(caption):
+    """caption/caption_entities for a file upload or album item. caption is FormattedText or plain str."""
+    if caption is None: return {}
+    if isinstance(caption, str): caption = FormattedText(caption)
+    caption = caption.truncate(MAX_CAPTION_LENGTH)
+    try: caption.validate(); entities = caption.api_entities()
+    except ValueError as e:
+        logger.warning(f"[{time.strftime('%H:%M:%S')}] Dropping caption formatting: {e}"); entities = None
+    return {"caption": caption.text, "caption_entities": entities}
+
+async def send_telegram_message_async(chat_id, text, disable_web_page_preview=True, delivery=None, step=None):
+    """Sends text (FormattedText or plain str), split into parts as needed. Returns True if every part was sent.
+
+    Formatting goes out as an explicit entities array checked locally beforehand, so Telegram
+    never has markup to reject. With a delivery journal and a step name, parts sent on an
+    earlier attempt are skipped.
+    """
+    if not text: logger.warning(f"[{time.strftime('%H:%M:%S')}] Attempted to send an empty or None message."); return False
+    delivery = delivery or Delivery.untracked()
+    formatted = FormattedText(text) if isinstance(text, str) else text
+    if not formatted.text.strip(): formatted = FormattedText("[空内容]", "italic")
+    message_parts = formatted.split(EFFECTIVE_MAX_LENGTH)
     total_parts = len(message_parts)
+    all_sent = True
     for part_idx, part in enumerate(message_parts):
-        if not part.strip() and total_parts > 1 : 
-            logger.debug(f"[{time.strftime('%H:%M:%S')}] Skipping empty part {part_idx + 1}/{total_parts}."); continue
-        current_part_to_send = part
-        if not part.strip() and total_parts == 1 and text.strip() == "":
-             logger.debug(f"[{time.strftime('%H:%M:%S')}] Original text was empty, sending placeholder for part {part_idx + 1}.")
-             current_part_to_send = escape_markdown_legacy_chars("_[空内容]_") if parse_mode else "_[空内容]_"
+        part_step = f"{step}:{part_idx}" if step else None
+        if delivery.is_done(part_step):
+            logger.debug(f"[{time.strftime('%H:%M:%S')}] Part {part_idx + 1}/{total_parts} already sent on an earlier attempt."); continue
+        if total_parts > 1: part.append("\n").append(f"(第 {part_idx+1}/{total_parts} 部分)", "italic")
+        try: part.validate(); entities = part.api_entities()
+        except ValueError as e:
+            # Caught before sending: the part goes out unformatted instead of costing a rejected request
+            logger.warning(f"[{time.strftime('%H:%M:%S')}] Invalid entities in part {part_idx + 1}: {e}. Sending it without formatting."); entities = None
         try:
-            message_object = await loop.run_in_executor(None, lambda: bot.send_message(chat_id=chat_id, text=current_part_to_send, parse_mode=parse_mode, disable_web_page_preview=disable_web_page_preview))
-            logger.debug(f"[{time.strftime('%H:%M:%S')}] Sent message part {part_idx + 1}/{total_parts} to {chat_id}. Msg ID: {message_object.message_id if message_object else 'N/A'}")
-        except telegram.error.TelegramError as e:
-            if "can't parse entities" in str(e).lower() or "parse error" in str(e).lower() and parse_mode:
-                logger.warning(f"[{time.strftime('%H:%M:%S')}] {parse_mode} parsing error for part {part_idx + 1}: {e}. Retrying as plain text.")
-                try:
-                    original_content_of_part = current_part_to_send.removesuffix(f"\n_(第 {part_idx+1}/{total_parts} 部分)_") if total_parts > 1 else current_part_to_send
-                    message_object = await loop.run_in_executor(None, lambda: bot.send_message(chat_id=chat_id, text=original_content_of_part, parse_mode=None, disable_web_page_preview=disable_web_page_preview))
-                    logger.debug(f"[{time.strftime('%H:%M:%S')}] Sent message part {part_idx + 1} as plain text. Msg ID: {message_object.message_id if message_object else 'N/A'}")
-                except Exception as plain_e: logger.error(f"[{time.strftime('%H:%M:%S')}] Failed to send part {part_idx + 1} as plain text: {plain_e}")
-            else: logger.error(f"[{time.strftime('%H:%M:%S')}] Telegram API Error sending text (part {part_idx + 1}): {e} - Text Preview: {current_part_to_send[:100]}...")
+            message_object = await _bot_call(chat_id, 'send_message', text=part.text, entities=entities, disable_web_page_preview=disable_web_page_preview)
+            logger.debug(f"[{time.strftime('%H:%M:%S')}] Sent message part {part_idx + 1}/{total_parts} to {chat_id}. Msg ID: {message_object.get('message_id') if message_object else 'N/A'}")
+            await delivery.mark_done(part_step); continue
+        except TelegramAPIError as e: logger.error(f"[{time.strftime('%H:%M:%S')}] Telegram API Error sending text (part {part_idx + 1}): {e} - Text Preview: {part.text[:100]}...")
         except Exception as e: logger.error(f"[{time.strftime('%H:%M:%S')}] Unexpected error in send_telegram_message_async (part {part_idx + 1}): {e}", exc_info=True)
+        all_sent = False
+    return all_sent
 
 async def send_telegram_document_async(chat_id, document_data, filename, caption=None):
-    loop = asyncio.get_event_loop()
     try:
-        file_to_send = BytesIO(document_data)
-        input_file = InputFile(file_to_send, filename=filename)
-        # Captions for documents will be plain text in this simplified version
-        plain_caption = caption 
-        message_object = await loop.run_in_executor(None, lambda: bot.send_document(chat_id=chat_id, document=input_file, caption=plain_caption, parse_mode=None))
-        logger.debug(f"[{time.strftime('%H:%M:%S')}] Sent document '{filename}' to {chat_id}. Msg ID: {message_object.message_id if message_object else 'N/A'}")
-    except telegram.error.TelegramError as e:
+        message_object = await _send_file_cached(chat_id, 'document', document_data, filename, **_caption_params(caption))
+        logger.debug(f"[{time.strftime('%H:%M:%S')}] Sent document '{filename}' to {chat_id}. Msg ID: {message_object.get('message_id') if message_object else 'N/A'}")
+        return True
+    except TelegramAPIError as e:
         logger.error(f"[{time.strftime('%H:%M:%S')}] Telegram API Error sending document '{filename}': {e}")
         if "file is too big" in str(e).lower():
-            error_msg = f"📎 附件 '{escape_markdown_legacy_chars(filename)}' 文件过大 ({len(document_data)/(1024*1024):.2f} MB)，无法发送。"
-            await send_telegram_message_async(chat_id, error_msg, parse_mode=PARSEMODE_MARKDOWN) # Use legacy markdown for error
+            await send_telegram_message_async(chat_id, f"📎 附件 '{filename}' 文件过大 ({len(document_data)/(1024*1024):.2f} MB)，无法发送。")
     except Exception as e: logger.error(f"[{time.strftime('%H:%M:%S')}] Unexpected error sending document '{filename}': {e}", exc_info=True)
+    return False
 
 async def send_telegram_photo_async(chat_id, photo_data, filename, caption=None):
     """Sends photo data as a photo message."""
-    loop = asyncio.get_event_loop()
     try:
-        photo_to_send = BytesIO(photo_data)
-        input_photo = InputFile(photo_to_send, filename=filename) # filename is optional for photo but good for context
-        # Caption for photos can use Markdown
-        message_object = await loop.run_in_executor(None, lambda: bot.send_photo(
-            chat_id=chat_id,
-            photo=input_photo,
-            caption=caption,
-            parse_mode=PARSEMODE_MARKDOWN if caption else None
-        ))
-        logger.debug(f"[{time.strftime('%H:%M:%S')}] Sent photo '{filename}' to {chat_id}. Msg ID: {message_object.message_id if message_object else 'N/A'}")
+        message_object = await _send_file_cached(chat_id, 'photo', photo_data, filename, **_caption_params(caption))
+        logger.debug(f"[{time.strftime('%H:%M:%S')}] Sent photo '{filename}' to {chat_id}. Msg ID: {message_object.get('message_id') if message_object else 'N/A'}")
         return True
-    except telegram.error.TelegramError as e:
+    except TelegramAPIError as e:
         logger.error(f"[{time.strftime('%H:%M:%S')}] Telegram API Error sending photo '{filename}': {e}")
         # Re-raise specific errors if they need to be handled by the caller (e.g., for splitting)
-        if "photo_invalid_dimensions" in str(e).lower() or \
-           "wrong file identifier" in str(e).lower() or \
-           "PHOTO_SAVE_FILE_INVALID" in str(e).upper() or \
-           "WEBPAGE_CURL_FAILED" in str(e).upper() or \
-           "IMAGE_PROCESS_FAILED" in str(e).upper(): # Common error for oversized images
-            raise e # Re-raise to be caught by send_html_as_image_async for splitting
+        if is_photo_dimension_error(e): raise e # Re-raise to be caught by send_html_as_image_async for splitting
     except Exception as e:
         logger.error(f"[{time.strftime('%H:%M:%S')}] Unexpected error sending photo '{filename}': {e}", exc_info=True)
     return False # Return False for other unhandled errors or if not re-raised
 
-async def send_html_as_image_async(chat_id, html_content, caption):
-    """Renders HTML content to an image and sends it as a photo, splitting if necessary."""
-    loop = asyncio.get_event_loop()
-    MAX_IMAGE_HEIGHT_TG = 2560 # Telegram's typical max height for a photo might be around this, width is less restrictive.
-                               # However, total pixels (W*H) also matter. Let's try a reasonable height.
-    IMG_QUALITY = 85 # JPEG quality for split images
+def media_item(kind, data, filename, caption=None, document_fallback=False, step=None):
+    """One entry for send_telegram_media_group_async. kind is 'photo' or 'document'; step names it in the delivery journal."""
+    return {"kind": kind, "data": data, "filename": filename, "caption": caption, "document_fallback": document_fallback, "step": step}
 
-    try:
-        logger.debug(f"[{time.strftime('%H:%M:%S')}] Attempting to render HTML to image...")
-        full_html = f"""
+async def _send_media_item(chat_id, item):
+    """Sends a single media item on its own; photos may fall back to a document upload."""
+    if item['kind'] == 'photo':
+        try:
+            if await send_telegram_photo_async(chat_id, item['data'], item['filename'], caption=item['caption']): return True
+        except TelegramAPIError:
+            if not item['document_fallback']: raise
+        if not item['document_fallback']: return False
+        logger.info(f"[{time.strftime('%H:%M:%S')}] 附件图片预览发送失败或不适用，作为文档发送: {item['filename']}")
+    return await send_telegram_document_async(chat_id, item['data'], item['filename'], caption=item['caption'])
+
+async def _send_album(chat_id, kind, group):
+    """Sends one sendMediaGroup album, using cached file_ids where possible. Returns False if Telegram rejected it."""
+    hashes = await _cache_call(lambda: [file_id_cache.content_hash(item['data']) for item in group]) if file_id_cache.enabled else [None] * len(group)
+    use_cache = True
+    while True:
+        cached_ids = await _cache_call(lambda: [file_id_cache.lookup(h, kind) if h and use_cache else None for h in hashes])
+        media = [{"type": kind, "media": cached_ids[i] or _input_file(item['data'], item['filename']), **_caption_params(item['caption'])}
+                 for i, item in enumerate(group)]
+        try:
+            messages = await _bot_call(chat_id, 'send_media_group', media=media)
+        except TelegramAPIError as e:
+            if use_cache and any(cached_ids) and isinstance(e, BadRequest) and is_stale_file_id_error(e):
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] Album with cached file_ids rejected: {e}. Re-uploading.")
+                for h, cached in zip(hashes, cached_ids):
+                    if cached: await _cache_call(file_id_cache.invalidate, h, kind)
+                use_cache = False; continue
+            logger.warning(f"[{time.strftime('%H:%M:%S')}] Album of {len(group)} {kind}s rejected: {e}. Sending items individually.")
+            return False
+        for h, item, message in zip(hashes, group, messages or []):
+            if h: await _cache_call(file_id_cache.store, h, kind, extract_file_id(message, kind), len(item['data']))
+        logger.debug(f"[{time.strftime('%H:%M:%S')}] Sent album of {len(group)} {kind}s to {chat_id} ({sum(1 for c in cached_ids if c)} from cache). Msg IDs: {[m.get('message_id') for m in messages or []]}")
+        return True
+
+async def send_telegram_media_group_async(chat_id, items, delivery=None):
+    """Sends items as albums of up to 10 (photos and documents cannot share an album).
+
+    Leftover single items, and every item of an album Telegram rejects, are sent one by one.
+    Items the delivery journal already records are skipped. Returns True if every item was delivered.
+    """
+    delivery = delivery or Delivery.untracked()
+    all_sent = True
+    for kind in ('photo', 'document'):
+        same_kind = [item for item in items if item['kind'] == kind and not delivery.is_done(item['step'])]
+        for start in range(0, len(same_kind), MAX_MEDIA_GROUP_SIZE):
+            group = same_kind[start:start + MAX_MEDIA_GROUP_SIZE]
+            if len(group) > 1:
+                if await _send_album(chat_id, kind, group):
+                    for item in group: await delivery.mark_done(item['step'])
+                    continue
+            for item in group:
+                try: sent = await _send_media_item(chat_id, item)
+                except TelegramAPIError: sent = False
+                if sent: await delivery.mark_done(item['step'])
+                else:
+                    logger.error(f"[{time.strftime('%H:%M:%S')}] Failed to send {kind} '{item['filename']}'.")
+                    all_sent = False
+    return all_sent
+
+def wrap_html_for_render(html_content):
+    return f"""
         <html><head><meta charset="UTF-8">
         <style>
             body {{ font-family: sans-serif; margin: 0; background-color: #ffffff; width: {IMGKIT_OPTIONS.get('width', 800)}px; }}
@@ -139,80 +235,144 @@ async def send_html_as_image_async(chat_id, html_content, caption):
             /* Add more robust styling as needed */
         </style></head><body>{html_content}</body></html>
         """
-        image_bytes = await loop.run_in_executor(None, lambda: imgkit.from_string(full_html, False, options=IMGKIT_OPTIONS))
+
+async def render_html_to_image_async(html_content):
+    """Renders HTML content to image bytes without sending anything (cached, bounded renderer pool)."""
+    logger.debug(f"[{time.strftime('%H:%M:%S')}] Attempting to render HTML to image...")
+    return await renderer.render(wrap_html_for_render(html_content))
+
+async def prerender_email_body_async(parsed_email):
+    """Renders the HTML body ahead of delivery so the send stage only has to upload.
+
+    On failure nothing is stored and send_html_as_image_async renders (and reports) again itself.
+    """
+    body_html_raw = parsed_email.get('body_html')
+    if not body_html_raw or not config.FORWARD_BODY: return
+    try:
+        image_bytes = await render_html_to_image_async(body_html_raw)
+        if image_bytes: parsed_email['body_image'] = image_bytes
+    except Exception as e:
+        logger.warning(f"[{time.strftime('%H:%M:%S')}] Pre-rendering HTML body for UID {parsed_email.get('uid', 'N/A')} failed: {e}")
+
+def is_photo_dimension_error(e):
+    """True for the errors Telegram returns for a photo that is too large or has unusable dimensions."""
+    message = str(e).upper()
+    return any(marker in message for marker in ("PHOTO_INVALID_DIMENSIONS", "WRONG FILE IDENTIFIER", "PHOTO_SAVE_FILE_INVALID",
+                                                "WEBPAGE_CURL_FAILED", "IMAGE_PROCESS_FAILED"))
+
+def photo_limit_problem(width, height, size):
+    """Why Telegram would reject a photo of this size, or None if it is within the sendPhoto limits."""
+    if size > PHOTO_MAX_BYTES: return f"{size} bytes > {PHOTO_MAX_BYTES}"
+    if width + height > PHOTO_MAX_DIMENSION_SUM: return f"{width}+{height} px > {PHOTO_MAX_DIMENSION_SUM}"
+    if max(width, height) > PHOTO_MAX_ASPECT_RATIO * max(min(width, height), 1): return f"aspect ratio {width}x{height} > {PHOTO_MAX_ASPECT_RATIO}"
+    return None
+
+def _encode_image(img):
+    buffer = BytesIO()
+    pillow_format = IMGKIT_OPTIONS.get('format', 'jpeg').upper()
+    if pillow_format == 'JPG': pillow_format = 'JPEG' # Pillow only knows the JPEG spelling
+    if pillow_format == 'JPEG' and img.mode not in ('RGB', 'L'): img = img.convert('RGB')
+    img.save(buffer, format=pillow_format, quality=PHOTO_JPEG_QUALITY)
+    return buffer.getvalue()
+
+def fit_photo_limits(image_bytes, force_split=False):
+    """Turns a rendered body image into photos Telegram will accept. Blocking; run it in an executor.
+
+    Dimensions come from the image header, so an image within the limits is returned as is
+    without being decoded. One that is only too many bytes is re-encoded, and one that is
+    slightly too wide is downscaled; anything else
+    (or any image with force_split) is cut into slices of at most PHOTO_MAX_SLICE_HEIGHT.
+    Returns a list of image bytes, one per photo to send.
+    """
+    img = Image.open(BytesIO(image_bytes)) # Reads the header only
+    width, height = img.size
+    problem = photo_limit_problem(width, height, len(image_bytes))
+    if not problem and not force_split: return [image_bytes]
+    logger.info(f"[{time.strftime('%H:%M:%S')}] Body image {width}x{height} ({len(image_bytes)} bytes) exceeds photo limits: {problem or 'rejected by Telegram'}.")
+
+    if not force_split and max(width, height) <= PHOTO_MAX_ASPECT_RATIO * min(width, height):
+        scale = min(1.0, PHOTO_MAX_DIMENSION_SUM / (width + height))
+        # Tall images are sliced rather than shrunk, which would leave their text unreadable
+        if scale == 1 or (scale >= PHOTO_MIN_DOWNSCALE and height <= PHOTO_MAX_SLICE_HEIGHT):
+            resized = img.resize((max(int(width * scale), 1), max(int(height * scale), 1)), Image.LANCZOS) if scale < 1 else img
+            encoded = _encode_image(resized)
+            if not photo_limit_problem(resized.width, resized.height, len(encoded)):
+                logger.info(f"[{time.strftime('%H:%M:%S')}] Downscaled body image to {resized.width}x{resized.height} ({len(encoded)} bytes).")
+                return [encoded]
+
+    # Too wide for even one slice to fit: narrow it first
+    max_width = PHOTO_MAX_DIMENSION_SUM - PHOTO_MAX_SLICE_HEIGHT
+    if width > max_width:
+        img = img.resize((max_width, max(height * max_width // width, 1)), Image.LANCZOS); width, height = img.size
+    # Equal slices, so the last one is never a thin strip with an unusable aspect ratio
+    num_splits = max((height + PHOTO_MAX_SLICE_HEIGHT - 1) // PHOTO_MAX_SLICE_HEIGHT, 1) # Ceiling division
+    slice_height = (height + num_splits - 1) // num_splits
+    logger.info(f"[{time.strftime('%H:%M:%S')}] Splitting image into {num_splits} parts (Original H: {height}, H per part: {slice_height}).")
+    return [_encode_image(img.crop((0, top, width, min(top + slice_height, height)))) for top in range(0, height, slice_height)]
+
+async def send_html_as_image_async(chat_id, html_content, caption, image_bytes=None, delivery=None):
+    """Renders HTML content to an image and sends it as a photo, splitting if necessary.
+
+    If image_bytes is given (pre-rendered by the pipeline), rendering is skipped. Split
+    slices are journalled as 'body_image:<n>' steps so a retry only sends the missing ones.
+    """
+    delivery = delivery or Delivery.untracked()
+
+    try:
+        if not image_bytes:
+            image_bytes = await render_html_to_image_async(html_content)
         
         if not image_bytes:
-            logger.error(f"[{time.strftime('%H:%M:%S')}] imgkit.from_string returned empty bytes. Cannot send image.")
+            logger.error(f"[{time.strftime('%H:%M:%S')}] HTML renderer returned empty bytes. Cannot send image.")
             return False
 
         logger.info(f"[{time.strftime('%H:%M:%S')}] HTML successfully rendered to image ({len(image_bytes)} bytes). Attempting to send to Telegram...")
-        
-        try:
-            # First, try sending the whole image
-            if await send_telegram_photo_async(chat_id, image_bytes, "email_body.jpg", caption=caption):
-                return True # Successfully sent as a single image
-        except telegram.error.TelegramError as e:
-            if not ("photo_invalid_dimensions" in str(e).lower() or \
-                    "wrong file identifier" in str(e).lower() or \
-                    "PHOTO_SAVE_FILE_INVALID" in str(e).upper() or \
-                    "WEBPAGE_CURL_FAILED" in str(e).upper() or \
-                    "IMAGE_PROCESS_FAILED" in str(e).upper()): # If error is not dimension related, re-raise or log and fail
-                logger.error(f"[{time.strftime('%H:%M:%S')}] Error sending full image (not dimension related): {e}")
-                return False # Fallback to text
-
-            logger.warning(f"[{time.strftime('%H:%M:%S')}] Full image sending failed due to dimensions/processing: {e}. Attempting to split.")
-            
-            # Splitting logic
+
+        # Checked against the photo limits up front, from the image header; only images that need it are decoded
+        # A retry after a partly sent forced split rebuilds the same slices, so only the missing ones are sent
+        resumed_split = delivery.any_done('body_image')
+        images = await asyncio.get_running_loop().run_in_executor(None, fit_photo_limits, image_bytes, resumed_split)
+        if len(images) == 1 and not resumed_split:
+            delivery.check_lease() # Rendering may have taken a while
             try:
-                img = Image.open(BytesIO(image_bytes))
-                original_width, original_height = img.width, img.height
-                num_splits = (original_height + MAX_IMAGE_HEIGHT_TG - 1) // MAX_IMAGE_HEIGHT_TG # Ceiling division
-
-                if num_splits <= 1: # Should have been caught by first send attempt, but as a safeguard
-                    logger.warning(f"[{time.strftime('%H:%M:%S')}] Image already small enough but failed first send. Not splitting further.")
-                    return False
-
-                logger.info(f"[{time.strftime('%H:%M:%S')}] Splitting image into {num_splits} parts (Original H: {original_height}, Max H per part: {MAX_IMAGE_HEIGHT_TG}).")
-                
-                all_parts_sent = True
-                for i in range(num_splits):
-                    top = i * MAX_IMAGE_HEIGHT_TG
-                    bottom = min((i + 1) * MAX_IMAGE_HEIGHT_TG, original_height)
-                    cropped_img = img.crop((0, top, original_width, bottom))
-                    
-                    img_byte_arr = BytesIO()
-                    # Correct the format string for Pillow
-                    pillow_format = IMGKIT_OPTIONS.get('format', 'jpeg').upper()
-                    if pillow_format == 'JPG': # Common mistake, ensure it's JPEG for Pillow
-                        pillow_format = 'JPEG'
-                    cropped_img.save(img_byte_arr, format=pillow_format, quality=IMG_QUALITY)
-                    cropped_image_bytes = img_byte_arr.getvalue()
-                    
-                    part_filename = f"email_body_part_{i+1}.{IMGKIT_OPTIONS.get('format', 'jpg')}"
-                    part_caption = caption if i == 0 else None # Only first part gets the full caption
-                    if i > 0: # Add a simple part indicator for subsequent parts if desired
-                        part_caption = f"_(邮件图片 {i+1}/{num_splits})_"
-
-
-                    if not await send_telegram_photo_async(chat_id, cropped_image_bytes, part_filename, caption=part_caption):
-                        logger.error(f"[{time.strftime('%H:%M:%S')}] Failed to send split image part {i+1}.")
-                        all_parts_sent = False
-                        break # Stop if one part fails
-                    await asyncio.sleep(0.5) # Small delay between sending parts
-                
-                return all_parts_sent
-
-            except Exception as split_e:
-                logger.error(f"[{time.strftime('%H:%M:%S')}] Error during image splitting: {split_e}", exc_info=True)
-                return False # Fallback to text if splitting fails
-
-        # If the first send_telegram_photo_async didn't raise a dimension error but failed for other reasons
-        return False
+                # The whole (possibly downscaled) image fits in one photo
+                if await send_telegram_photo_async(chat_id, images[0], "email_body.jpg", caption=caption):
+                    return True # Successfully sent as a single image
+                # Failed for reasons other than dimensions
+                return False
+            except TelegramAPIError as e:
+                if not is_photo_dimension_error(e): # If error is not dimension related, re-raise or log and fail
+                    logger.error(f"[{time.strftime('%H:%M:%S')}] Error sending full image (not dimension related): {e}")
+                    return False # Fallback to text
+                # Only reached if Telegram's limits are stricter than the local check
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] Full image sending failed due to dimensions/processing: {e}. Attempting to split.")
+                images = await asyncio.get_running_loop().run_in_executor(None, fit_photo_limits, image_bytes, True)
+
+        num_splits = len(images)
+        if num_splits <= 1:
+            logger.warning(f"[{time.strftime('%H:%M:%S')}] Image already small enough but failed first send. Not splitting further.")
+            return False
 
+        part_items = []
+        for i, part_bytes in enumerate(images):
+            part_filename = f"email_body_part_{i+1}.{IMGKIT_OPTIONS.get('format', 'jpg')}"
+            part_caption = caption if i == 0 else None # Only first part gets the full caption
+            if i > 0: # Add a simple part indicator for subsequent parts if desired
+                part_caption = FormattedText(f"(邮件图片 {i+1}/{num_splits})", "italic")
+            part_items.append(media_item('photo', part_bytes, part_filename, caption=part_caption, step=f"body_image:{i}"))
+
+        if config.TELEGRAM_ALBUM_MODE:
+            return await send_telegram_media_group_async(chat_id, part_items, delivery=delivery)
+        for i, item in enumerate(part_items):
+            if not await delivery.run(item['step'], lambda item=item: send_telegram_photo_async(chat_id, item['data'], item['filename'], caption=item['caption'])):
+                logger.error(f"[{time.strftime('%H:%M:%S')}] Failed to send split image part {i+1}.")
+                return False # Stop if one part fails
+        return True
 
+    except LeaseExpired: raise # Not a rendering failure: the caller must not fall back to text
     except FileNotFoundError as e:
         logger.critical(f"[{time.strftime('%H:%M:%S')}] wkhtmltoimage not found: {e}", exc_info=True)
-        await send_telegram_message_async(chat_id, "错误：`wkhtmltoimage` 未安装或未配置，无法将邮件渲染为图片。", parse_mode=None)
+        await send_telegram_message_async(chat_id, FormattedText("错误：").append("wkhtmltoimage", "code").append(" 未安装或未配置，无法将邮件渲染为图片。"))
         return False
     except OSError as e:
         logger.error(f"[{time.strftime('%H:%M:%S')}] OS error during HTML to image conversion (wkhtmltoimage issue?): {e}", exc_info=True)
@@ -221,127 +381,156 @@ async def send_html_as_image_async(chat_id, html_content, caption):
         logger.error(f"[{time.strftime('%H:%M:%S')}] Failed to convert HTML to image: {e}", exc_info=True)
         return False
 
-async def forward_email_to_telegram(parsed_email):
-    chat_id = config.TELEGRAM_CHAT_ID
+async def forward_email_to_telegram(parsed_email, delivery=None):
+    """Forwards a parsed email as header, body and attachment messages. Returns True if every part was sent.
+
+    With a delivery journal (see outbox.Outbox) each part is recorded as it goes out, and
+    a repeated call for the same email only sends what is still missing.
+    """
+    chat_id = parsed_email.get('chat_id') or config.TELEGRAM_CHAT_ID
     email_uid = parsed_email.get('uid', 'N/A')
     if not chat_id:
         logger.error(f"TELEGRAM_CHAT_ID is not set. Cannot forward email UID {email_uid}.")
-        return
+        return False
+    delivery = delivery or Delivery.untracked()
+    all_sent = True
     logger.info(f"[{time.strftime('%H:%M:%S')}] 开始转发邮件 UID {email_uid} ('{parsed_email['subject']}') 到 Telegram 聊天 {chat_id}")
 
     header_parts = []
     field_map = {
-        "subject": ("🏷️ *主题:*", "subject", True), "from": ("👤 *发件人:*", "from", False),
-        "to": ("➡️ *收件人:*", "to", False), "cc": ("👥 *抄送:*", "cc", False),
-        "date": ("📅 *日期:*", "date", True), "importance": ("⚠️ *重要性:*", "importance", False),
-        "message_id": ("🆔 *Message-ID:*", "message_id", True)
+        "subject": ("🏷️", "主题:", "subject", True), "from": ("👤", "发件人:", "from", False),
+        "to": ("➡️", "收件人:", "to", False), "cc": ("👥", "抄送:", "cc", False),
+        "date": ("📅", "日期:", "date", True), "importance": ("⚠️", "重要性:", "importance", False),
+        "message_id": ("🆔", "Message-ID:", "message_id", True)
     }
 
     for field_key in config.TELEGRAM_HEADER_FIELDS:
         if field_key in field_map:
-            label, email_key, use_code_block = field_map[field_key]
+            icon, label, email_key, use_code_block = field_map[field_key]
             value = parsed_email.get(email_key)
             if value and value != "N/A":
-                value_escaped = escape_markdown_legacy_chars(str(value))
-                current_label = label
+                value = str(value)
                 if field_key == "importance":
-                    if value == "high": current_label = f"❗*紧急邮件* ({value_escaped})"
-                    elif value == "low": current_label = f"📉 *低优先级* ({value_escaped})"
-                    elif value == "normal": continue
-                    else: current_label = f"{label} {value_escaped}" # Should not happen
-                
-                if field_key == "importance" and value == "high": # Special case for high importance to always show
-                     header_parts.append(current_label)
-                elif field_key != "importance" or (field_key == "importance" and value != "normal"): # Add if not normal importance
-                    header_parts.append(f"{current_label} `{value_escaped}`" if use_code_block else f"{current_label} {value_escaped}")
-    
-    header_text_for_image_caption = "📧 *新邮件通知*\n" + "\n".join(header_parts) if header_parts else f"📧 *新邮件通知*\n🏷️ *主题:* `{escape_markdown_legacy_chars(parsed_email.get('subject', '[无主题]'))}`"
-    header_text_for_message = "📧 *新邮件通知*\n\n" + "\n".join(header_parts) if header_parts else f"📧 *新邮件通知*\n\n🏷️ *主题:* `{escape_markdown_legacy_chars(parsed_email.get('subject', '[无主题]'))}`"
+                    if value == "high": header_parts.append(FormattedText("❗").append("紧急邮件", "bold").append(f" ({value})"))
+                    elif value == "low": header_parts.append(FormattedText("📉 ").append("低优先级", "bold").append(f" ({value})"))
+                    elif value != "normal": header_parts.append(FormattedText(f"{icon} ").append(label, "bold").append(f" {value}")) # Should not happen
+                    continue
+                header_parts.append(FormattedText(f"{icon} ").append(label, "bold").append(" ").append(value, *(("code",) if use_code_block else ())))
+    if not header_parts:
+        header_parts.append(FormattedText("🏷️ ").append("主题:", "bold").append(" ").append(parsed_email.get('subject') or '[无主题]', "code"))
+
+    def header_text(gap):
+        header = FormattedText("📧 ").append("新邮件通知", "bold").append(gap)
+        for idx, part in enumerate(header_parts): header.extend(part).append("\n" if idx < len(header_parts) - 1 else "")
+        return header
+    header_text_for_image_caption = header_text("\n")
+    header_text_for_message = header_text("\n\n")
 
 
     # Attempt to send HTML body as image first
     body_html_raw = parsed_email.get('body_html')
     body_sent_as_image = False
 
-    if body_html_raw and config.FORWARD_BODY: # Check if HTML body exists and we should forward body
-        logger.info(f"[{time.strftime('%H:%M:%S')}] 邮件 UID {email_uid} 包含 HTML 正文，尝试渲染为图片...")
-        # Use the shorter header_text for image caption to avoid exceeding caption limits
-        body_sent_as_image = await send_html_as_image_async(chat_id, body_html_raw, caption=header_text_for_image_caption)
+    # 'body_mode' pins the image/text decision, so a retry never sends the header both ways
+    if body_html_raw and config.FORWARD_BODY and delivery.result('body_mode') != 'text': # Check if HTML body exists and we should forward body
+        if delivery.is_done('body_image'):
+            body_sent_as_image = True
+        else:
+            logger.info(f"[{time.strftime('%H:%M:%S')}] 邮件 UID {email_uid} 包含 HTML 正文，尝试渲染为图片...")
+            # Use the shorter header_text for image caption to avoid exceeding caption limits
+            body_sent_as_image = await send_html_as_image_async(chat_id, body_html_raw, caption=header_text_for_image_caption, image_bytes=parsed_email.get('body_image'), delivery=delivery)
         if body_sent_as_image:
+            await delivery.mark_done('body_image')
             logger.info(f"[{time.strftime('%H:%M:%S')}] 邮件 UID {email_uid} 的 HTML 正文已作为图片发送。")
+        elif delivery.any_done('body_image'):
+            # Some slices are already in the chat; finish them on the next attempt instead of switching to text
+            logger.warning(f"[{time.strftime('%H:%M:%S')}] 邮件 UID {email_uid} 的 HTML 正文图片只发送了一部分，稍后重试。")
+            return False
         else:
             logger.warning(f"[{time.strftime('%H:%M:%S')}] 邮件 UID {email_uid} 的 HTML 正文渲染为图片失败。将回退到文本格式。")
+            await delivery.mark_done('body_mode', 'text')
             # If image sending failed, we need to send the header separately if it wasn't part of a successful image caption
-            await send_telegram_message_async(chat_id, header_text_for_message, parse_mode=PARSEMODE_MARKDOWN)
+            all_sent &= await send_telegram_message_async(chat_id, header_text_for_message, delivery=delivery, step='header')
     else:
         # No HTML body or body forwarding is disabled, send header as a separate message
-         await send_telegram_message_async(chat_id, header_text_for_message, parse_mode=PARSEMODE_MARKDOWN)
+         all_sent &= await send_telegram_message_async(chat_id, header_text_for_message, delivery=delivery, step='header')
 
 
     # If body was not sent as image (or HTML was not available/image failed), send text body
-    if not body_sent_as_image and config.FORWARD_BODY:
+    forward_body = config.FORWARD_BODY and parsed_email.get('forward_body', True) # A headers_only filter rule turns it off per email
+    if not body_sent_as_image and forward_body:
         email_body_text = parsed_email.get('body', "_[邮件正文处理失败]_") # Fallback for text body
-        email_body_text_escaped = escape_markdown_legacy_chars(email_body_text)
-        
+
         if email_body_text != "_[邮件正文为空]_" and email_body_text != "_[邮件正文处理失败]_":
-            separator = escape_markdown_legacy_chars("\n\n‐‐‐‐‐‐‐‐‐‐ 正文 ‐‐‐‐‐‐‐‐‐‐\n\n")
-            final_body_to_send = separator + email_body_text_escaped
+            # HTML-derived bodies carry Markdown from the converter; plain text bodies only their "> " quotes
+            body = from_markdown(email_body_text, inline=parsed_email.get('body_format') == 'markdown')
+            final_body_to_send = FormattedText("‐‐‐‐‐‐‐‐‐‐ 正文 ‐‐‐‐‐‐‐‐‐‐\n\n").extend(body)
         else:
-            final_body_to_send = email_body_text_escaped # Send placeholder like "[邮件正文为空]"
-        
+            final_body_to_send = FormattedText(email_body_text.strip('_'), "italic") # Send placeholder like "[邮件正文为空]"
+
         if final_body_to_send:
             logger.debug(f"[{time.strftime('%H:%M:%S')}] 发送邮件文本正文 UID {email_uid}...")
-            await send_telegram_message_async(chat_id, final_body_to_send, parse_mode=PARSEMODE_MARKDOWN)
-    elif not config.FORWARD_BODY:
+            all_sent &= await send_telegram_message_async(chat_id, final_body_to_send, delivery=delivery, step='body')
+    elif not forward_body:
         logger.info(f"[{time.strftime('%H:%M:%S')}] 根据配置，跳过发送邮件 UID {email_uid} 的正文。")
 
 
     if config.FORWARD_ATTACHMENTS and parsed_email['attachments']:
         logger.debug(f"[{time.strftime('%H:%M:%S')}] 发送 {len(parsed_email['attachments'])} 个附件，邮件 UID {email_uid}...")
         attachment_count = len(parsed_email['attachments'])
-        attachment_header = f"📎 *附件 ({escape_markdown_legacy_chars(str(attachment_count))}):*"
-        await send_telegram_message_async(chat_id, attachment_header, parse_mode=PARSEMODE_MARKDOWN)
+        attachment_header = FormattedText("📎 ").append(f"附件 ({attachment_count}):", "bold")
+        all_sent &= await send_telegram_message_async(chat_id, attachment_header, delivery=delivery, step='attachments_header')
         
+        attachment_items = []
         for idx, attachment in enumerate(parsed_email['attachments']):
             attachment_data = attachment['data']; attachment_filename = attachment['filename']
             attachment_content_type = attachment['content_type'].lower()
-            file_size_bytes = len(attachment_data)
+            step = attachment.get('step') or f"attachment:{idx}" # Journal key, stable across retries
+            file_size_bytes = len(attachment_data) if attachment_data is not None else attachment.get('size', 0)
             file_size_kb = file_size_bytes / 1024; file_size_mb = file_size_kb / 1024
             size_str = f"{file_size_kb:.2f} KB" if file_size_kb < 1024 else f"{file_size_mb:.2f} MB"
             
             logger.debug(f"[{time.strftime('%H:%M:%S')}] 处理附件 {idx+1}/{attachment_count}: {attachment_filename} ({size_str}, {attachment_content_type}) UID {email_uid}")
             
-            caption = (f"文件: {escape_markdown_legacy_chars(attachment_filename)}\n"
-                       f"类型: {escape_markdown_legacy_chars(attachment_content_type)}\n"
-                       f"大小: {size_str}")
+            caption = FormattedText(f"文件: {attachment_filename}\n类型: {attachment_content_type}\n大小: {size_str}")
+
+            if attachment.get('oversized'): # Skipped by the partial fetch before downloading it
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] 附件 '{attachment_filename}' ({size_str}) 超过 Telegram 上传限制，未下载。")
+                error_msg = f"📎 附件 '{attachment_filename}' 文件过大 ({file_size_mb:.2f} MB)，无法发送。"
+                all_sent &= await send_telegram_message_async(chat_id, error_msg, delivery=delivery, step=step)
+                continue
+
+            if file_size_bytes == 0: # Ensure data is not empty
+                logger.warning(f"[{time.strftime('%H:%M:%S')}] 附件 '{attachment_filename}' 数据为空，跳过发送。"); continue
 
-            photo_sent_successfully = False
             if config.TELEGRAM_IMAGE_PREVIEW and \
                attachment_content_type in SUPPORTED_IMAGE_MIME_TYPES and \
-               file_size_bytes < config.TELEGRAM_IMAGE_PREVIEW_MAX_SIZE_BYTES and \
-               file_size_bytes > 0: # Ensure data is not empty
-                
+               file_size_bytes < config.TELEGRAM_IMAGE_PREVIEW_MAX_SIZE_BYTES:
                 logger.info(f"[{time.strftime('%H:%M:%S')}] 尝试作为图片预览发送附件: {attachment_filename}")
-                photo_sent_successfully = await send_telegram_photo_async(
-                    chat_id, attachment_data, attachment_filename, caption=caption
-                )
-            
-            if not photo_sent_successfully:
-                if config.TELEGRAM_IMAGE_PREVIEW and attachment_content_type in SUPPORTED_IMAGE_MIME_TYPES:
-                    logger.info(f"[{time.strftime('%H:%M:%S')}] 附件图片预览发送失败或不适用，作为文档发送: {attachment_filename}")
-                else:
-                    logger.debug(f"[{time.strftime('%H:%M:%S')}] 作为文档发送附件: {attachment_filename}")
-                
-                if file_size_bytes > 0: # Ensure data is not empty before sending as document
-                    await send_telegram_document_async(
-                        chat_id, attachment_data, attachment_filename, caption=caption
-                    )
-                else:
-                    logger.warning(f"[{time.strftime('%H:%M:%S')}] 附件 '{attachment_filename}' 数据为空，跳过发送。")
+                attachment_items.append(media_item('photo', attachment_data, attachment_filename, caption=caption, document_fallback=True, step=step))
+            else:
+                logger.debug(f"[{time.strftime('%H:%M:%S')}] 作为文档发送附件: {attachment_filename}")
+                attachment_items.append(media_item('document', attachment_data, attachment_filename, caption=caption, step=step))
+
+        if config.TELEGRAM_ALBUM_MODE:
+            all_sent &= await send_telegram_media_group_async(chat_id, attachment_items, delivery=delivery)
+        else:
+            for item in attachment_items:
+                try: all_sent &= await delivery.run(item['step'], lambda item=item: _send_media_item(chat_id, item))
+                except TelegramAPIError as e:
+                    logger.error(f"[{time.strftime('%H:%M:%S')}] Failed to send attachment '{item['filename']}': {e}"); all_sent = False
 
     elif not parsed_email['attachments']:
         logger.debug(f"[{time.strftime('%H:%M:%S')}] 邮件 UID {email_uid} 无附件。")
     else: # Attachments exist but FORWARD_ATTACHMENTS is false
         logger.info(f"[{time.strftime('%H:%M:%S')}] 根据配置，跳过发送邮件 UID {email_uid} 的 {len(parsed_email['attachments'])} 个附件.")
     
-    logger.info(f"[{time.strftime('%H:%M:%S')}] 邮件 UID {email_uid} ('{parsed_email['subject']}') 转发到 Telegram 完成。")
+    if all_sent: logger.info(f"[{time.strftime('%H:%M:%S')}] 邮件 UID {email_uid} ('{parsed_email['subject']}') 转发到 Telegram 完成。")
+    else: logger.warning(f"[{time.strftime('%H:%M:%S')}] 邮件 UID {email_uid} ('{parsed_email['subject']}') 部分内容发送失败。")
+    return bool(all_sent)
+
+async def shutdown():
+    """Stops background workers owned by the sender (renderer pool, HTTP connection pool)."""
+    await renderer.close()
+    await api.close()
+    await _cache_call(file_id_cache.close); file_id_executor.shutdown(wait=False)
@@ -0,0 +1,164 @@
+import re
+from .email_parser import utf16_length, utf16_prefix, EFFECTIVE_MAX_LENGTH
+
+# MessageEntity types this module produces
+ENTITY_TYPES = {"bold", "italic", "underline", "strikethrough", "code", "pre", "text_link", "blockquote"}
+MAX_CAPTION_LENGTH = 1024 # Telegram's caption limit, in UTF-16 units
+
+class FormattedText:
+    """Message text plus explicit Telegram MessageEntity spans, used instead of parse_mode markup.
+
+    Nothing in the text is markup, so there is nothing to escape and nothing Telegram can fail
+    to parse. Entities are kept with character offsets and converted to the UTF-16 offsets
+    the Bot API expects by api_entities().
+    """
+    __slots__ = ("_chunks", "_length", "entities")
+
+    def __init__(self, text="", *types, url=None, language=None):
+        self._chunks = []; self._length = 0
+        self.entities = [] # (type, start, end, extra) with character offsets
+        if text: self.append(text, *types, url=url, language=language)
+
+    @property
+    def text(self):
+        if len(self._chunks) > 1: self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def __len__(self):
+        return self._length
+
+    def __bool__(self):
+        return self._length > 0
+
+    def __str__(self):
+        return self.text
+
+    def append(self, text, *types, url=None, language=None):
+        """Appends text, wrapped in the given entity types. Returns self, so calls can be chained."""
+        if not text: return self
+        start = self._length
+        self._chunks.append(text); self._length += len(text)
+        for entity_type in types:
+            extra = {"url": url} if entity_type == "text_link" else {"language": language} if entity_type == "pre" and language else {}
+            self.entities.append((entity_type, start, self._length, extra))
+        return self
+
+    def extend(self, other):
+        """Appends another FormattedText, entities included. Returns self."""
+        if isinstance(other, str): return self.append(other)
+        offset = self._length
+        self._chunks.append(other.text); self._length += len(other)
+        self.entities.extend((t, s + offset, e + offset, x) for t, s, e, x in other.entities)
+        return self
+
+    def validate(self):
+        """Checks every entity locally, so a malformed one is never sent. Raises ValueError."""
+        spans = []
+        for entity_type, start, end, extra in self.entities:
+            if entity_type not in ENTITY_TYPES: raise ValueError(f"Unsupported entity type {entity_type!r}.")
+            if not 0 <= start < end <= self._length: raise ValueError(f"Entity {entity_type} [{start}, {end}) is outside the text (length {self._length}).")
+            if entity_type == "text_link" and not re.match(r"^(https?|tg)://", extra.get("url") or ""): raise ValueError(f"Link entity has an unusable URL {extra.get('url')!r}.")
+            spans.append((start, -end, entity_type))
+        # Entities may nest but must not partially overlap
+        open_ends = []
+        for start, neg_end, entity_type in sorted(spans):
+            end = -neg_end
+            while open_ends and open_ends[-1] <= start: open_ends.pop()
+            if open_ends and end > open_ends[-1]: raise ValueError(f"Entity {entity_type} [{start}, {end}) partially overlaps another entity.")
+            open_ends.append(end)
+
+    def slice(self, start, end):
+        """The text between two character offsets, with entities clipped to it."""
+        piece = FormattedText(self.text[start:end])
+        for entity_type, e_start, e_end, extra in self.entities:
+            s, e = max(e_start, start), min(e_end, end)
+            if s < e: piece.entities.append((entity_type, s - start, e - start, extra))
+        return piece
+
+    def split(self, max_length=EFFECTIVE_MAX_LENGTH):
+        """Pieces of at most max_length UTF-16 units, cut at a paragraph break, a line break or a space.
+
+        Entities crossing a cut are simply clipped on both sides; unlike markup, nothing can break.
+        """
+        text = self.text; total = len(text); position = 0; pieces = []
+        while position < total:
+            window = text[position:position + max_length]
+            fits = utf16_prefix(window, max_length)
+            if position + fits >= total: pieces.append(self._trimmed_slice(position, total)); break
+            window = window[:fits]
+            for separator in ("\n\n", "\n", " "):
+                cut = window.rfind(separator)
+                if cut > fits // 2: break
+            else: cut = max(fits, 1); separator = ""
+            pieces.append(self._trimmed_slice(position, position + cut))
+            position += cut + (1 if separator == " " else 0)
+            while position < total and text[position] == "\n": position += 1
+        return [piece for piece in pieces if piece] or [FormattedText()]
+
+    def _trimmed_slice(self, start, end):
+        # Telegram strips surrounding whitespace from a message; trimming here keeps entity offsets exact
+        text = self.text
+        while start < end and text[start].isspace(): start += 1
+        while end > start and text[end - 1].isspace(): end -= 1
+        return self.slice(start, end)
+
+    def truncate(self, max_length, ellipsis="…"):
+        """This text cut to max_length UTF-16 units (for captions)."""
+        if utf16_length(self.text) <= max_length: return self
+        cut = utf16_prefix(self.text, max_length - utf16_length(ellipsis))
+        return self.slice(0, cut).append(ellipsis)
+
+    def api_entities(self):
+        """Entities as Bot API MessageEntity dicts, with offsets in UTF-16 units."""
+        if not self.entities: return None
+        text = self.text; units = {}
+        def to_units(offset):
+            if offset not in units: units[offset] = utf16_length(text[:offset])
+            return units[offset]
+        result = []
+        for entity_type, start, end, extra in sorted(self.entities, key=lambda entity: (entity[1], -entity[2])):
+            offset = to_units(start)
+            result.append({"type": entity_type, "offset": offset, "length": to_units(end) - offset, **extra})
+        return result
+
+INLINE_MARKDOWN_PATTERN = re.compile(r"\*\*(?P<bold>[^*\n]+?)\*\*|\*(?P<italic>[^*\s][^*\n]*?)\*|\[(?P<label>[^\]\n]+)\]\((?P<url>https?://[^)\s]+)\)")
+HEADING_PATTERN = re.compile(r"^#{1,6} ")
+PLACEHOLDER_PATTERN = re.compile(r"^_(\[[^\]\n]+\])_$") # Parser notes such as "_[引用内容已移除]_"
+
+def from_markdown(markdown, inline=True):
+    """Builds a FormattedText from the Markdown that html_text.html_to_markdown writes.
+
+    Handles "# " headings (bold), "> " quotes (blockquote), "_[...]_" parser notes (italic)
+    and, with inline=True, **bold**, *italic* and [label](url) links. Anything else stays literal text, so no input can fail.
+    """
+    formatted = FormattedText(); quote_start = None
+    lines = markdown.split("\n")
+    for line_idx, line in enumerate(lines):
+        quoted = line.startswith(">")
+        if quoted and quote_start is None: quote_start = len(formatted)
+        if quoted: line = line[1:].lstrip(" ")
+        heading = HEADING_PATTERN.match(line)
+        if heading: line = line[heading.end():]
+        line_start = len(formatted)
+        placeholder = PLACEHOLDER_PATTERN.match(line)
+        if placeholder: formatted.append(placeholder.group(1), "italic")
+        elif inline:
+            position = 0
+            for match in INLINE_MARKDOWN_PATTERN.finditer(line):
+                formatted.append(line[position:match.start()])
+                if match.group("bold"): formatted.append(match.group("bold"), "bold")
+                elif match.group("italic"): formatted.append(match.group("italic"), "italic")
+                else: formatted.append(match.group("label"), "text_link", url=match.group("url"))
+                position = match.end()
+            formatted.append(line[position:])
+        else: formatted.append(line)
+        if heading and len(formatted) > line_start:
+            # The heading is bold as a whole; inner bold spans would only duplicate it
+            formatted.entities = [entity for entity in formatted.entities if not (entity[0] == "bold" and entity[1] >= line_start)]
+            formatted.entities.append(("bold", line_start, len(formatted), {}))
+        last_line = line_idx == len(lines) - 1
+        if quote_start is not None and (last_line or not lines[line_idx + 1].startswith(">")):
+            if len(formatted) > quote_start: formatted.entities.append(("blockquote", quote_start, len(formatted), {}))
+            quote_start = None
+        if not last_line: formatted.append("\n")
+    return formatted